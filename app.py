@@ -1,8 +1,11 @@
 #!/usr/bin/env python3
 import time
+import threading
 
 from flask import Flask, render_template, jsonify, request
 
+from micamac.flask_utils import serve_until
+
 app = Flask(__name__)
 
 EXAMPLE_FC = {
@@ -34,12 +37,7 @@ EXAMPLE_FC = {
 }
 
 POLYGONS = []
-
-def shutdown_server():
-    func = request.environ.get('werkzeug.server.shutdown')
-    if func is None:
-        raise RuntimeError('Not running with the Werkzeug Server')
-    func()
+POLYGON_RECEIVED = threading.Event()
 
 @app.route('/')
 def index():
@@ -50,11 +48,11 @@ def index():
 def post_polygon():
     content = request.get_json(silent=True)
     POLYGONS.append(content)
-    shutdown_server()
+    POLYGON_RECEIVED.set()
     return jsonify('Bye')
 
 
 if __name__ == '__main__':
     print('Visit the address written below to select a subset of images to process')
-    app.run(debug=False)
+    serve_until(app, POLYGON_RECEIVED)
     print(POLYGONS)
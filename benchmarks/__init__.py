@@ -0,0 +1,20 @@
+"""Benchmarks of micamac
+
+Synthetic RedEdge flights (``benchmarks.synthetic``) and a stub of the mm3d
+command (``benchmarks/stubs/mm3d``) make it possible to time image processing
+functions and the orchestration of the workflow without real data and
+without MicMac. Requires pytest-benchmark; when exiftool is not installed, a
+stub (``benchmarks/stubs/exiftool``) serves the image metadata from the
+``flight.csv`` of the synthetic flights
+
+Run from the repository root; every run is saved in ``.benchmarks/`` so that
+later runs can be compared to it::
+
+    pytest benchmarks
+    pytest benchmarks --n-captures 200 --capture-scale 0.5
+    pytest benchmarks --benchmark-compare --benchmark-compare-fail=mean:10%
+    pytest-benchmark compare --group-by=name
+
+The time the stub spends per unit of mm3d work is set with the
+``MM3D_STUB_COST`` environment variable (seconds, defaults to 0.002)
+"""
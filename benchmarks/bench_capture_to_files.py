@@ -0,0 +1,33 @@
+import functools
+
+import pytest
+
+imageset = pytest.importorskip('micasense.imageset')
+imageutils = pytest.importorskip('micasense.imageutils')
+
+from micamac.micasense_utils import capture_to_files
+
+
+@pytest.fixture(scope='module')
+def alignment(raw_flight):
+    imgset = imageset.ImageSet.from_directory(raw_flight)
+    warp_matrices, alignment_pairs = imageutils.align_capture(imgset.captures[0],
+                                                              max_iterations=10)
+    cropped_dimensions, _ = imageutils.find_crop_bounds(imgset.captures[0], warp_matrices)
+    return imgset, {'warp_matrices': warp_matrices,
+                    'warp_mode': alignment_pairs[0]['warp_mode'],
+                    'cropped_dimensions': cropped_dimensions,
+                    'match_index': alignment_pairs[0]['ref_index']}
+
+
+@pytest.mark.parametrize('img_type', [None, 'reflectance'])
+def bench_capture_to_files(benchmark, tmp_path, alignment, img_type):
+    imgset, process_kwargs = alignment
+    func = functools.partial(capture_to_files, scaling=60000, out_dir=str(tmp_path),
+                             img_type=img_type, **process_kwargs)
+
+    def run():
+        for count, cap in enumerate(imgset.captures):
+            func((cap, True, count))
+
+    benchmark.pedantic(run, rounds=3, iterations=1)
@@ -0,0 +1,7 @@
+from micamac.micmac_utils import dir_to_points
+
+
+def bench_dir_to_points(benchmark, monkeypatch, aligned_flight, n_captures):
+    monkeypatch.chdir(aligned_flight)
+    point_list = benchmark(dir_to_points)
+    assert len(point_list) == n_captures
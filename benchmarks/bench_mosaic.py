@@ -0,0 +1,47 @@
+import os
+
+import numpy as np
+import rasterio
+
+from micamac.mosaic import feather_mosaic
+
+from benchmarks.stub_mm3d import write_raster, write_mtd_ortho
+
+
+COLORS = ['blue', 'green', 'red', 'nir', 'edge']
+
+
+def write_ortho_dirs(root, n_images=12, shape=(480, 640), step=(400, 0)):
+    """Malt like ortho directories (one per color, not georeferenced ``Ort_``
+    images placed by ``MTDOrtho.xml`` and ``PC_*.xml``), band k of image i being
+    filled with ``100 * (k + 1) + i``
+    """
+    for k, color in enumerate(COLORS):
+        ortho_dir = os.path.join(root, 'Ortho-%s' % color)
+        os.makedirs(ortho_dir)
+        write_mtd_ortho(ortho_dir, 500000., 4000000., 0.1)
+        for i in range(n_images):
+            arr = np.full(shape, 100 * (k + 1) + i, dtype=np.uint16)
+            name = '%s_%05d' % (color, i)
+            write_raster(os.path.join(ortho_dir, 'Ort_%s.tif' % name), arr, None)
+            write_raster(os.path.join(ortho_dir, 'PC_%s.tif' % name),
+                         np.zeros(shape, dtype=np.uint8), None)
+            with open(os.path.join(ortho_dir, 'PC_%s.xml' % name), 'w') as dst:
+                dst.write('<MetaDataPartiesCachees><Offset>%d %d</Offset>'
+                          '</MetaDataPartiesCachees>' % (i * step[0], i * step[1]))
+
+
+def bench_feather_mosaic(benchmark, tmp_path):
+    write_ortho_dirs(str(tmp_path))
+    ortho_dirs = [str(tmp_path / ('Ortho-%s' % color)) for color in COLORS]
+    dst_path = str(tmp_path / 'mosaic.tif')
+    benchmark.pedantic(feather_mosaic, args=(ortho_dirs, dst_path),
+                       kwargs={'ncores': 2, 'descriptions': COLORS}, rounds=1)
+    with rasterio.open(dst_path) as src:
+        assert src.descriptions == tuple(COLORS)
+        assert src.transform.c == 500000 and src.transform.f == 4000000
+        arr = src.read(window=((240, 241), (0, src.width)))
+    # Single image areas keep their values, overlaps fade to the closest image
+    base = np.array([100 * (k + 1) for k in range(len(COLORS))])
+    assert (arr[:,0,100] == base).all()
+    assert (arr[:,0,420] == base).all() and (arr[:,0,620] == base + 1).all()
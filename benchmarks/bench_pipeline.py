@@ -0,0 +1,30 @@
+import os
+import sys
+import shutil
+import subprocess
+
+import pytest
+
+RUN_MICMAC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                          'micamac', 'scripts', 'run_micmac.py')
+
+
+@pytest.mark.parametrize('extra_args', [[], ['--tile-size', '100', '--tile-jobs', '2'],
+                                        ['--tiepoint-factor', '2']],
+                         ids=['block', 'tiled', 'pyramid'])
+def bench_run_micmac(benchmark, tmp_path, stub_mm3d, aligned_flight, extra_args):
+    """Whole run_micmac.py workflow with the mm3d stub (orchestration and python side processing)
+    """
+    counter = iter(range(100))
+
+    def setup():
+        project = str(tmp_path / ('run_%d' % next(counter)))
+        shutil.copytree(aligned_flight, project)
+        return ([sys.executable, RUN_MICMAC, '-i', project, '--auto-subset', '10',
+                 '--utm', '33', '--ortho', '--dem', '-res', '0.5', '-n', '4',
+                 '--history', str(tmp_path / 'history.jsonl')] + extra_args,), {}
+
+    def run(args):
+        subprocess.check_call(args, stdout=subprocess.DEVNULL)
+
+    benchmark.pedantic(run, setup=setup, rounds=2, iterations=1)
@@ -0,0 +1,13 @@
+import pytest
+
+from micamac.micmac_utils import make_tarama_mask, points_to_utm
+from benchmarks.synthetic import write_tarama_dir
+
+
+@pytest.mark.parametrize('footprint', ['convex', 'concave', 'lines'])
+@pytest.mark.parametrize('res', [0.5, 0.1])
+def bench_make_tarama_mask(benchmark, tmp_path, monkeypatch, flight_points, footprint, res):
+    monkeypatch.chdir(tmp_path)
+    write_tarama_dir('TA', points_to_utm(flight_points, utm_zone=33), res=res)
+    benchmark(make_tarama_mask, point_list=flight_points, utm_zone=33, buff=50,
+              footprint=footprint)
@@ -0,0 +1,143 @@
+import os
+import csv
+import shutil
+import subprocess
+
+import numpy as np
+import pytest
+import cv2
+import rasterio
+from affine import Affine
+
+from micamac.micmac_utils import build_tiepoint_pyramid, make_tiepoint_image
+from micamac.homol_utils import write_homol, read_homol, rescale_homol
+from micamac.homol_utils import homol_files, homol_count
+from micamac.reference import write_pairs
+
+from benchmarks.conftest import STUBS_DIR
+
+
+def has_tapioca():
+    """Whether a real mm3d (not the stub) is on the PATH
+    """
+    path = shutil.which('mm3d')
+    return path is not None and os.path.dirname(os.path.abspath(path)) != STUBS_DIR
+
+
+def flight_pairs(img_dir, max_dist=60):
+    """Pairs of images of a synthetic flight closer than ``max_dist`` meters
+    """
+    with open(os.path.join(img_dir, 'flight.csv')) as src:
+        rows = list(csv.DictReader(src))
+    lat0 = np.radians(float(rows[0]['lat']))
+    xy = np.array([(float(x['lon']) * 111320 * np.cos(lat0), float(x['lat']) * 111320)
+                   for x in rows])
+    return [(rows[i]['image'], rows[j]['image'])
+            for i in range(len(rows)) for j in range(i + 1, len(rows))
+            if np.hypot(*(xy[i] - xy[j])) < max_dist]
+
+
+def run_tapioca(img_dir, pairs):
+    """Match image pairs with ``mm3d Tapioca File``, writing ``<img_dir>/Homol``
+    """
+    write_pairs(pairs, os.path.join(img_dir, 'pairs.xml'))
+    subprocess.check_call(['mm3d', 'Tapioca', 'File', 'pairs.xml', '-1'], cwd=img_dir,
+                          stdout=subprocess.DEVNULL)
+
+
+def match_tiepoints(img_dir, pairs, homol_dir, ratio=0.75):
+    """Match SIFT features of image pairs (stand-in for Tapioca when MicMac is
+    not installed) and write Homol files
+
+    Return:
+        int: Number of tie points
+    """
+    sift = cv2.SIFT_create()
+    features = {}
+    for img in sorted(set(x for pair in pairs for x in pair)):
+        arr = cv2.imread(os.path.join(img_dir, img), cv2.IMREAD_UNCHANGED)
+        features[img] = sift.detectAndCompute(arr, None)
+    matcher = cv2.BFMatcher()
+    total = 0
+    for img_1, img_2 in pairs:
+        (kp_1, des_1), (kp_2, des_2) = features[img_1], features[img_2]
+        if des_1 is None or des_2 is None:
+            continue
+        matches = [m[0] for m in matcher.knnMatch(des_1, des_2, k=2)
+                   if len(m) == 2 and m[0].distance < ratio * m[1].distance]
+        arr = np.array([kp_1[m.queryIdx].pt + kp_2[m.trainIdx].pt for m in matches]).reshape(-1, 4)
+        pastis = os.path.join(homol_dir, 'Pastis%s' % img_1)
+        os.makedirs(pastis, exist_ok=True)
+        write_homol(os.path.join(pastis, '%s.dat' % img_2), arr)
+        total += len(matches)
+    return total
+
+
+@pytest.mark.parametrize('factor', [1, 2, 4])
+def bench_tiepoint_pyramid(benchmark, tmp_path, monkeypatch, aligned_images, factor):
+    """Tie point matching on 8 bits derivatives reduced by ``factor`` (1 is full
+    resolution), including the pyramid build and the rescaling of the tie points
+
+    Pairs are matched by Tapioca when MicMac is installed, by SIFT otherwise. The
+    matcher and number of tie points are reported in the ``extra_info`` of the
+    benchmark
+    """
+    monkeypatch.chdir(aligned_images)
+    pairs = flight_pairs(aligned_images)
+    tapioca = has_tapioca()
+    counter = iter(range(100))
+
+    def setup():
+        return (str(tmp_path / ('run_%d' % next(counter))),), {}
+
+    def run(out_dir):
+        pyram_dir = os.path.join(out_dir, 'Pyram-TP')
+        build_tiepoint_pyramid(factor=factor, ncores=4, out_dir=pyram_dir)
+        if tapioca:
+            run_tapioca(pyram_dir, pairs)
+        else:
+            match_tiepoints(pyram_dir, pairs, os.path.join(pyram_dir, 'Homol'))
+        return rescale_homol(os.path.join(pyram_dir, 'Homol'),
+                             os.path.join(out_dir, 'Homol'), factor=factor)
+
+    n_tiepoints = benchmark.pedantic(run, setup=setup, rounds=2, iterations=1)
+    benchmark.extra_info['matcher'] = 'tapioca' if tapioca else 'sift'
+    benchmark.extra_info['pairs'] = len(pairs)
+    benchmark.extra_info['tiepoints'] = n_tiepoints
+    benchmark.extra_info['connected_pairs'] = sum(
+        1 for _, _, path in homol_files(os.path.join(str(tmp_path), 'run_0', 'Homol'))
+        if homol_count(path) > 0)
+    assert n_tiepoints > 0
+
+
+@pytest.mark.parametrize('factor', [2, 3, 4])
+def bench_tiepoint_image_scale(benchmark, tmp_path, factor):
+    """Reduced tie point image of a 1283 x 961 image (not a multiple of ``factor``)
+
+    A blob near the far corner must map back to its full resolution position
+    through ``rescale_homol`` within a fraction of a pixel
+    """
+    height, width = 961, 1283
+    cx, cy = 1262.3, 940.6
+    rows, cols = np.mgrid[0:height, 0:width]
+    arr = 30000 * np.exp(-((cols - cx) ** 2 + (rows - cy) ** 2) / (2 * 3.0 ** 2))
+    img_path = str(tmp_path / 'pan_00000.tif')
+    with rasterio.open(img_path, 'w', driver='GTiff', width=width, height=height,
+                       count=1, dtype='uint16', transform=Affine.identity()) as dst:
+        dst.write(arr.astype(np.uint16), 1)
+    out_dir = tmp_path / 'Pyram-TP'
+    out_dir.mkdir()
+    out_path = benchmark(make_tiepoint_image, img_path, str(out_dir), factor=factor)
+
+    with rasterio.open(out_path) as src:
+        reduced = src.read(1).astype(np.float64)
+    weights = reduced
+    r, c = np.mgrid[0:reduced.shape[0], 0:reduced.shape[1]]
+    centroid = np.array([[(c * weights).sum() / weights.sum(),
+                          (r * weights).sum() / weights.sum(), 0, 0]])
+    homol_dir = tmp_path / 'Homol-reduced' / 'Pastispan_00000.tif'
+    homol_dir.mkdir(parents=True)
+    write_homol(str(homol_dir / 'pan_00001.tif.dat'), centroid)
+    rescale_homol(str(tmp_path / 'Homol-reduced'), str(tmp_path / 'Homol'), factor=factor)
+    x, y = read_homol(str(tmp_path / 'Homol' / 'Pastispan_00000.tif' / 'pan_00001.tif.dat'))[0, :2]
+    assert abs(x - cx) < 0.5 and abs(y - cy) < 0.5
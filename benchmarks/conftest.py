@@ -0,0 +1,93 @@
+import os
+import shutil
+
+import pytest
+from shapely.geometry import Point
+
+from benchmarks.synthetic import make_aligned_flight, make_raw_flight, flight_plan
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STUBS_DIR = os.path.join(REPO_DIR, 'benchmarks', 'stubs')
+
+
+def pytest_addoption(parser):
+    parser.addoption('--n-captures', type=int, default=40,
+                     help='Number of captures of the synthetic flights')
+    parser.addoption('--capture-scale', type=float, default=0.25,
+                     help='Size of the synthetic images relative to the RedEdge sensor (1280 x 960)')
+
+
+@pytest.fixture(scope='session')
+def n_captures(request):
+    return request.config.getoption('n_captures')
+
+
+@pytest.fixture(scope='session')
+def capture_scale(request):
+    return request.config.getoption('capture_scale')
+
+
+# Set by pytest_configure: the exiftool stub answers metadata queries from
+# flight.csv, the synthetic images are then written without exif tags
+EXIFTOOL_STUB = False
+
+
+def pytest_configure(config):
+    global EXIFTOOL_STUB
+    if shutil.which('exiftool') is None:
+        # Appended, so that a real mm3d found on the PATH is not shadowed
+        EXIFTOOL_STUB = True
+        os.environ['PATH'] = os.environ['PATH'] + os.pathsep + STUBS_DIR
+        os.environ['PYTHONPATH'] = REPO_DIR + os.pathsep + os.environ.get('PYTHONPATH', '')
+
+
+def pytest_report_header(config):
+    if EXIFTOOL_STUB:
+        return 'exiftool: not found, using benchmarks/stubs/exiftool (metadata from flight.csv)'
+    return 'exiftool: %s' % shutil.which('exiftool')
+
+
+@pytest.fixture(scope='session')
+def flight_points(n_captures):
+    """List of (shapely.Point, str) tuples of a synthetic flight, see ``dir_to_points``
+    """
+    positions = flight_plan(n_captures)
+    return [(Point(p['lon'], p['lat']), 'pan_%05d.tif' % i) for i, p in enumerate(positions)]
+
+
+@pytest.fixture(scope='session')
+def raw_flight(tmp_path_factory, n_captures, capture_scale):
+    """Directory of raw synthetic RedEdge captures
+    """
+    img_dir = str(tmp_path_factory.mktemp('raw'))
+    make_raw_flight(img_dir, n_captures, scale=capture_scale, exif=not EXIFTOOL_STUB)
+    return img_dir
+
+
+@pytest.fixture(scope='session')
+def aligned_flight(tmp_path_factory, n_captures, capture_scale):
+    """Directory of synthetic images as produced by align_images.py
+    """
+    img_dir = str(tmp_path_factory.mktemp('aligned'))
+    make_aligned_flight(img_dir, n_captures, scale=capture_scale, exif=not EXIFTOOL_STUB)
+    return img_dir
+
+
+@pytest.fixture(scope='session')
+def aligned_images(tmp_path_factory, n_captures, capture_scale):
+    """Directory of synthetic aligned images without exif tags, for benchmarks
+    that only need the pixels
+    """
+    img_dir = str(tmp_path_factory.mktemp('aligned_noexif'))
+    make_aligned_flight(img_dir, n_captures, scale=capture_scale, exif=False)
+    return img_dir
+
+
+@pytest.fixture
+def stub_mm3d(monkeypatch):
+    """Put the mm3d stub first on the PATH
+    """
+    monkeypatch.setenv('PATH', STUBS_DIR + os.pathsep + os.environ['PATH'])
+    monkeypatch.setenv('PYTHONPATH', REPO_DIR + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    monkeypatch.setenv('MM3D_STUB_COST', os.environ.get('MM3D_STUB_COST', '0.002'))
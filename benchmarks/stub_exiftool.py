@@ -0,0 +1,142 @@
+"""Stand-in for the ``exiftool`` command
+
+Answers the metadata queries micamac sends through pyexiftool (``-stay_open True
+-@ -`` batch mode, one json list per ``-execute``) from the ``flight.csv``
+written next to the synthetic images by ``benchmarks.synthetic``, so that
+benchmarks run where exiftool is not installed. Write invocations (tag
+assignments) are accepted and ignored
+"""
+import os
+import re
+import csv
+import sys
+import json
+import math
+
+import rasterio
+
+from benchmarks.synthetic import SENSOR_SIZE, PIXEL_SIZE_MM, FOCAL_LENGTH_MM
+
+
+# Options followed by a value
+VALUE_OPTIONS = ['-config', '-sep', '-@', '-stay_open', '-w',
+                 '-p', '-d', '-charset', '-o', '-if', '-ext']
+
+_flights = {}
+
+
+def flight_positions(flight_dir):
+    """Dict of image or capture name to flight.csv row, cached per directory
+    """
+    if flight_dir not in _flights:
+        out = {}
+        path = os.path.join(flight_dir, 'flight.csv')
+        if os.path.exists(path):
+            with open(path) as src:
+                for row in csv.DictReader(src):
+                    out[row['image']] = row
+        _flights[flight_dir] = out
+    return _flights[flight_dir]
+
+
+def file_metadata(path):
+    """Exiftool json record (``-G -n`` keys) of a synthetic image
+
+    Aligned images (``<color>_XXXXX.tif``) are looked up under the name of their
+    panchromatic image, raw images (``IMG_XXXX_N.tif``) under their capture name.
+    Links (e.g. reference images) are resolved first
+
+    Return:
+        dict: The record, with only ``SourceFile`` and an ``Error`` when the
+        image is not in flight.csv
+    """
+    real_path = os.path.realpath(path)
+    name = os.path.basename(real_path)
+    key = re.sub(r'^[a-z]+_(\d{5}\.tif)$', r'pan_\1', name)
+    key = re.sub(r'^(IMG_\d{4})_\d+\.tif$', r'\1', key)
+    row = flight_positions(os.path.dirname(real_path)).get(key)
+    if row is None:
+        return {'SourceFile': path, 'ExifTool:Error': 'No flight.csv record'}
+    lon, lat, alt = float(row['lon']), float(row['lat']), float(row['alt'])
+    with rasterio.open(real_path) as src:
+        scale = src.width / float(SENSOR_SIZE[0])
+    return {'SourceFile': path,
+            'EXIF:GPSLatitude': abs(lat),
+            'EXIF:GPSLatitudeRef': 'N' if lat >= 0 else 'S',
+            'EXIF:GPSLongitude': abs(lon),
+            'EXIF:GPSLongitudeRef': 'E' if lon >= 0 else 'W',
+            'EXIF:GPSAltitude': alt,
+            'Composite:GPSLatitude': lat,
+            'Composite:GPSLongitude': lon,
+            'XMP:Yaw': math.degrees(float(row['yaw'])),
+            'EXIF:FocalLength': FOCAL_LENGTH_MM,
+            'EXIF:FocalPlaneXResolution': scale / PIXEL_SIZE_MM,
+            'EXIF:FocalPlaneYResolution': scale / PIXEL_SIZE_MM}
+
+
+def run(args):
+    """Run one exiftool command
+
+    Return:
+        str: Output of the command
+    """
+    files = []
+    is_write = False
+    skip = False
+    for arg in args:
+        if skip:
+            skip = False
+        elif arg in VALUE_OPTIONS:
+            skip = True
+        elif arg.startswith('-'):
+            is_write = is_write or '=' in arg
+        elif arg:
+            files.append(arg)
+    if is_write:
+        return '    %d image files updated\n' % len(files)
+    return json.dumps([file_metadata(x) for x in files], indent=2) + '\n'
+
+
+def stay_open(stdin, stdout):
+    """Batch mode: run the commands read from ``stdin`` until ``-stay_open False``
+    """
+    args = []
+    expect_flag = False
+    for line in stdin:
+        line = line.rstrip('\r\n')
+        if expect_flag:
+            if line.lower() in ['false', '0']:
+                break
+            expect_flag = False
+            continue
+        if line == '-stay_open':
+            expect_flag = True
+            continue
+        match = re.match(r'^-execute(\d*)$', line)
+        if match is None:
+            args.append(line)
+            continue
+        stdout.write(run(args))
+        stdout.write('{ready%s}\n' % match.group(1))
+        stdout.flush()
+        args = []
+
+
+def main(argv):
+    if '-stay_open' in argv and '-@' in argv and argv[argv.index('-@') + 1] == '-':
+        stay_open(sys.stdin, sys.stdout)
+        return 0
+    args = list(argv)
+    if '-@' in args:
+        i = args.index('-@')
+        with open(args[i + 1]) as src:
+            args[i:i + 2] = src.read().splitlines()
+    # Argument files may hold several commands, see synthetic.run_exiftool
+    command = []
+    for arg in args + ['-execute']:
+        if arg == '-execute':
+            sys.stdout.write(run(command))
+            command = []
+        else:
+            command.append(arg)
+    return 0
@@ -0,0 +1,431 @@
+"""Stand-in for the ``mm3d`` command
+
+Reproduces the layout of the files written by the mm3d commands used by
+micamac (Homol, Ori-*, TA, MEC-Malt, Ortho-* directories, world files, ...)
+with synthetic content, and sleeps for a time proportional to the amount of
+work a real run would do (``MM3D_STUB_COST`` seconds per unit, see ``COSTS``),
+so that orchestration code can be benchmarked without MicMac and without
+waiting hours. Image positions are read from the ``flight.csv`` written by
+``benchmarks.synthetic.make_aligned_flight``
+"""
+import os
+import re
+import csv
+import sys
+import glob
+import math
+import time
+import shutil
+
+import numpy as np
+import rasterio
+from affine import Affine
+from rasterio.crs import CRS
+from rasterio.warp import transform as warp_transform
+
+from micamac.homol_utils import write_homol
+from micamac.export_utils import utm_crs
+from micamac.mosaic import raster_bounds
+
+from benchmarks.synthetic import write_tarama_dir
+
+
+# Relative cost of the commands, per image (per pair for Tapioca)
+COSTS = {'XifGps2Txt': 0.01,
+         'XifGps2Xml': 0.01,
+         'OriConvert': 0.01,
+         'Tapioca': 1.0,
+         'Schnaps': 0.1,
+         'Tapas': 0.5,
+         'Martini': 0.05,
+         'CenterBascule': 0.01,
+         'Campari': 0.3,
+         'ChgSysCo': 0.01,
+         'Tarama': 0.05,
+         'Malt': 2.0,
+         'Tawny': 0.3,
+         'SeamlineFeathering': 0.3}
+
+# Ground footprint of an image (m), used to size the synthetic rasters
+FOOTPRINT = (100.0, 75.0)
+
+ORIENTATION_XML = """<?xml version="1.0" ?>
+<ExportAPERO>
+     <OrientationConique>
+          <TypeProj>eProjStenope</TypeProj>
+          <ZoneUtileInPixel>true</ZoneUtileInPixel>
+          <FileInterne>%(calib)s</FileInterne>
+          <RelativeNameFI>true</RelativeNameFI>
+          <Externe>
+               <AltiSol>0</AltiSol>
+               <Profondeur>%(z)f</Profondeur>
+               <Time>0</Time>
+               <KnownConv>eConvApero_DistM2C</KnownConv>
+               <Centre>%(x)f %(y)f %(z)f</Centre>
+               <IncCentre>1 1 1</IncCentre>
+               <ParamRotation>
+                    <CodageMatr>
+                         <L1>%(c)f %(s)f 0</L1>
+                         <L2>%(s)f %(mc)f 0</L2>
+                         <L3>0 0 -1</L3>
+                    </CodageMatr>
+               </ParamRotation>
+          </Externe>
+          <ConvOri>
+               <KnownConv>eConvApero_DistM2C</KnownConv>
+          </ConvOri>
+     </OrientationConique>
+</ExportAPERO>
+"""
+
+
+def parse_args(argv):
+    """Split mm3d arguments into positional arguments and ``Name=value`` options
+    """
+    args = []
+    opts = {}
+    for arg in argv:
+        m = re.match(r'^([A-Za-z][A-Za-z0-9]*)=(.*)$', arg)
+        if m:
+            opts[m.group(1)] = m.group(2).strip('"')
+        else:
+            args.append(arg)
+    return args, opts
+
+
+def match_images(pattern):
+    """Images of the current directory matching an mm3d pattern (regex or ``a|b|c`` list)
+    """
+    pattern = pattern.strip('"')
+    return sorted(x for x in os.listdir('.') if re.fullmatch(pattern, x))
+
+
+def positions(flight_dir='.', prefix=''):
+    """Dict of image name to (lon, lat, alt, yaw), from flight.csv
+
+    Reference images linked by ``micamac.reference.link_reference`` (``ref_``
+    prefix) are read from the flight.csv of the directory they link to
+    """
+    out = {}
+    with open(os.path.join(flight_dir, 'flight.csv')) as src:
+        for row in csv.DictReader(src):
+            position = tuple(float(row[k]) for k in ['lon', 'lat', 'alt', 'yaw'])
+            for color in ['pan', 'blue', 'green', 'red', 'nir', 'edge']:
+                out[prefix + row['image'].replace('pan_', '%s_' % color, 1)] = position
+    ref_list = glob.glob('ref_pan_*.tif') if flight_dir == '.' else []
+    if ref_list:
+        ref_dir = os.path.dirname(os.path.realpath(ref_list[0]))
+        out.update(positions(ref_dir, prefix='ref_'))
+    return out
+
+
+def utm_zone():
+    with open('SysUTM.xml') as src:
+        return int(re.search(r'\+zone=(\d+)', src.read()).group(1))
+
+
+def utm_centers(img_list):
+    """Projected centers (UTM zone of SysUTM.xml) of a list of images, as an (n, 3) array
+    """
+    pos = positions()
+    lon, lat, alt, _ = zip(*[pos[x] for x in img_list])
+    x, y = warp_transform(CRS.from_epsg(4326), utm_crs(utm_zone()), list(lon), list(lat))
+    return np.column_stack([x, y, alt])
+
+
+def work(command, units):
+    time.sleep(float(os.environ.get('MM3D_STUB_COST', '0.002')) * COSTS.get(command, 0) * units)
+
+
+def write_raster(path, arr, transform, tfw=True):
+    """Write a single band tif with its world file, the way MicMac does
+    """
+    profile = {'driver': 'GTiff', 'count': 1, 'dtype': arr.dtype.name,
+               'width': arr.shape[1], 'height': arr.shape[0]}
+    if transform is None:
+        # Not georeferenced, e.g. Malt Ort_ images
+        tfw = False
+    else:
+        profile['transform'] = transform
+    if tfw:
+        profile['TFW'] = 'YES'
+    with rasterio.Env(GDAL_PAM_ENABLED='NO'):
+        with rasterio.open(path, 'w', **profile) as dst:
+            dst.write(arr, 1)
+
+
+def write_ori_dir(ori_dir, img_list, centers, calib_name='AutoCal_Foc-5400_Cam-RedEdge-M.xml'):
+    if not os.path.exists(ori_dir):
+        os.makedirs(ori_dir)
+    pos = positions()
+    with open(os.path.join(ori_dir, calib_name), 'w') as dst:
+        dst.write('<?xml version="1.0" ?>\n<ExportAPERO><CalibrationInternConique>'
+                  '<F>1440</F><PP>640 480</PP><SzIm>1280 960</SzIm>'
+                  '</CalibrationInternConique></ExportAPERO>\n')
+    for img, (x, y, z) in zip(img_list, centers):
+        yaw = pos[img][3]
+        with open(os.path.join(ori_dir, 'Orientation-%s.xml' % img), 'w') as dst:
+            dst.write(ORIENTATION_XML % {'calib': os.path.join(ori_dir, calib_name),
+                                         'x': x, 'y': y, 'z': z,
+                                         'c': math.cos(yaw), 's': math.sin(yaw),
+                                         'mc': -math.cos(yaw)})
+
+
+def read_centers(ori_dir, img_list=None):
+    """Centers of the orientation files of an Ori directory
+
+    Return:
+        tuple: (list of images, (n, 3) array)
+    """
+    files = sorted(glob.glob(os.path.join(ori_dir, 'Orientation-*.xml')))
+    out_img = []
+    out_xyz = []
+    for path in files:
+        img = re.sub(r'^Orientation-(.*)\.xml$', r'\1', os.path.basename(path))
+        if img_list is not None and img not in img_list:
+            continue
+        with open(path) as src:
+            centre = re.search(r'<Centre>(.*)</Centre>', src.read()).group(1)
+        out_img.append(img)
+        out_xyz.append([float(v) for v in centre.split()])
+    return out_img, np.array(out_xyz).reshape(-1, 3)
+
+
+def grid(xyz, res, margin=None):
+    """Transform and shape of a north up grid covering image footprints
+    """
+    margin = margin or max(FOOTPRINT) / 2
+    xmin, ymin = xyz[:,:2].min(axis=0) - margin
+    xmax, ymax = xyz[:,:2].max(axis=0) + margin
+    width = int(math.ceil((xmax - xmin) / res))
+    height = int(math.ceil((ymax - ymin) / res))
+    return Affine(res, 0, xmin, 0, -res, ymax), (height, width)
+
+
+def cmd_xifgps2txt(args, opts):
+    img_list = match_images(args[0])
+    pos = positions()
+    work('XifGps2Txt', len(img_list))
+    with open('GpsCoordinatesFromExif.txt', 'w') as dst:
+        dst.write('#F=N X Y Z\n')
+        for img in img_list:
+            lon, lat, alt, _ = pos[img]
+            dst.write('%s %.8f %.8f %.3f\n' % (img, lon, lat, alt))
+
+
+def cmd_xifgps2xml(args, opts):
+    img_list = match_images(args[0])
+    work('XifGps2Xml', len(img_list))
+    if not os.path.exists('Ori-%s' % args[1]):
+        os.makedirs('Ori-%s' % args[1])
+    shutil.copy('SysUTM.xml', 'RTLFromExif.xml')
+
+
+def cmd_oriconvert(args, opts):
+    with open(args[1]) as src:
+        rows = [x.split() for x in src if not x.startswith('#') and x.strip()]
+    img_list = [x[0] for x in rows]
+    work('OriConvert', len(img_list))
+    xyz = utm_centers(img_list)
+    write_ori_dir('Ori-%s' % args[2], img_list, xyz)
+    nb = int(opts.get('NbImC', 20))
+    with open(opts.get('NameCple', 'FileImagesNeighbour.xml'), 'w') as dst:
+        dst.write('<?xml version="1.0" ?>\n<SauvegardeNamedRel>\n')
+        for i, img in enumerate(img_list):
+            dist = np.hypot(*(xyz[:,:2] - xyz[i,:2]).T)
+            for j in np.argsort(dist)[1:nb + 1]:
+                if dist[j] < max(FOOTPRINT):
+                    dst.write('     <Cple>%s %s</Cple>\n' % (img, img_list[j]))
+        dst.write('</SauvegardeNamedRel>\n')
+
+
+def cmd_tapioca(args, opts):
+    with open(args[1]) as src:
+        pairs = re.findall(r'<Cple>\s*(\S+)\s+(\S+)\s*</Cple>', src.read())
+    work('Tapioca', len(pairs))
+    rng = np.random.RandomState(0)
+    for img_1, img_2 in pairs:
+        pastis = os.path.join('Homol', 'Pastis%s' % img_1)
+        if not os.path.exists(pastis):
+            os.makedirs(pastis)
+        n = rng.randint(50, 500)
+        arr = rng.uniform(0, 1280, (n, 4))
+        write_homol(os.path.join(pastis, '%s.dat' % img_2), arr)
+
+
+def cmd_schnaps(args, opts):
+    img_list = match_images(args[0])
+    work('Schnaps', len(img_list))
+    if os.path.exists('Homol_mini'):
+        shutil.rmtree('Homol_mini')
+    shutil.copytree('Homol', 'Homol_mini')
+
+
+def cmd_tapas(args, opts):
+    img_list = match_images(args[1])
+    work('Tapas', len(img_list))
+    write_ori_dir('Ori-%s' % opts['Out'], img_list, utm_centers(img_list))
+
+
+def cmd_martini(args, opts):
+    img_list = match_images(args[0])
+    work('Martini', len(img_list))
+    out = 'Ori-Martini%s%s' % (opts.get('SH', ''), opts.get('OriCalib', ''))
+    write_ori_dir(out, img_list, utm_centers(img_list))
+
+
+def cmd_copy_ori(command, pattern, out):
+    img_list = match_images(pattern)
+    work(command, len(img_list))
+    write_ori_dir('Ori-%s' % out, img_list, utm_centers(img_list))
+
+
+def cmd_tarama(args, opts):
+    img_list = match_images(args[0])
+    work('Tarama', len(img_list))
+    _, xyz = read_centers('Ori-%s' % args[1], img_list)
+    write_tarama_dir(opts.get('Out', 'TA'), xyz[:,:2], res=0.5, margin=max(FOOTPRINT) / 2)
+
+
+def cmd_malt(args, opts):
+    img_list = match_images(args[1])
+    ori_imgs, xyz = read_centers('Ori-%s' % args[2])
+    resolution = float(opts.get('ResolTerrain', 0.1))
+    zoom = int(opts.get('ZoomF', 1))
+    work('Malt', len(img_list) * (1 if opts.get('DoMEC', '1') != '0' else 0.2))
+    mec_dir = opts.get('DirMEC', 'MEC-Malt')
+    if not os.path.exists(mec_dir):
+        os.makedirs(mec_dir)
+    if opts.get('DoMEC', '1') != '0':
+        aff, shape = grid(xyz, res=resolution * zoom)
+        rows, cols = np.indices(shape)
+        z = (100 + 5 * np.sin(rows / 50.0) + 5 * np.cos(cols / 70.0)).astype(np.float32)
+        name = 'Z_Num7_DeZoom%d_STD-MALT' % zoom
+        write_raster(os.path.join(mec_dir, '%s.tif' % name), z, aff)
+        with open(os.path.join(mec_dir, '%s.xml' % name), 'w') as dst:
+            dst.write('<?xml version="1.0" ?>\n<FileOriMnt>\n'
+                      '     <NameFileMnt>%s.tif</NameFileMnt>\n'
+                      '     <OrigineAlti>0</OrigineAlti>\n'
+                      '     <ResolutionAlti>1</ResolutionAlti>\n</FileOriMnt>\n' % name)
+        write_raster(os.path.join(mec_dir, 'Masq_STD-MALT_DeZoom%d.tif' % zoom),
+                     np.ones(shape, dtype=np.uint8), aff)
+    if opts.get('DoOrtho', '1') != '0':
+        of_dir = opts.get('DirOF', 'Ortho-%s' % mec_dir)
+        if not os.path.exists(of_dir):
+            os.makedirs(of_dir)
+        ortho_imgs = match_images(opts.get('ImOrtho', args[1]))
+        pan_centers = dict(zip(ori_imgs, xyz))
+        ortho_imgs = [x for x in ortho_imgs if re.sub(r'^[a-z]+_', 'pan_', x) in pan_centers]
+        if not ortho_imgs:
+            return
+        # Like Malt, orthoimages are written without georeferencing; their
+        # offset on the MTDOrtho.xml grid is given in PC_*.xml
+        centers = np.array([pan_centers[re.sub(r'^[a-z]+_', 'pan_', x)][:2] for x in ortho_imgs])
+        x_ori = centers[:,0].min() - FOOTPRINT[0] / 2
+        y_ori = centers[:,1].max() + FOOTPRINT[1] / 2
+        write_mtd_ortho(of_dir, x_ori, y_ori, resolution)
+        for img, (x, y) in zip(ortho_imgs, centers):
+            col_off = int(round((x - FOOTPRINT[0] / 2 - x_ori) / resolution))
+            row_off = int(round((y_ori - y - FOOTPRINT[1] / 2) / resolution))
+            with rasterio.open(img) as src:
+                arr = src.read(1, out_shape=(int(FOOTPRINT[1] / resolution),
+                                             int(FOOTPRINT[0] / resolution)))
+            name = os.path.splitext(img)[0]
+            write_raster(os.path.join(of_dir, 'Ort_%s.tif' % name), arr, None)
+            write_raster(os.path.join(of_dir, 'PC_%s.tif' % name),
+                         np.zeros(arr.shape, dtype=np.uint8), None)
+            with open(os.path.join(of_dir, 'PC_%s.xml' % name), 'w') as dst:
+                dst.write('<?xml version="1.0" ?>\n<MetaDataPartiesCachees>\n'
+                          '     <Done>true</Done>\n'
+                          '     <Offset>%d %d</Offset>\n'
+                          '     <Sz>%d %d</Sz>\n'
+                          '     <Pas>1</Pas>\n'
+                          '     <SeuilUse>254</SeuilUse>\n</MetaDataPartiesCachees>\n'
+                          % (col_off, row_off, arr.shape[1], arr.shape[0]))
+
+
+def write_mtd_ortho(of_dir, x_ori, y_ori, resolution):
+    """Write the ``MTDOrtho.xml`` grid of an ortho directory
+    """
+    with open(os.path.join(of_dir, 'MTDOrtho.xml'), 'w') as dst:
+        dst.write('<?xml version="1.0" ?>\n<FileOriMnt>\n'
+                  '     <NameFileMnt>Orthophotomosaic.tif</NameFileMnt>\n'
+                  '     <OriginePlani>%r %r</OriginePlani>\n'
+                  '     <ResolutionPlani>%r %r</ResolutionPlani>\n'
+                  '     <OrigineAlti>0</OrigineAlti>\n'
+                  '     <ResolutionAlti>1</ResolutionAlti>\n'
+                  '     <Geometrie>eGeomMNTEuclid</Geometrie>\n</FileOriMnt>\n'
+                  % (float(x_ori), float(y_ori), float(resolution), -float(resolution)))
+
+
+def mosaic(ortho_dir, out_name, command):
+    """Paste the Ort_ images of a directory in a single mosaic
+    """
+    ort_list = sorted(glob.glob(os.path.join(ortho_dir, 'Ort_*.tif')))
+    work(command, len(ort_list))
+    bounds, res, _ = raster_bounds(ort_list)
+    res = res[0]
+    with rasterio.open(ort_list[0]) as src:
+        dtype = src.dtypes[0]
+    aff = Affine(res, 0, bounds[:,0].min(), 0, -res, bounds[:,3].max())
+    shape = (int(round((bounds[:,3].max() - bounds[:,1].min()) / res)),
+             int(round((bounds[:,2].max() - bounds[:,0].min()) / res)))
+    out = np.zeros(shape, dtype=dtype)
+    for path, (left, _, _, top) in zip(ort_list, bounds):
+        with rasterio.open(path) as src:
+            arr = src.read(1)
+        col, row = [int(round(v)) for v in ~aff * (left, top)]
+        h, w = min(arr.shape[0], shape[0] - row), min(arr.shape[1], shape[1] - col)
+        out[row:row + h, col:col + w] = arr[:h,:w]
+    write_raster(os.path.join(ortho_dir, out_name), out, aff)
+
+
+def cmd_tawny(args, opts):
+    mosaic(args[0], opts.get('Out', 'Orthophotomosaic.tif'), 'Tawny')
+
+
+def cmd_testlib(args, opts):
+    if args[0] == 'SeamlineFeathering':
+        mosaic('.', 'MosaicFeathering.tif', 'SeamlineFeathering')
+
+
+def main(argv):
+    if not argv:
+        print('mm3d stub: no command')
+        return 1
+    command = argv[0]
+    args, opts = parse_args(argv[1:])
+    print('mm3d stub: %s' % ' '.join(argv))
+    if command == 'XifGps2Txt':
+        cmd_xifgps2txt(args, opts)
+    elif command == 'XifGps2Xml':
+        cmd_xifgps2xml(args, opts)
+    elif command == 'OriConvert':
+        cmd_oriconvert(args, opts)
+    elif command == 'Tapioca':
+        cmd_tapioca(args, opts)
+    elif command == 'Schnaps':
+        cmd_schnaps(args, opts)
+    elif command == 'Tapas':
+        cmd_tapas(args, opts)
+    elif command == 'Martini':
+        cmd_martini(args, opts)
+    elif command == 'Campari':
+        cmd_copy_ori(command, args[0], args[2])
+    elif command in ['CenterBascule', 'ChgSysCo']:
+        cmd_copy_ori(command, args[0], args[3])
+    elif command == 'Tarama':
+        cmd_tarama(args, opts)
+    elif command == 'Malt':
+        cmd_malt(args, opts)
+    elif command == 'Tawny':
+        cmd_tawny(args, opts)
+    elif command == 'TestLib':
+        cmd_testlib(args, opts)
+    else:
+        print('mm3d stub: %s is not simulated' % command)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,325 @@
+"""Synthetic RedEdge flights
+
+Captures are sampled from a procedural ground scene along a lawnmower flight
+plan, so that overlapping images share content (tie points, mosaics) and band
+images of a capture are slightly misaligned like on the real camera rig
+"""
+import os
+import csv
+import math
+import uuid
+import datetime
+import subprocess
+
+import numpy as np
+import cv2
+from shapely.geometry import Point
+
+
+EXIFTOOL_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               'micasense.config')
+
+# (name, central wavelength, FWHM, relative reflectance of the scene)
+BANDS = [('Blue', 475, 20, 0.6),
+         ('Green', 560, 20, 0.8),
+         ('Red', 668, 10, 0.5),
+         ('NIR', 840, 40, 1.6),
+         ('Red edge', 717, 10, 1.1)]
+COLORS = ['blue', 'green', 'red', 'nir', 'edge']
+
+# RedEdge-M geometry at full resolution
+SENSOR_SIZE = (1280, 960)
+PIXEL_SIZE_MM = 0.00375
+FOCAL_LENGTH_MM = 5.4
+
+
+def flight_plan(n_captures, lon=16.3, lat=1.6, altitude=120, forward=20,
+                side=60, line_length=10):
+    """Camera positions of a lawnmower flight plan
+
+    Args:
+        n_captures (int): Number of captures
+        lon (float): Longitude of the first capture
+        lat (float): Latitude of the first capture
+        altitude (float): Flight altitude above ground (m)
+        forward (float): Distance between consecutive captures (m)
+        side (float): Distance between flight lines (m)
+        line_length (int): Number of captures per flight line
+
+    Return:
+        numpy.ndarray: Structured array with ``lon``, ``lat``, ``alt``, ``x``, ``y``
+        (local metric coordinates) and ``yaw`` (radians) fields
+    """
+    out = np.empty(n_captures, dtype=[('lon', 'f8'), ('lat', 'f8'), ('alt', 'f8'),
+                                      ('x', 'f8'), ('y', 'f8'), ('yaw', 'f8')])
+    m_per_deg_lon = 111320.0 * math.cos(math.radians(lat))
+    for i in range(n_captures):
+        line, pos = divmod(i, line_length)
+        # Every other line is flown backwards
+        if line % 2:
+            pos = line_length - 1 - pos
+        y = pos * forward
+        x = line * side
+        out[i] = (lon + x / m_per_deg_lon, lat + y / 111320.0, altitude, x, y,
+                  math.pi if line % 2 else 0)
+    return out
+
+
+def ground_scene(x, y, seed=0):
+    """Procedural ground reflectance (between 0 and 1) at metric coordinates x, y
+    """
+    rng = np.random.RandomState(seed)
+    out = np.zeros(np.broadcast(x, y).shape, dtype=np.float32)
+    for _ in range(12):
+        freq = rng.uniform(0.01, 0.6)
+        angle = rng.uniform(0, np.pi)
+        phase = rng.uniform(0, 2 * np.pi)
+        out += np.sin(freq * (x * np.cos(angle) + y * np.sin(angle)) + phase) / freq ** 0.5
+    out -= out.min()
+    return out / max(out.max(), 1e-6)
+
+
+def capture_arrays(position, scale=1.0, seed=0, max_offset=6):
+    """Simulate the five raw band images of a capture
+
+    Args:
+        position (numpy.void): Element of a ``flight_plan`` array
+        scale (float): Image size relative to the sensor size
+        seed (int): Seed of the ground scene
+        max_offset (int): Largest band to band misalignment, in full resolution pixels
+
+    Return:
+        list: List of five uint16 arrays
+    """
+    width, height = int(SENSOR_SIZE[0] * scale), int(SENSOR_SIZE[1] * scale)
+    gsd = position['alt'] * PIXEL_SIZE_MM / FOCAL_LENGTH_MM / scale
+    rng = np.random.RandomState(int(position['x'] * 1000 + position['y']) % (2 ** 31))
+    cols, rows = np.meshgrid(np.arange(width) - width / 2.0,
+                             np.arange(height) - height / 2.0)
+    out = []
+    for band, (_, _, _, reflectance) in enumerate(BANDS):
+        # Rig parallax: each band sees the scene with a small, fixed offset
+        dx, dy = (np.array([band % 3, band // 3]) - 1) * max_offset * scale
+        c = np.cos(position['yaw'])
+        s = np.sin(position['yaw'])
+        x = position['x'] + gsd * (c * (cols + dx) - s * (rows + dy))
+        y = position['y'] - gsd * (s * (cols + dx) + c * (rows + dy))
+        arr = ground_scene(x, y, seed) * reflectance * 20000 + 3000
+        arr += rng.normal(0, 200, arr.shape)
+        out.append(np.clip(arr, 0, 65535).astype(np.uint16))
+    return out
+
+
+def run_exiftool(tag_list, config=EXIFTOOL_CONFIG):
+    """Write tags to many files with a single exiftool process
+
+    Args:
+        tag_list (list): List of (path, dict) tuples; dict keys are exiftool tag
+            names (e.g. ``'XMP-Camera:BandName'``); list values are written as
+            comma separated lists
+        config (str): exiftool config file defining the MicaSense xmp namespaces
+    """
+    args = []
+    for path, tags in tag_list:
+        for k, v in tags.items():
+            if isinstance(v, (list, tuple)):
+                v = ','.join(str(x) for x in v)
+            args.append('-%s=%s' % (k, v))
+        args += ['-overwrite_original', path, '-execute']
+    argfile = os.path.join(os.path.dirname(tag_list[0][0]), '.exiftool_%s.args' % uuid.uuid4().hex[:8])
+    with open(argfile, 'w') as dst:
+        dst.write('\n'.join(args))
+    try:
+        subprocess.check_call(['exiftool', '-config', config, '-sep', ',', '-q', '-@', argfile],
+                              stdout=subprocess.DEVNULL)
+    finally:
+        os.remove(argfile)
+
+
+def gps_tags(position, time):
+    """Exif GPS and date tags of a capture
+    """
+    return {'GPSLatitude': abs(position['lat']),
+            'GPSLatitudeRef': 'N' if position['lat'] >= 0 else 'S',
+            'GPSLongitude': abs(position['lon']),
+            'GPSLongitudeRef': 'E' if position['lon'] >= 0 else 'W',
+            'GPSAltitude': position['alt'],
+            'GPSAltitudeRef': 'Above Sea Level',
+            'GPSDateStamp': time.strftime('%Y:%m:%d'),
+            'GPSTimeStamp': time.strftime('%H:%M:%S'),
+            'DateTimeOriginal': time.strftime('%Y:%m:%d %H:%M:%S'),
+            'SubSecTimeOriginal': '%03d' % (time.microsecond // 1000)}
+
+
+def band_tags(band, position, capture_id, flight_id, scale=1.0):
+    """Exif and MicaSense xmp tags of a raw band image
+    """
+    name, wavelength, fwhm, _ = BANDS[band]
+    width, height = int(SENSOR_SIZE[0] * scale), int(SENSOR_SIZE[1] * scale)
+    pixel_size = PIXEL_SIZE_MM / scale
+    yaw_deg = math.degrees(position['yaw'])
+    return {'Make': 'MicaSense',
+            'Model': 'RedEdge-M',
+            'Software': 'v5.1.7',
+            'ExposureTime': 0.001,
+            'ISOSpeed': 100,
+            'BlackLevel': 4800,
+            'FocalLength': FOCAL_LENGTH_MM,
+            'FocalPlaneXResolution': 1 / pixel_size,
+            'FocalPlaneYResolution': 1 / pixel_size,
+            'FocalPlaneResolutionUnit': 'mm',
+            'XMP-Camera:BandName': name,
+            'XMP-Camera:CentralWavelength': wavelength,
+            'XMP-Camera:WavelengthFWHM': fwhm,
+            'XMP-Camera:RigCameraIndex': band,
+            'XMP-Camera:ModelType': 'perspective',
+            'XMP-Camera:PrincipalPoint': '%f,%f' % (width * pixel_size / 2, height * pixel_size / 2),
+            'XMP-Camera:PerspectiveFocalLength': FOCAL_LENGTH_MM,
+            'XMP-Camera:PerspectiveDistortion': [0, 0, 0, 0, 0],
+            'XMP-Camera:VignettingCenter': [width / 2.0, height / 2.0],
+            'XMP-Camera:VignettingPolynomial': [0, 0, 0, 0, 0, 0],
+            'XMP-Camera:Yaw': yaw_deg,
+            'XMP-Camera:Pitch': 0,
+            'XMP-Camera:Roll': 0,
+            'XMP-Camera:Irradiance': 1.2,
+            'XMP-Camera:IrradianceYaw': yaw_deg,
+            'XMP-Camera:IrradiancePitch': 0,
+            'XMP-Camera:IrradianceRoll': 0,
+            'XMP-Camera:GPSXYAccuracy': 1.5,
+            'XMP-Camera:GPSZAccuracy': 2.5,
+            'XMP-MicaSense:CaptureId': capture_id,
+            'XMP-MicaSense:FlightId': flight_id,
+            'XMP-MicaSense:RadiometricCalibration': [2.5e-4, 6e-8, 1e-5],
+            'XMP-MicaSense:DarkRowValue': [4800, 4800, 4800, 4800],
+            'XMP-MicaSense:TriggerMethod': 0,
+            'XMP-DLS:SpectralIrradiance': 1.2,
+            'XMP-DLS:HorizontalIrradiance': 1.1,
+            'XMP-DLS:SolarElevation': 1.2,
+            'XMP-DLS:SolarAzimuth': 0.3,
+            'XMP-DLS:Yaw': position['yaw'],
+            'XMP-DLS:Pitch': 0,
+            'XMP-DLS:Roll': 0}
+
+
+def write_flight_csv(path, names, positions):
+    """Write image names and positions (read by the mm3d stub in place of exif)
+    """
+    with open(path, 'w', newline='') as dst:
+        writer = csv.writer(dst)
+        writer.writerow(['image', 'lon', 'lat', 'alt', 'yaw'])
+        for name, p in zip(names, positions):
+            writer.writerow([name, p['lon'], p['lat'], p['alt'], p['yaw']])
+
+
+def make_raw_flight(out_dir, n_captures, scale=1.0, seed=0, exif=True, **kwargs):
+    """Write a synthetic raw RedEdge flight (``IMG_XXXX_[1-5].tif``)
+
+    Args:
+        out_dir (str): Output directory
+        n_captures (int): Number of captures
+        scale (float): Image size relative to the sensor size (1280 x 960)
+        seed (int): Seed of the ground scene
+        exif (bool): Write exif/xmp metadata (requires exiftool)
+        **kwargs: Additional arguments passed to ``flight_plan``
+
+    Return:
+        list: List of capture image lists
+    """
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    positions = flight_plan(n_captures, **kwargs)
+    flight_id = uuid.uuid4().hex[:20]
+    t0 = datetime.datetime(2019, 5, 14, 10, 0, 0)
+    captures = []
+    tag_list = []
+    for i, position in enumerate(positions):
+        capture_id = uuid.uuid4().hex[:20]
+        time = t0 + datetime.timedelta(seconds=2 * i)
+        paths = []
+        for band, arr in enumerate(capture_arrays(position, scale=scale, seed=seed)):
+            path = os.path.join(out_dir, 'IMG_%04d_%d.tif' % (i, band + 1))
+            cv2.imwrite(path, arr)
+            tags = gps_tags(position, time)
+            tags.update(band_tags(band, position, capture_id, flight_id, scale))
+            tag_list.append((path, tags))
+            paths.append(path)
+        captures.append(paths)
+    write_flight_csv(os.path.join(out_dir, 'flight.csv'),
+                     ['IMG_%04d' % i for i in range(n_captures)], positions)
+    if exif:
+        run_exiftool(tag_list)
+    return captures
+
+
+def make_aligned_flight(out_dir, n_captures, scale=1.0, seed=0, exif=True,
+                        start_count=0, **kwargs):
+    """Write a synthetic flight as produced by ``align_images.py``
+
+    Every capture gives one geotagged uint16 GeoTiff per band plus the
+    panchromatic band (``pan_XXXXX.tif``, ``blue_XXXXX.tif``, ...). Image
+    names and positions are also written to ``flight.csv``
+
+    Args:
+        out_dir (str): Output directory
+        n_captures (int): Number of captures
+        scale (float): Image size relative to the sensor size (1280 x 960)
+        seed (int): Seed of the ground scene
+        exif (bool): Write exif GPS tags (requires exiftool)
+        start_count (int): Number of the first capture
+        **kwargs: Additional arguments passed to ``flight_plan``
+
+    Return:
+        list: List of (shapely.Point, str) tuples, like ``dir_to_points``
+    """
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    positions = flight_plan(n_captures, **kwargs)
+    t0 = datetime.datetime(2019, 5, 14, 10, 0, 0)
+    tag_list = []
+    names = []
+    for i, position in enumerate(positions):
+        count = i + start_count
+        arrays = capture_arrays(position, scale=scale, seed=seed, max_offset=0)
+        pan = (0.299 * arrays[2] + 0.587 * arrays[1] + 0.114 * arrays[0]) * 3
+        arrays.append(np.clip(pan, 0, 65535).astype(np.uint16))
+        tags = gps_tags(position, t0 + datetime.timedelta(seconds=2 * i))
+        for color, arr in zip(COLORS + ['pan'], arrays):
+            path = os.path.join(out_dir, '%s_%05d.tif' % (color, count))
+            cv2.imwrite(path, arr)
+            tag_list.append((path, tags))
+        names.append('pan_%05d.tif' % count)
+    write_flight_csv(os.path.join(out_dir, 'flight.csv'), names, positions)
+    if exif:
+        run_exiftool(tag_list)
+    return [(Point(p['lon'], p['lat']), name) for p, name in zip(positions, names)]
+
+
+def write_tarama_dir(ta_dir, xy, res=0.5, margin=50):
+    """Write the ``TA_LeChantier`` raster and xml files as produced by ``mm3d Tarama``
+
+    Args:
+        ta_dir (str): Output directory (e.g. ``'TA'``)
+        xy (numpy.ndarray): Projected camera centers, array of shape (n, 2)
+        res (float): Ground resolution of the grid (m)
+        margin (float): Distance (m) between the outermost centers and the grid edges
+    """
+    if not os.path.exists(ta_dir):
+        os.makedirs(ta_dir)
+    xmin, ymin = xy.min(axis=0) - margin
+    xmax, ymax = xy.max(axis=0) + margin
+    width = int(math.ceil((xmax - xmin) / res))
+    height = int(math.ceil((ymax - ymin) / res))
+    cv2.imwrite(os.path.join(ta_dir, 'TA_LeChantier.tif'),
+                np.full((height, width), 128, dtype=np.uint8))
+    with open(os.path.join(ta_dir, 'TA_LeChantier.xml'), 'w') as dst:
+        dst.write("""<?xml version="1.0" ?>
+<FileOriMnt>
+     <NameFileMnt>./TA_LeChantier.tif</NameFileMnt>
+     <NombrePixels>%d %d</NombrePixels>
+     <OriginePlani>%f %f</OriginePlani>
+     <ResolutionPlani>%f %f</ResolutionPlani>
+     <OrigineAlti>0</OrigineAlti>
+     <ResolutionAlti>1</ResolutionAlti>
+     <Geometrie>eGeomMNTEuclid</Geometrie>
+</FileOriMnt>
+""" % (width, height, xmin, ymax, res, -res))
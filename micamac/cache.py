@@ -0,0 +1,202 @@
+import os
+import glob
+import json
+import time
+import shutil
+import hashlib
+
+from micamac.ori_utils import link_file
+from micamac.resource_utils import disk_usage, format_bytes
+
+
+def file_digest(path, sample=1 << 20):
+    """Digest of a file, from its size and its first and last ``sample`` bytes
+
+    Cheap enough for thousands of multi megabyte images, while every image written
+    by align_images.py (distinct exif, distinct pixels) gets a distinct digest
+
+    Return:
+        str: Hexadecimal sha1 digest
+    """
+    h = hashlib.sha1()
+    size = os.path.getsize(path)
+    h.update(str(size).encode('ascii'))
+    with open(path, 'rb') as src:
+        h.update(src.read(sample))
+        if size > sample:
+            src.seek(max(sample, size - sample))
+            h.update(src.read(sample))
+    return h.hexdigest()
+
+
+def images_digest(img_list):
+    """Digest of a set of images (names and content, see ``file_digest``)
+    """
+    h = hashlib.sha1()
+    for path in sorted(img_list):
+        h.update(('%s %s\n' % (os.path.basename(path), file_digest(path))).encode('utf-8'))
+    return h.hexdigest()
+
+
+def step_key(step, params, parents=()):
+    """Cache key of the artifacts of a step
+
+    Args:
+        step (str): Step name
+        params (dict): Json serializable parameters and input digests the
+            artifacts depend on
+        parents (list): Keys of the upstream artifacts they were computed from
+
+    Return:
+        str: Hexadecimal sha1 digest
+    """
+    content = json.dumps({'step': step, 'params': params, 'parents': list(parents)},
+                         sort_keys=True)
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+class ArtifactCache(object):
+    """Content addressed cache of MicMac artifacts, shared by the projects of a site
+
+    Every entry is a directory ``<cache_dir>/<key>`` holding ``entry.json`` and a
+    ``files`` tree, which mirrors the project paths of the artifacts (e.g.
+    ``files/Homol``). Artifacts are stored and restored as hard links (copies
+    across file systems), so that parameter variants of a flight share them
+    without using more disk space. Least recently used entries are evicted when
+    the cache grows beyond ``max_size``
+
+    Args:
+        cache_dir (str): Cache directory, created if it doesn't exist
+        max_size (int): Optional size cap, in bytes
+    """
+    def __init__(self, cache_dir, max_size=None):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def _link_tree(self, src, dst, link):
+        if os.path.isdir(src):
+            for root, dirs, files in os.walk(src):
+                dst_root = os.path.join(dst, os.path.relpath(root, src))
+                if not os.path.exists(dst_root):
+                    os.makedirs(dst_root)
+                for name in files:
+                    link_file(os.path.join(root, name), os.path.join(dst_root, name), link=link)
+        else:
+            dirname = os.path.dirname(dst)
+            if dirname and not os.path.exists(dirname):
+                os.makedirs(dirname)
+            link_file(src, dst, link=link)
+
+    def entries(self):
+        """Return:
+            list: Metadata of the cache entries, see ``store``
+        """
+        out = []
+        for path in glob.glob(os.path.join(self.cache_dir, '*', 'entry.json')):
+            with open(path) as src:
+                out.append(json.load(src))
+        return out
+
+    def restore(self, key, project_dir='.'):
+        """Link the artifacts of an entry into a project directory
+
+        Existing files of the project at the same paths are replaced
+
+        Return:
+            dict: The entry metadata, ``None`` when the key is not cached
+        """
+        entry_dir = os.path.join(self.cache_dir, key)
+        meta_path = os.path.join(entry_dir, 'entry.json')
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path) as src:
+            meta = json.load(src)
+        for path in meta['paths']:
+            self._link_tree(os.path.join(entry_dir, 'files', path),
+                            os.path.join(project_dir, path), meta['link'])
+        meta['last_used'] = time.time()
+        # Replaced atomically, other projects may be reading the entry
+        tmp_path = '%s.tmp-%d' % (meta_path, os.getpid())
+        with open(tmp_path, 'w') as dst:
+            json.dump(meta, dst, indent=2)
+        os.replace(tmp_path, meta_path)
+        print('%s: %s restored from cache (%s)' % (meta['step'], ', '.join(meta['paths']), key[:12]))
+        return meta
+
+    def store(self, key, step, patterns, project_dir='.', link='hard', extra=None):
+        """Add the artifacts of a step to the cache
+
+        The entry is built in a temporary directory and renamed, so that concurrent
+        projects never see a partial entry
+
+        Args:
+            key (str): Entry key, see ``step_key``
+            step (str): Step name
+            patterns (list): Glob patterns of the artifacts, relative to ``project_dir``
+            project_dir (str): Project directory
+            link (str): ``'hard'`` to share the files with the project, or ``'copy'``
+                for artifacts that later steps modify in place
+            extra (dict): Json serializable data restored with the entry
+
+        Return:
+            dict: The entry metadata, ``None`` when an artifact is missing (failed step)
+        """
+        entry_dir = os.path.join(self.cache_dir, key)
+        if os.path.exists(entry_dir):
+            return None
+        paths = []
+        for pattern in patterns:
+            matches = sorted(glob.glob(os.path.join(project_dir, pattern)))
+            if not matches:
+                print('%s: %s not found, not cached' % (step, pattern))
+                return None
+            paths += [os.path.relpath(x, project_dir) for x in matches]
+        tmp_dir = '%s.tmp-%d' % (entry_dir, os.getpid())
+        for path in paths:
+            self._link_tree(os.path.join(project_dir, path), os.path.join(tmp_dir, 'files', path), link)
+        now = time.time()
+        meta = {'key': key, 'step': step, 'paths': paths, 'link': link,
+                'size': disk_usage(tmp_dir), 'created': now, 'last_used': now,
+                'extra': extra or {}}
+        with open(os.path.join(tmp_dir, 'entry.json'), 'w') as dst:
+            json.dump(meta, dst, indent=2)
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # Stored meanwhile by another project
+            shutil.rmtree(tmp_dir)
+            return None
+        print('%s: %s cached (%s, %s)' % (step, ', '.join(paths), key[:12], format_bytes(meta['size'])))
+        self.evict(keep=[key])
+        return meta
+
+    def evict(self, keep=()):
+        """Remove least recently used entries until the cache fits in ``max_size``
+
+        Files still linked from a project only free their space once the project
+        is deleted
+
+        Args:
+            keep (list): Keys that must not be evicted
+
+        Return:
+            int: Size of the removed entries, in bytes
+        """
+        if self.max_size is None:
+            return 0
+        entries = sorted(self.entries(), key=lambda x: x['last_used'])
+        total = sum(x['size'] for x in entries)
+        freed = 0
+        for meta in entries:
+            if total <= self.max_size:
+                break
+            if meta['key'] in keep:
+                continue
+            shutil.rmtree(os.path.join(self.cache_dir, meta['key']))
+            total -= meta['size']
+            freed += meta['size']
+            print('cache: evicted %s %s (%s)' % (meta['step'], meta['key'][:12],
+                                                 format_bytes(meta['size'])))
+        return freed
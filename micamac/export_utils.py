@@ -0,0 +1,151 @@
+import os
+import concurrent.futures
+import collections
+import functools
+
+import numpy as np
+import rasterio
+import rasterio.shutil
+from rasterio.crs import CRS
+from rasterio.enums import Resampling
+from rasterio.windows import Window
+
+
+OVERVIEW_LEVELS = [2, 4, 8, 16, 32, 64]
+
+
+def utm_crs(zone):
+    """Build the rasterio CRS of a WGS84 utm zone
+    """
+    return CRS.from_string('+proj=utm +zone=%d +ellps=WGS84 +datum=WGS84 +units=m +no_defs' % zone)
+
+
+def block_windows(width, height, blocksize=512):
+    """Split a raster grid in square windows
+
+    Return:
+        list: List of ``rasterio.windows.Window``
+    """
+    return [Window(col_off, row_off,
+                   min(blocksize, width - col_off),
+                   min(blocksize, height - row_off))
+            for row_off in range(0, height, blocksize)
+            for col_off in range(0, width, blocksize)]
+
+
+def bounded_map(executor, func, iterable, max_pending):
+    """Lazy, ordered equivalent of ``executor.map``
+
+    At most ``max_pending`` tasks are submitted at once, which bounds the memory
+    used by results waiting to be consumed
+
+    Yields:
+        Tuple of (item, result) in the order of ``iterable``
+    """
+    pending = collections.deque()
+    for item in iterable:
+        pending.append((item, executor.submit(func, item)))
+        if len(pending) >= max_pending:
+            item, future = pending.popleft()
+            yield item, future.result()
+    while pending:
+        item, future = pending.popleft()
+        yield item, future.result()
+
+
+def read_stack_window(window, src_paths):
+    """Read a window of several single band rasters sharing the same grid
+
+    Return:
+        numpy.ndarray: Array of shape (len(src_paths), height, width)
+    """
+    arr_list = []
+    for path in src_paths:
+        with rasterio.open(path) as src:
+            arr_list.append(src.read(1, window=window))
+    return np.stack(arr_list)
+
+
+def write_cog(dst_path, profile, block_func, ncores=4, blocksize=512,
+              compress='deflate', overview_levels=OVERVIEW_LEVELS,
+              descriptions=None, executor=None):
+    """Write a tiled, compressed Cloud Optimized GeoTiff block by block
+
+    Blocks are computed concurrently and written in order as they come, so that
+    memory use is bounded by a few blocks per worker whatever the raster size.
+    A temporary tiled GeoTiff is written first, overviews are added to it and it
+    is finally copied to a COG layout (overviews before full resolution data)
+
+    Args:
+        dst_path (str): Output file
+        profile (dict): Rasterio profile of the output (``width``, ``height``,
+            ``count``, ``dtype``, ``crs``, ``transform`` and optionally ``nodata``)
+        block_func (callable): Function taking a ``rasterio.windows.Window``
+            and returning the corresponding (count, height, width) array, or
+            ``None`` to leave the block empty. Must be picklable when a process
+            pool executor is used
+        ncores (int): Number of workers (threads unless ``executor`` is provided)
+        blocksize (int): Internal tile size, also used as processing block size
+        compress (str): GeoTiff compression
+        overview_levels (list): Decimation factors of the overviews
+        descriptions (list): Optional band descriptions
+        executor (concurrent.futures.Executor): Optional executor used instead
+            of a thread pool
+    """
+    tmp_path = '%s.tmp.tif' % os.path.splitext(dst_path)[0]
+    profile = dict(profile)
+    profile.update(driver='GTiff', tiled=True, blockxsize=blocksize,
+                   blockysize=blocksize, compress=compress, BIGTIFF='IF_SAFER')
+    windows = block_windows(profile['width'], profile['height'], blocksize)
+    own_executor = executor is None
+    if own_executor:
+        executor = concurrent.futures.ThreadPoolExecutor(ncores)
+    try:
+        with rasterio.open(tmp_path, 'w', **profile) as dst:
+            if descriptions is not None:
+                for i, desc in enumerate(descriptions, 1):
+                    dst.set_band_description(i, desc)
+            for window, arr in bounded_map(executor, block_func, windows,
+                                           max_pending=2 * ncores):
+                if arr is not None:
+                    dst.write(arr.astype(profile['dtype']), window=window)
+    finally:
+        if own_executor:
+            executor.shutdown()
+    max_size = max(profile['width'], profile['height'])
+    levels = [x for x in overview_levels if max_size // x >= blocksize]
+    with rasterio.open(tmp_path, 'r+') as dst:
+        if levels:
+            dst.build_overviews(levels, Resampling.average)
+    rasterio.shutil.copy(tmp_path, dst_path, driver='GTiff', tiled=True,
+                         blockxsize=blocksize, blockysize=blocksize,
+                         compress=compress, copy_src_overviews=True,
+                         BIGTIFF='IF_SAFER')
+    os.remove(tmp_path)
+
+
+def stack_to_cog(src_paths, dst_path, crs, ncores=4, descriptions=None, **kwargs):
+    """Stack single band rasters sharing the same grid into a multiband COG
+
+    Replaces ``gdal_translate -a_srs`` calls; the georeferencing of the inputs
+    (e.g. from ``.tfw`` world files) is preserved and ``crs`` is attached
+
+    Args:
+        src_paths (list): Input single band rasters
+        dst_path (str): Output file
+        crs (rasterio.crs.CRS): Coordinate reference system of the output; see ``utm_crs``
+        ncores (int): Number of threads used to read the blocks
+        descriptions (list): Optional band descriptions (e.g. band names)
+        **kwargs: Additional arguments passed to ``write_cog``
+    """
+    with rasterio.open(src_paths[0]) as src:
+        profile = {'width': src.width,
+                   'height': src.height,
+                   'count': len(src_paths),
+                   'dtype': src.dtypes[0],
+                   'nodata': src.nodata,
+                   'crs': crs,
+                   'transform': src.transform}
+    block_func = functools.partial(read_stack_window, src_paths=src_paths)
+    write_cog(dst_path, profile, block_func, ncores=ncores,
+              descriptions=descriptions, **kwargs)
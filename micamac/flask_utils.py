@@ -1,9 +1,35 @@
-from flask import request
+import threading
 
+from werkzeug.serving import make_server
 
-def shutdown_server():
-    func = request.environ.get('werkzeug.server.shutdown')
-    if func is None:
-        raise RuntimeError('Not running with the Werkzeug Server')
-    func()
 
+def serve_until(app, event, host='127.0.0.1', port=5000, timeout=None):
+    """Serve a flask app in a background thread until ``event`` is set
+
+    Replaces the ``werkzeug.server.shutdown`` request environ function, which is
+    no longer provided by recent Werkzeug versions. Request handlers set the
+    event (e.g. once the polygon of interest has been posted)
+
+    Args:
+        app (flask.Flask): The app
+        event (threading.Event): Event signaling that the server can stop
+        host (str): Interface to listen on
+        port (int): Port to listen on
+        timeout (float): Stop after that many seconds even if the event is not set
+
+    Return:
+        bool: ``True`` if the event was set, ``False`` on timeout
+    """
+    server = make_server(host, port, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    print('Serving on http://%s:%d' % (host, port))
+    try:
+        is_set = event.wait(timeout)
+    finally:
+        server.shutdown()
+        # Waits for request threads, so that the last response is sent
+        server.server_close()
+        thread.join()
+    return is_set
@@ -0,0 +1,237 @@
+import os
+import glob
+
+import numpy as np
+
+
+# Binary (.dat) tie points files are made of a header (dimension, number of
+# records) followed by packed records (number of points, weight, x1, y1, x2, y2)
+_DAT_HEADER_DTYPE = np.dtype([('dim', '<i4'), ('count', '<i4')])
+_DAT_RECORD_DTYPE = np.dtype([('nb', '<i4'), ('weight', '<f8'),
+                              ('x1', '<f8'), ('y1', '<f8'),
+                              ('x2', '<f8'), ('y2', '<f8')])
+
+
+def read_homol(path):
+    """Read a MicMac tie points file into a numpy array
+
+    Both binary (``.dat``) and text (``.txt``, as produced with ``ExpTxt=1``)
+    files are supported
+
+    Args:
+        path (str): Path to a tie points file, e.g. ``Homol/Pastispan_00001.tif/pan_00002.tif.dat``
+
+    Return:
+        numpy.ndarray: Array of shape (n, 4) with columns x1, y1, x2, y2 in
+        image coordinates
+    """
+    if path.endswith('.dat'):
+        with open(path, 'rb') as src:
+            header = np.fromfile(src, dtype=_DAT_HEADER_DTYPE, count=1)
+            if header.size == 0:
+                return np.empty((0, 4))
+            records = np.fromfile(src, dtype=_DAT_RECORD_DTYPE,
+                                  count=int(header['count'][0]))
+        return np.column_stack([records['x1'], records['y1'],
+                                records['x2'], records['y2']])
+    with open(path) as src:
+        first_line = src.readline()
+    ncols = len(first_line.split())
+    if ncols == 0:
+        return np.empty((0, 4))
+    arr = np.fromfile(path, sep=' ').reshape(-1, ncols)
+    return arr[:,:4]
+
+
+def write_homol(path, arr):
+    """Write an array of tie points to a MicMac tie points file
+
+    The format (binary or text) is determined by the file extension
+
+    Args:
+        path (str): Output path, ending with ``.dat`` or ``.txt``
+        arr (numpy.ndarray): Array of shape (n, 4) with columns x1, y1, x2, y2
+    """
+    arr = np.asarray(arr, dtype=np.float64).reshape(-1, 4)
+    if path.endswith('.dat'):
+        header = np.array([(2, arr.shape[0])], dtype=_DAT_HEADER_DTYPE)
+        records = np.empty(arr.shape[0], dtype=_DAT_RECORD_DTYPE)
+        records['nb'] = 2
+        records['weight'] = 1
+        for i, name in enumerate(['x1', 'y1', 'x2', 'y2']):
+            records[name] = arr[:,i]
+        with open(path, 'wb') as dst:
+            header.tofile(dst)
+            records.tofile(dst)
+    else:
+        np.savetxt(path, arr, fmt='%.6f')
+
+
+def homol_files(homol_dir='Homol'):
+    """List the tie points files of a Homol directory
+
+    Args:
+        homol_dir (str): Homol directory (e.g. ``'Homol'`` or ``'Homol_mini'``)
+
+    Return:
+        list: List of (image_1, image_2, path) tuples
+    """
+    file_list = glob.glob(os.path.join(homol_dir, 'Pastis*', '*'))
+    out = []
+    for path in sorted(file_list):
+        img_1 = os.path.basename(os.path.dirname(path))[len('Pastis'):]
+        img_2 = os.path.splitext(os.path.basename(path))[0]
+        out.append((img_1, img_2, path))
+    return out
+
+
+def rescale_homol(src_dir, dst_dir, factor):
+    """Scale tie points computed on downsampled images back to full resolution
+
+    Pixel centers are preserved, i.e. a coordinate ``c`` in the reduced image
+    becomes ``(c + 0.5) * factor - 0.5`` in the full resolution image
+
+    Args:
+        src_dir (str): Homol directory computed on the reduced images
+        dst_dir (str): Homol directory to write, usually ``'Homol'``
+        factor (int): Downsampling factor used to produce the reduced images
+
+    Return:
+        int: The total number of tie points written
+    """
+    total = 0
+    for img_1, img_2, path in homol_files(src_dir):
+        arr = read_homol(path)
+        arr = (arr + 0.5) * factor - 0.5
+        out_path = os.path.join(dst_dir, os.path.relpath(path, src_dir))
+        os.makedirs(os.path.dirname(out_path), exist_ok=True)
+        write_homol(out_path, arr)
+        total += arr.shape[0]
+    return total
+
+
+def homol_count(path):
+    """Count the tie points of a MicMac tie points file without loading them
+
+    Only the header is read for binary files
+    """
+    if path.endswith('.dat'):
+        header = np.fromfile(path, dtype=_DAT_HEADER_DTYPE, count=1)
+        return int(header['count'][0]) if header.size else 0
+    with open(path, 'rb') as src:
+        return sum(1 for line in src if line.strip())
+
+
+def load_homol(homol_dir='Homol'):
+    """Bulk read all tie points files of a Homol directory
+
+    Args:
+        homol_dir (str): Homol directory
+
+    Return:
+        dict: Dictionary of (image_1, image_2): array pairs; see ``read_homol``
+    """
+    return {(img_1, img_2): read_homol(path)
+            for img_1, img_2, path in homol_files(homol_dir)}
+
+
+def connectivity_graph(homol_dir='Homol', img_pattern='pan*tif'):
+    """Build the image connectivity graph of a Homol directory
+
+    MicMac stores each pair in both directions, the largest of the two counts
+    is retained. The graph is returned as an edge list, so that its size grows
+    with the number of pairs rather than with the square of the number of images
+
+    Args:
+        homol_dir (str): Homol directory
+        img_pattern (str): Glob pattern of the images of the current working
+            directory, included in the graph even when they have no tie point
+
+    Return:
+        tuple: A tuple (names, edges) where names is the sorted list of images
+        and edges a tuple of three arrays (i, j, count) with the indices
+        (``i < j``) and tie point counts of every pair
+    """
+    file_list = homol_files(homol_dir)
+    names = sorted(set(glob.glob(img_pattern) + [x[0] for x in file_list]
+                       + [x[1] for x in file_list]))
+    index = {name: i for i, name in enumerate(names)}
+    pairs = {}
+    for img_1, img_2, path in file_list:
+        i, j = sorted([index[img_1], index[img_2]])
+        pairs[(i, j)] = max(pairs.get((i, j), 0), homol_count(path))
+    i = np.array([k[0] for k in pairs], dtype=np.int64)
+    j = np.array([k[1] for k in pairs], dtype=np.int64)
+    counts = np.array(list(pairs.values()), dtype=np.int64)
+    return names, (i, j, counts)
+
+
+def connected_components(n, i, j):
+    """Label the connected components of a graph (union-find)
+
+    Args:
+        n (int): Number of nodes
+        i (numpy.ndarray): First node of every edge
+        j (numpy.ndarray): Second node of every edge
+
+    Return:
+        numpy.ndarray: Array of n component labels, 0 being the largest component
+    """
+    parent = list(range(n))
+
+    def find(x):
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    for a, b in zip(i.tolist(), j.tolist()):
+        root_a, root_b = find(a), find(b)
+        if root_a != root_b:
+            parent[max(root_a, root_b)] = min(root_a, root_b)
+    roots = np.array([find(x) for x in range(n)], dtype=np.int64)
+    _, labels = np.unique(roots, return_inverse=True)
+    labels = labels.reshape(-1)
+    # Relabel by decreasing size
+    sizes = np.bincount(labels)
+    order = np.argsort(-sizes, kind='stable')
+    relabel = np.empty_like(order)
+    relabel[order] = np.arange(len(order))
+    return relabel[labels]
+
+
+def homol_report(homol_dir='Homol', min_points=30, min_links=2, img_pattern='pan*tif'):
+    """Tie points connectivity quality assessment
+
+    Args:
+        homol_dir (str): Homol directory
+        min_points (int): Pairs with fewer tie points are considered as weak links
+        min_links (int): Images with fewer non-weak links are considered as weak
+        img_pattern (str): Glob pattern of the images of the current working
+            directory, see ``connectivity_graph``
+
+    Return:
+        dict: Dictionary with keys ``images`` (list of dict with per image name,
+        tie points count, number of links and component), ``components``
+        (list of component sizes, largest first), ``weak_links`` (list of
+        (image_1, image_2, count) tuples) and ``weak_images`` (list of images
+        that are weakly linked, without tie points or outside of the largest
+        component)
+    """
+    names, (i, j, counts) = connectivity_graph(homol_dir, img_pattern=img_pattern)
+    n = len(names)
+    links = counts >= min_points
+    labels = connected_components(n, i[links], j[links])
+    n_links = np.bincount(np.concatenate([i[links], j[links]]), minlength=n)
+    tie_points = (np.bincount(i, weights=counts, minlength=n)
+                  + np.bincount(j, weights=counts, minlength=n))
+    images = [{'name': name, 'tie_points': int(tie_points[k]),
+               'links': int(n_links[k]), 'component': int(labels[k])}
+              for k, name in enumerate(names)]
+    weak = np.flatnonzero((counts > 0) & ~links)
+    weak_links = [(names[i[k]], names[j[k]], int(counts[k])) for k in weak]
+    is_weak = (n_links < min_links) | (labels != 0)
+    return {'images': images,
+            'components': np.bincount(labels).tolist() if labels.size else [],
+            'weak_links': weak_links,
+            'weak_images': [names[k] for k in np.flatnonzero(is_weak)]}
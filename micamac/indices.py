@@ -0,0 +1,142 @@
+import os
+import re
+import ast
+import glob
+import functools
+
+import numpy as np
+import rasterio
+from rasterio import windows
+from rasterio.enums import Resampling
+
+from micamac.export_utils import write_cog
+
+
+COLORS = ['blue', 'green', 'red', 'nir', 'edge']
+
+INDICES = {'ndvi': '(nir - red) / (nir + red)',
+           'ndre': '(nir - edge) / (nir + edge)',
+           'gndvi': '(nir - green) / (nir + green)'}
+
+
+def compile_expression(expression):
+    """Compile a spectral index expression
+
+    Expressions are python/numpy expressions using the band names (blue, green,
+    red, nir, edge) and the ``np`` namespace as variables, e.g.
+    ``'(nir - red) / (nir + red)'`` or ``'np.where(nir > 0, nir / red, 0)'``
+
+    Return:
+        code: Compiled expression, to be evaluated by ``index_window``
+    """
+    tree = ast.parse(expression, mode='eval')
+    unknown = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and node.id not in COLORS + ['np']:
+            unknown.add(node.id)
+        elif isinstance(node, ast.Attribute) and node.attr.startswith('_'):
+            unknown.add(node.attr)
+    if unknown:
+        raise ValueError('Unknown names in index expression %s: %s'
+                         % (expression, ', '.join(sorted(unknown))))
+    return compile(tree, '<index>', 'eval')
+
+
+def find_malt_mask(mec_dir='MEC-Malt'):
+    """Find the Malt correlation mask of the finest level of a project
+
+    Return:
+        str: Path to ``Masq_STD-MALT_DeZoom<n>.tif`` with the smallest ``n``, or
+        ``None`` when there is no georeferenced mask (e.g. tiled projects)
+    """
+    mask_list = glob.glob(os.path.join(mec_dir, 'Masq_STD-MALT_DeZoom*.tif'))
+    if not mask_list:
+        return None
+    path = min(mask_list, key=lambda x: int(re.search(r'DeZoom(\d+)', x).group(1)))
+    with rasterio.open(path) as src:
+        if src.transform.is_identity:
+            print('%s has no world file, not used as mask' % path)
+            return None
+    return path
+
+
+def index_window(window, src_path, codes, scaling, band_names=COLORS,
+                 mask_paths=()):
+    """Compute spectral indices on a window of a multiband orthomosaic
+
+    Pixels with a zero value in any band (outside of the Tawny mosaic) or a zero
+    value in one of the masks are set to nan. Masks may have a different
+    resolution than the orthomosaic (e.g. the Malt mask of the DEM level) and
+    are resampled (nearest) to the window using their georeferencing
+
+    Args:
+        window (rasterio.windows.Window): The window to process
+        src_path (str): Multiband orthomosaic, see ``micamac.export_utils.stack_to_cog``
+        codes (list): List of compiled expressions, see ``compile_expression``
+        scaling (float): Scaling factor used in ``align_images.py``, applied
+            in reverse to recover reflectance (or radiance) values
+        band_names (list): Names of the bands of ``src_path``, in order
+        mask_paths (list): Mask rasters, 0 being nodata, see ``find_malt_mask``
+
+    Return:
+        numpy.ndarray: float32 array of shape (len(codes), height, width)
+    """
+    with rasterio.open(src_path) as src:
+        arr = src.read(window=window).astype(np.float32)
+        bounds = windows.bounds(window, src.transform)
+    nodata = (arr == 0).any(axis=0)
+    for mask_path in mask_paths:
+        with rasterio.open(mask_path) as src:
+            mask_window = windows.from_bounds(*bounds, transform=src.transform)
+            mask = src.read(1, window=mask_window, out_shape=nodata.shape,
+                            boundless=True, fill_value=0,
+                            resampling=Resampling.nearest)
+        nodata |= mask == 0
+    arr /= scaling
+    namespace = dict(zip(band_names, arr))
+    namespace['np'] = np
+    out = np.empty((len(codes),) + nodata.shape, dtype=np.float32)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for i, code in enumerate(codes):
+            out[i] = eval(code, {'__builtins__': {}}, namespace)
+    out[:,nodata] = np.nan
+    out[~np.isfinite(out)] = np.nan
+    return out
+
+
+def compute_indices(src_path, dst_path, indices=INDICES, scaling=60000,
+                    ncores=4, mask_paths=(), **kwargs):
+    """Compute a set of spectral indices from a multiband orthomosaic in a single pass
+
+    The orthomosaic is read window by window, all indices are computed on each
+    window and written to a multiband float32 COG (one band per index, nodata
+    set to nan) by a pool of threads
+
+    Args:
+        src_path (str): Multiband orthomosaic, see ``micamac.export_utils.stack_to_cog``
+        dst_path (str): Output file
+        indices (dict): Dictionary of index name: expression pairs. See
+            ``compile_expression`` and ``INDICES``
+        scaling (float): Scaling factor used in ``align_images.py``
+        ncores (int): Number of threads
+        mask_paths (list): Mask rasters, see ``index_window``
+        **kwargs: Additional arguments passed to ``micamac.export_utils.write_cog``
+    """
+    names = list(indices.keys())
+    codes = [compile_expression(indices[name]) for name in names]
+    with rasterio.open(src_path) as src:
+        band_names = list(src.descriptions)
+        if None in band_names:
+            band_names = COLORS[:src.count]
+        profile = {'width': src.width,
+                   'height': src.height,
+                   'count': len(names),
+                   'dtype': 'float32',
+                   'nodata': np.nan,
+                   'crs': src.crs,
+                   'transform': src.transform}
+    block_func = functools.partial(index_window, src_path=src_path, codes=codes,
+                                   scaling=scaling, band_names=band_names,
+                                   mask_paths=mask_paths)
+    write_cog(dst_path, profile, block_func, ncores=ncores, descriptions=names,
+              **kwargs)
@@ -1,11 +1,14 @@
 import os
+import csv
 import math
+import time
 
 from affine import Affine
-from shapely.geometry import Point
+from shapely.geometry import Point, mapping
 import rasterio
 from rasterio.crs import CRS
 import numpy as np
+import cv2
 import exiftool
 
 from micasense import imageutils
@@ -35,29 +38,120 @@ def affine_from_capture(c, res):
     return aff * Affine.rotation(yaw_deg)
 
 
+def band_residuals(stack, ref_index, factor=4):
+    """Residual misregistration of every band of an aligned capture
+
+    Bands are block averaged by ``factor`` and their gradient magnitudes (comparable
+    across wavelengths) are phase correlated with the one of the reference band
+
+    Args:
+        stack (numpy.ndarray): Aligned capture, of shape (height, width, bands)
+        ref_index (int): Index of the reference band
+        factor (int): Downsampling factor
+
+    Return:
+        list: Residual shift of every band, in full resolution pixels (0 for the
+        reference band)
+    """
+    height = stack.shape[0] // factor
+    width = stack.shape[1] // factor
+    window = cv2.createHanningWindow((width, height), cv2.CV_32F)
+    grads = []
+    for i in range(stack.shape[2]):
+        band = cv2.resize(stack[:, :, i].astype(np.float32), (width, height),
+                          interpolation=cv2.INTER_AREA)
+        grads.append(cv2.magnitude(cv2.Sobel(band, cv2.CV_32F, 1, 0),
+                                   cv2.Sobel(band, cv2.CV_32F, 0, 1)))
+    out = []
+    for i, grad in enumerate(grads):
+        if i == ref_index:
+            out.append(0.0)
+            continue
+        (dx, dy), _ = cv2.phaseCorrelate(grads[ref_index], grad, window)
+        out.append(float(math.hypot(dx, dy) * factor))
+    return out
+
+
 def capture_to_files(cap_tuple, scaling, out_dir, warp_matrices, warp_mode,
                      cropped_dimensions, match_index, img_type=None,
-                     irradiance_list=None, resolution=0.1):
+                     irradiance_list=None, resolution=0.1, max_residual=None,
+                     on_misaligned='flag'):
     """Wrapper to align images of capture and write them to separate GeoTiffs on disk
 
+    The registration of the aligned bands is checked on every capture (see
+    ``band_residuals``)
+
     Args:
         cap_tuple (tuple): Tuple of (capture, is_valid, count)
+        max_residual (float): Optional residual (pixels) above which a capture
+            is considered misaligned
+        on_misaligned (str): What to do with misaligned captures; flag (write
+            it anyway), realign (estimate warp matrices for that capture,
+            keeping the best of both alignments) or skip (do not write it)
+
+    Return:
+        dict: ``count``, ``valid``, number of ``bytes`` written, time spent in
+        seconds in the ``decode``, ``align``, ``reflectance``, ``check``, ``write``
+        and ``exif`` phases (see ``micamac.resource_utils.ProgressMeter``), band
+        ``residuals`` and ``status`` (ok, flagged, realigned or skipped)
     """
     cap, valid, count = cap_tuple
+    timing = {'count': count, 'valid': valid, 'bytes': 0, 'decode': 0.0,
+              'align': 0.0, 'reflectance': 0.0, 'check': 0.0, 'write': 0.0,
+              'exif': 0.0, 'residuals': None, 'status': None}
     if valid:
+        t0 = time.time()
+        # Images are lazily read by micasense, force decoding to time it separately
+        for img in cap.images:
+            img.raw()
+        t1 = time.time()
+        timing['decode'] = t1 - t0
         if img_type == 'reflectance':
             cap.compute_reflectance(irradiance_list=irradiance_list)
+        t2 = time.time()
+        timing['reflectance'] = t2 - t1
         aligned_stack = imageutils.aligned_capture(capture=cap,
                                                    warp_matrices=warp_matrices,
                                                    warp_mode=warp_mode,
                                                    cropped_dimensions=cropped_dimensions,
                                                    match_index=match_index,
                                                    img_type=img_type)
+        t3 = time.time()
+        timing['align'] = t3 - t2
+        residuals = band_residuals(aligned_stack, match_index)
+        status = 'ok'
+        if max_residual is not None and max(residuals) > max_residual:
+            status = 'flagged'
+            if on_misaligned == 'realign':
+                own_matrices, _ = imageutils.align_capture(cap, ref_index=match_index,
+                                                           warp_mode=warp_mode,
+                                                           max_iterations=100,
+                                                           multithreaded=False)
+                own_stack = imageutils.aligned_capture(capture=cap,
+                                                       warp_matrices=own_matrices,
+                                                       warp_mode=warp_mode,
+                                                       cropped_dimensions=cropped_dimensions,
+                                                       match_index=match_index,
+                                                       img_type=img_type)
+                own_residuals = band_residuals(own_stack, match_index)
+                if max(own_residuals) < max(residuals):
+                    aligned_stack, residuals = own_stack, own_residuals
+                    status = 'realigned' if max(residuals) <= max_residual else 'flagged'
+        timing['residuals'] = residuals
+        timing['check'] = time.time() - t3
+        if status == 'flagged' and on_misaligned == 'skip':
+            timing['status'] = 'skipped'
+            cap.clear_image_data()
+            return timing
+        timing['status'] = status
+        t3 = time.time()
         aligned_stack = aligned_stack * scaling
         aligned_stack[aligned_stack > 65535] = 65535
         aligned_stack = aligned_stack.astype('uint16')
         panchro_array = (0.299 * aligned_stack[:,:,2] + 0.587 * aligned_stack[:,:,1] + 0.114 * aligned_stack[:,:,0]) * 3
         panchro_array = panchro_array.astype('uint16')
+        timing['align'] += time.time() - t3
+        t3 = time.time()
         # Retrieve exif dict
         exif_params = exif_params_from_capture(cap)
         # Write to file
@@ -94,6 +188,8 @@ def capture_to_files(cap_tuple, scaling, out_dir, warp_matrices, warp_mode,
         # Write panchromatic
         with rasterio.open(pan_path, 'w', **profile) as dst:
             dst.write(panchro_array, 1)
+        t4 = time.time()
+        timing['write'] = t4 - t3
         with exiftool.ExifTool() as et:
             et.execute(*exif_params,
                        str.encode('-overwrite_original'),
@@ -113,8 +209,21 @@ def capture_to_files(cap_tuple, scaling, out_dir, warp_matrices, warp_mode,
             et.execute(*exif_params,
                        str.encode('-overwrite_original'),
                        str.encode(pan_path))
+        timing['exif'] = time.time() - t4
+        timing['bytes'] = sum(os.path.getsize(x) for x in [blue_path, green_path, red_path,
+                                                           nir_path, edge_path, pan_path])
 
     cap.clear_image_data()
+    return timing
+
+
+def capture_job_to_files(job):
+    """Run ``capture_to_files`` on a (cap_tuple, kwargs) tuple
+
+    Lets captures of flights with different processing arguments share a pool
+    """
+    cap_tuple, kwargs = job
+    return capture_to_files(cap_tuple, **kwargs)
 
 
 def capture_to_point(c, ndigits=6):
@@ -122,3 +231,44 @@ def capture_to_point(c, ndigits=6):
     """
     lat,lon,_ = [round(x, ndigits) for x in c.location()]
     return Point(lon, lat)
+
+
+def points_to_fc(point_list):
+    """Build a geojson like feature collection of capture centers
+
+    Args:
+        point_list (list): List of shapely Points, see ``capture_to_point``
+
+    Return:
+        dict: The feature collection, as used by the interactive AOI selection map
+    """
+    feature_list = [{'type': 'Feature',
+                     'properties': {},
+                     'geometry': mapping(x)}
+                    for x in point_list]
+    return {'type': 'FeatureCollection',
+            'features': feature_list}
+
+
+def write_capture_index(results, point_list, path, start_count=0,
+                        bands=('blue', 'green', 'red', 'nir', 'edge')):
+    """Write a csv index of the processed captures, with their registration residuals
+
+    Args:
+        results (list): Results of ``capture_to_files``
+        point_list (list): Capture centers (shapely Points), in capture order
+        path (str): Output csv file
+        start_count (int): Number of the first capture
+        bands (tuple): Band names, in capture order
+    """
+    with open(path, 'w') as dst:
+        writer = csv.writer(dst)
+        writer.writerow(['count', 'lon', 'lat', 'status', 'max_residual'] +
+                        ['residual_%s' % x for x in bands])
+        for result in sorted(results, key=lambda x: x['count']):
+            if not result['valid']:
+                continue
+            point = point_list[result['count'] - start_count]
+            residuals = result['residuals']
+            writer.writerow([result['count'], point.x, point.y, result['status'],
+                             '%.2f' % max(residuals)] + ['%.2f' % x for x in residuals])
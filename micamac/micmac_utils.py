@@ -5,23 +5,133 @@ import re
 import os
 import shutil
 import xml.etree.ElementTree as ET
+import functools
+import json
+import fnmatch
 
 from shapely.geometry import Point
 import exiftool
+import numpy as np
 import rasterio
 from rasterio.crs import CRS
-from rasterio.warp import transform_geom
+from rasterio.warp import transform
 from rasterio.features import rasterize
+from rasterio.enums import Resampling
+from rasterio import windows
+from rasterio.windows import Window
 from affine import Affine
-from shapely.geometry import mapping, shape, MultiPoint
+from shapely.geometry import MultiPoint, LineString, box
+from shapely.ops import unary_union
+from shapely.prepared import prep
+
+from micamac.ori_utils import link_file
+from micamac.export_utils import stack_to_cog, utm_crs
+from micamac.resource_utils import disk_usage, format_bytes
+from micamac.profile_utils import profiled
+
+
+COLORS = ['blue', 'green', 'red', 'nir', 'edge']
+
+# Intermediate artifacts of which every step of run_micmac.py is the last consumer.
+# ``products`` must exist for the step to count as successful, ``release`` lists
+# (glob pattern, action) tuples, action being 'delete' or 'compress' (directories
+# are then archived to <name>.tar.gz before removal). See ``release_artifacts``
+# Malt runs with ZoomF=4 (see run_malt_pan), coarser levels are only used by Malt itself
+GC_RULES = {'tapioca': {'products': ['Homol'],
+                        'release': [('Pyram-TP', 'delete'),
+                                    ('Pastis', 'delete')]},
+            'schnaps': {'products': ['Homol_mini'],
+                        'release': [('Homol', 'compress')]},
+            'tapas_full': {'products': ['Ori-Arbitrary'],
+                           'release': [('Ori-Arbitrary_pre', 'compress'),
+                                       ('Ori-Martini_miniArbitrary_pre', 'compress')]},
+            'tapas_reference': {'products': ['Ori-Ground_RTL'],
+                                'release': [('Homol_mini', 'compress'),
+                                            ('Ori-RAWGNSS_Ref', 'compress')]},
+            'centerbascule': {'products': ['Ori-Ground_Init_RTL'],
+                              'release': [('Ori-Arbitrary', 'compress')]},
+            'campari': {'products': ['Ori-Ground_RTL'],
+                        'release': [('Homol_mini', 'compress'),
+                                    ('Ori-Ground_Init_RTL', 'compress')]},
+            'chgsysco': {'products': ['Ori-Ground_UTM'],
+                         'release': [('Ori-Ground_RTL', 'compress')]},
+            'tiles': {'products': ['OUTPUT/tiles.json'],
+                      'release': [('Tiles/*/TA', 'delete'),
+                                  ('Tiles/*/MEC-Malt', 'delete'),
+                                  ('Tiles/*/Ortho-*', 'delete'),
+                                  ('Tiles/*/Tmp-MM-Dir', 'delete')]},
+            'malt_pan': {'products': ['MEC-Malt/Z_Num*_DeZoom4_STD-MALT.tif'],
+                         'release': [('Ortho-MEC-Malt', 'delete'),
+                                     ('MEC-Malt/*DeZoom64*.tif', 'delete'),
+                                     ('MEC-Malt/*DeZoom32*.tif', 'delete'),
+                                     ('MEC-Malt/*DeZoom16*.tif', 'delete'),
+                                     ('MEC-Malt/*DeZoom8*.tif', 'delete')]},
+            'malt_multi': {'products': ['Ortho-%s/Ort_*' % color for color in COLORS],
+                           'release': [('MEC-Malt/Correl_*', 'delete'),
+                                       ('TA', 'delete')]},
+            'tawny': {'products': ['Ortho-%s/Orthophotomosaic.tif' % color for color in COLORS],
+                      'release': [('Tmp-MM-Dir', 'delete')]},
+            'ortho_export': {'products': ['OUTPUT/ortho.tif'],
+                             'release': [('Ortho-*/Ort_*', 'delete'),
+                                         ('Ortho-*/PC_*', 'delete')]},
+            'dem_export': {'products': ['OUTPUT/dem.tif'],
+                           'release': [('Tmp-MM-Dir', 'delete')]}}
+
+
+def run_tawny(color, cwd=None):
+    """tawny wrapper to be called in a multiprocessing map
 
+    Args:
+        color (str): Band name
+        cwd (str): Optional project directory, defaults to the current working directory
 
-def run_tawny(color):
-    """tawny wrapper to be called in a multiprocessing map
+    Return:
+        int: The mm3d return code
+    """
+    return subprocess.call(['mm3d', 'Tawny',
+                            'Ortho-%s' % color,
+                            'DEq=1', 'DegRap=0', 'SzV=25'], cwd=cwd)
+
+
+def run_malt_pan(resolution, ncores, cwd=None):
+    """Run Malt on the panchromatic images (DEM and panchromatic orthoimages)
+
+    Args:
+        resolution (float): Ground resolution in meters
+        ncores (int): Number of processes used by Malt
+        cwd (str): Optional project directory, defaults to the current working directory
+
+    Return:
+        int: The mm3d return code
+    """
+    return subprocess.call(['mm3d', 'Malt', 'Ortho',
+                            'pan.*tif', 'Ground_UTM', 'DirTA=TA', 'NbProc=%d' % ncores,
+                            'DefCor=0.0005', 'ZoomF=4', 'ResolTerrain=%f' % resolution],
+                           cwd=cwd)
+
+
+def run_malt_ortho(color, resolution, ncores, cwd=None):
+    """Run Malt orthorectification of a band, using the DEM computed on the panchromatic images
+
+    Args:
+        color (str): Band name
+        resolution (float): Ground resolution in meters
+        ncores (int): Number of processes used by Malt
+        cwd (str): Optional project directory, defaults to the current working directory
+
+    Return:
+        int: The mm3d return code
     """
-    subprocess.call(['mm3d', 'Tawny',
-                     'Ortho-%s' % color,
-                     'DEq=1', 'DegRap=0', 'SzV=25'])
+    return subprocess.call(['mm3d', 'Malt', 'Ortho',
+                            '(pan|%s).*tif' % color,
+                            'Ground_UTM', 'DoMEC=0', 'DoOrtho=1',
+                            'ImOrtho="%s.*.tif"' % color,
+                            'DirOF=Ortho-%s' % color,
+                            'DirMEC=MEC-Malt',
+                            'ZoomF=4',
+                            'NbProc=%d' % ncores,
+                            'ImMNT="pan.*tif"',
+                            'ResolTerrain=%f' % resolution], cwd=cwd)
 
 
 def img_to_Point(img_path):
@@ -44,10 +154,141 @@ def dir_to_points():
     img_list = glob.glob('pan*tif')
     all_cpu = mp.cpu_count()
     pool = mp.Pool(all_cpu)
-    point_list = pool.map(img_to_Point, img_list)
+    point_list = pool.map(profiled(img_to_Point), img_list)
     return point_list
 
 
+def make_tiepoint_image(img_path, out_dir, factor=2, percentiles=(2, 98)):
+    """Write a reduced resolution, contrast stretched 8 bits copy of an image
+
+    The derivative keeps the name of the input image, so that tie points matched
+    on it can be mapped back to the full resolution image (see
+    ``micamac.homol_utils.rescale_homol``). The right and bottom margins that do
+    not fill a whole ``factor`` block are left out
+
+    Args:
+        img_path (str): Path to the full resolution (uint16) image
+        out_dir (str): Directory where the derivative is written
+        factor (int): Downsampling factor
+        percentiles (tuple): Lower and upper percentiles used for the linear stretch
+
+    Return:
+        str: Path of the written file
+    """
+    with rasterio.open(img_path) as src:
+        out_shape = (src.height // factor, src.width // factor)
+        # The last rows and columns are cropped when the size is not a multiple
+        # of the factor, so that the scale is exactly ``factor`` on both axes
+        window = Window(0, 0, out_shape[1] * factor, out_shape[0] * factor)
+        arr = src.read(1, window=window, out_shape=out_shape,
+                       resampling=Resampling.average)
+        profile = src.profile
+        aff = src.transform * Affine.scale(factor)
+    arr = arr.astype(np.float32)
+    sample = arr[::4,::4]
+    sample = sample[sample > 0]
+    if sample.size:
+        low, high = np.percentile(sample, percentiles)
+    else:
+        low, high = 0, 1
+    arr = (arr - low) * (255.0 / max(high - low, 1))
+    arr = np.clip(arr, 0, 255).astype(np.uint8)
+    profile.update(dtype=rasterio.uint8, height=out_shape[0],
+                   width=out_shape[1], transform=aff)
+    out_path = os.path.join(out_dir, os.path.basename(img_path))
+    with rasterio.open(out_path, 'w', **profile) as dst:
+        dst.write(arr, 1)
+    return out_path
+
+
+def build_tiepoint_pyramid(factor, ncores, out_dir='Pyram-TP', img_pattern='pan*tif'):
+    """Build reduced 8 bits derivatives of all panchromatic images of the current working directory
+
+    Images are processed in parallel; see ``make_tiepoint_image``
+
+    Args:
+        factor (int): Downsampling factor
+        ncores (int): Number of processes used
+        out_dir (str): Output directory, created if it doesn't exist
+        img_pattern (str): Glob pattern of the images
+
+    Return:
+        list: List of written files
+    """
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    img_list = sorted(glob.glob(img_pattern))
+    pool = mp.Pool(ncores)
+    out_list = pool.map(profiled(functools.partial(make_tiepoint_image, out_dir=out_dir,
+                                                   factor=factor)),
+                        img_list)
+    pool.close()
+    pool.join()
+    return out_list
+
+
+def points_to_utm(point_list, utm_zone):
+    """Project the coordinates of a point list to utm in a single vectorized transform
+
+    Args:
+        point_list (list): List of (shapely.Point, str) tuples. See ``dir_to_points``
+        utm_zone (int): Utm zone of the project
+
+    Return:
+        numpy.ndarray: Array of shape (n, 2) of projected x and y coordinates
+    """
+    src_crs = CRS.from_epsg(4326)
+    dst_crs = CRS(proj='utm', zone=utm_zone, ellps='WGS84', units='m')
+    lon = [x[0].x for x in point_list]
+    lat = [x[0].y for x in point_list]
+    xs, ys = transform(src_crs, dst_crs, lon, lat)
+    return np.column_stack([xs, ys])
+
+
+def select_dense_cluster(xy, size, chunk_size=1024):
+    """Select the most compact cluster of ``size`` images
+
+    For every image, the distance to its ``size - 1`` th nearest neighbour is
+    computed (in chunks of rows of the distance matrix to bound memory); the
+    image minimizing that distance is the center of the densest cluster.
+
+    Args:
+        xy (numpy.ndarray): Array of shape (n, 2) of projected capture centers
+        size (int): Target number of images in the cluster
+        chunk_size (int): Number of rows of the distance matrix computed at once
+
+    Return:
+        tuple: A tuple (indices, score) where indices is an array of the selected
+        images indices and score a dictionary with the cluster ``center`` index,
+        ``radius`` (m), ``density`` (images per hectare) and ``overlap`` (mean
+        fraction of the other cluster members lying within one radius of each member)
+    """
+    n = xy.shape[0]
+    size = min(size, n)
+    radii = np.empty(n)
+    for start in range(0, n, chunk_size):
+        block = xy[start:start + chunk_size]
+        dist = np.hypot(block[:,None,0] - xy[None,:,0],
+                        block[:,None,1] - xy[None,:,1])
+        radii[start:start + chunk_size] = np.partition(dist, size - 1, axis=1)[:,size - 1]
+    center = int(np.argmin(radii))
+    radius = radii[center]
+    dist_center = np.hypot(xy[:,0] - xy[center,0], xy[:,1] - xy[center,1])
+    indices = np.argsort(dist_center, kind='stable')[:size]
+    members = xy[indices]
+    dist_members = np.hypot(members[:,None,0] - members[None,:,0],
+                            members[:,None,1] - members[None,:,1])
+    if size > 1:
+        overlap = ((dist_members <= radius).sum(axis=1) - 1).mean() / (size - 1)
+    else:
+        overlap = 1.0
+    score = {'center': center,
+             'radius': float(radius),
+             'density': float(size / max(np.pi * radius ** 2, 1) * 10000),
+             'overlap': float(overlap)}
+    return indices, score
+
+
 def update_poubelle():
     """Mirror content of Poubelle for all bands
 
@@ -57,27 +298,54 @@ def update_poubelle():
     bad_files = glob.glob('Poubelle/pan*tif')
     bad_files = [os.path.basename(x) for x in bad_files]
     file_pattern = re.compile(r'pan_(\d{5}\.tif)$')
-    [shutil.move(file_pattern.sub(r'blue_\1', x), 'Poubelle/') for x in bad_files]
-    [shutil.move(file_pattern.sub(r'green_\1', x), 'Poubelle/') for x in bad_files]
-    [shutil.move(file_pattern.sub(r'red_\1', x), 'Poubelle/') for x in bad_files]
-    [shutil.move(file_pattern.sub(r'nir_\1', x), 'Poubelle/') for x in bad_files]
-    [shutil.move(file_pattern.sub(r'edge_\1', x), 'Poubelle/') for x in bad_files]
+    for color in COLORS:
+        for x in bad_files:
+            color_file = file_pattern.sub(r'%s_\1' % color, x)
+            if os.path.exists(color_file):
+                shutil.move(color_file, 'Poubelle/')
 
 
-def update_ori(path='Ori-Ground_UTM'):
-    """Create ori files for all bands by renaming existing panchromatic ori files
+def prune_images(img_list):
+    """Move panchromatic images to Poubelle
+
+    Mirrors what Schnaps does with ``MoveBadImgs=1``; run ``update_poubelle``
+    afterwards to apply the same to all bands
+
+    Args:
+        img_list (list): List of panchromatic image names of the current working directory
+    """
+    if not os.path.exists('Poubelle'):
+        os.makedirs('Poubelle')
+    for img in img_list:
+        if os.path.exists(img):
+            shutil.move(img, 'Poubelle/')
+
+
+def update_ori(path='Ori-Ground_UTM', link='hard'):
+    """Create ori files for all bands from the existing panchromatic ori files
+
+    Band orientation files are hard links (or symbolic links, or copies) of the
+    panchromatic ones, so that the fan-out costs neither disk space nor time. A
+    ``band_links.json`` manifest of the created files is written to the
+    orientation directory.
 
     Args:
         path (str): Orientation directory
+        link (str): One of ``'hard'``, ``'sym'`` or ``'copy'``; see
+            ``micamac.ori_utils.link_file``
     """
     glob_pattern = os.path.join(path, 'Orientation-pan*xml')
     ori_pan_list = glob.glob(glob_pattern)
     ori_file_pattern = re.compile(r'(Orientation-)pan(_\d{5}\.tif\.xml)')
-    [shutil.copyfile(x, ori_file_pattern.sub(r'\1blue\2', x)) for x in ori_pan_list]
-    [shutil.copyfile(x, ori_file_pattern.sub(r'\1green\2', x)) for x in ori_pan_list]
-    [shutil.copyfile(x, ori_file_pattern.sub(r'\1red\2', x)) for x in ori_pan_list]
-    [shutil.copyfile(x, ori_file_pattern.sub(r'\1nir\2', x)) for x in ori_pan_list]
-    [shutil.copyfile(x, ori_file_pattern.sub(r'\1edge\2', x)) for x in ori_pan_list]
+    manifest = {}
+    for color in COLORS:
+        for x in ori_pan_list:
+            dst = ori_file_pattern.sub(r'\1%s\2' % color, x)
+            method = link_file(x, dst, link=link)
+            manifest[os.path.basename(dst)] = {'source': os.path.basename(x),
+                                               'method': method}
+    with open(os.path.join(path, 'band_links.json'), 'w') as dst:
+        json.dump(manifest, dst, indent=2)
 
 
 def clean_intermediary(exclude=['OUTPUT/']):
@@ -97,6 +365,56 @@ def clean_images():
     [os.remove(x) for x in tif_list]
 
 
+def _is_retained(pattern, path, retain):
+    for x in retain:
+        if (fnmatch.fnmatch(path, x) or fnmatch.fnmatch(os.path.basename(path), x)
+                or fnmatch.fnmatch(pattern, x)):
+            return True
+    return False
+
+
+def release_artifacts(step, retain=(), rules=GC_RULES):
+    """Delete or compress the intermediate artifacts a step is the last consumer of
+
+    Must be called from the project directory once the step has ended. Nothing is
+    released when one of the products of the step is missing (failed step)
+
+    Args:
+        step (str): Step name, key of ``rules``
+        retain (list): Glob patterns (matched against the artifact path, its name
+            or its rule pattern) of artifacts to keep, e.g. for debugging
+        rules (dict): Artifacts declared per step, see ``GC_RULES``
+
+    Return:
+        int: Number of bytes freed
+    """
+    rule = rules.get(step)
+    if rule is None:
+        return 0
+    missing = [x for x in rule['products'] if not glob.glob(x)]
+    if missing:
+        print('%s: %s not found, keeping intermediate files' % (step, ', '.join(missing)))
+        return 0
+    freed = 0
+    for pattern, action in rule['release']:
+        for path in sorted(glob.glob(pattern)):
+            if _is_retained(pattern, path, retain):
+                continue
+            if os.path.isdir(path) and not os.path.islink(path):
+                size = disk_usage(path)
+                if action == 'compress':
+                    archive = shutil.make_archive(path, 'gztar', root_dir=os.path.dirname(path) or '.',
+                                                  base_dir=os.path.basename(path))
+                    size -= os.path.getsize(archive)
+                shutil.rmtree(path)
+            else:
+                size = os.lstat(path).st_blocks * 512
+                os.remove(path)
+            freed += size
+            print('%s: released %s (%s, %s)' % (step, path, action, format_bytes(size)))
+    return freed
+
+
 def create_proj_file(zone):
     proj_xml = """
     <SystemeCoord>
@@ -115,26 +433,66 @@ def create_proj_file(zone):
         dst.write(proj_xml)
 
 
-def make_tarama_mask(point_list, utm_zone, buff=0, TA_dir='TA'):
+def capture_footprint(xy, footprint='convex', buff=0, concave_radius=50,
+                      gap_factor=5):
+    """Build the area covered by a set of capture centers
+
+    Args:
+        xy (numpy.ndarray): Array of shape (n, 2) of projected capture centers,
+            in capture order
+        footprint (str): One of ``'convex'`` (convex hull), ``'concave'``
+            (morphological closing of the points with ``concave_radius``) or
+            ``'lines'`` (flight lines, split where two consecutive captures are
+            more than ``gap_factor`` times the median capture interval apart).
+        buff (float): Buffer applied to the footprint. Must be positive with
+            ``'lines'``
+        concave_radius (float): Closing radius (m) for the ``'concave'`` footprint
+        gap_factor (float): Flight lines split threshold for the ``'lines'`` footprint
+
+    Return:
+        shapely.geometry.Polygon: The footprint
+    """
+    points = MultiPoint([tuple(x) for x in xy])
+    if footprint == 'convex':
+        return points.convex_hull.buffer(buff)
+    if footprint == 'concave':
+        return points.buffer(concave_radius).buffer(-concave_radius).buffer(buff)
+    if footprint == 'lines':
+        if buff <= 0:
+            raise ValueError('buff must be positive for a flight lines footprint')
+        steps = np.hypot(*np.diff(xy, axis=0).T)
+        breaks = np.flatnonzero(steps > gap_factor * np.median(steps)) + 1
+        segments = [seg for seg in np.split(xy, breaks) if seg.shape[0] > 0]
+        lines = [LineString(seg) if seg.shape[0] > 1 else Point(seg[0])
+                 for seg in segments]
+        return unary_union([x.buffer(buff) for x in lines])
+    raise ValueError('footprint must be one of convex, concave or lines')
+
+
+def make_tarama_mask(point_list, utm_zone, buff=0, TA_dir='TA', footprint='convex',
+                     block_rows=256, **kwargs):
     """Generate a mask using the gps coordinates of the captures
 
     This command follows the execution of tarama, after which a mask is normally
-    created interactively by the user
+    created interactively by the user. The mask is rasterized and written by
+    blocks of rows so that the full grid never needs to be held in memory
 
     Args:
         point_list (list): List of (shapely.Point, str) tuples. See ``dir_to_points``
         utm_zone (int): Utm zone of the project
         buffer (float): optional buffer to extend or reduce masked area around
-           the convex hull of the point list
+           the footprint of the point list
         TA_dir (str): tarama dir relative to current directory. Defaults to ``'TA'``
+        footprint (str): Footprint type, see ``capture_footprint``
+        block_rows (int): Number of rows rasterized and written at once
+        **kwargs: Additional arguments passed to ``capture_footprint``
     """
-    # Build study area polygon
-    src_crs = CRS.from_epsg(4326)
+    # Build study area polygon; captures are sorted by name (i.e. in capture order)
     dst_crs = CRS(proj='utm', zone=utm_zone, ellps='WGS84', units='m')
-    feature_list = [mapping(x[0]) for x in point_list]
-    feature_list_proj = [transform_geom(src_crs, dst_crs, x) for x in feature_list]
-    point_list_proj = [shape(x) for x in feature_list_proj]
-    study_area = MultiPoint(point_list_proj).convex_hull.buffer(buff)
+    point_list = sorted(point_list, key=lambda x: x[1])
+    xy = points_to_utm(point_list, utm_zone)
+    study_area = capture_footprint(xy, footprint=footprint, buff=buff, **kwargs)
+    study_area_prep = prep(study_area)
 
     # Retrieve Affine transform and shape from TA dir
     root = ET.parse(os.path.join(TA_dir, 'TA_LeChantier.xml')).getroot()
@@ -143,11 +501,7 @@ def make_tarama_mask(point_list, utm_zone, buff=0, TA_dir='TA'):
     arr_shape = tuple(reversed([int(x) for x in root.find('NombrePixels').text.split(' ')]))
     aff = Affine(x_res, 0, x_ori, 0, y_res, y_ori)
 
-    # Rasterize study area to template raster
-    arr = rasterize(shapes=[(study_area, 255)], out_shape=arr_shape, fill=0,
-                    transform=aff, default_value=255, dtype=rasterio.uint8)
-
-    # Write mask to raster
+    # Rasterize study area to template raster, block by block
     meta = {'driver': 'GTiff',
             'dtype': 'uint8',
             'width': arr_shape[1],
@@ -157,7 +511,19 @@ def make_tarama_mask(point_list, utm_zone, buff=0, TA_dir='TA'):
             'transform': aff}
     filename = os.path.join(TA_dir, 'TA_LeChantier_Masq.tif')
     with rasterio.open(filename, 'w', **meta) as dst:
-        dst.write(arr, 1)
+        for row_off in range(0, arr_shape[0], block_rows):
+            window = Window(0, row_off, arr_shape[1], min(block_rows, arr_shape[0] - row_off))
+            win_aff = windows.transform(window, aff)
+            win_shape = (int(window.height), int(window.width))
+            win_box = box(*windows.bounds(window, aff))
+            if study_area_prep.contains(win_box):
+                arr = np.full(win_shape, 255, dtype=np.uint8)
+            elif not study_area_prep.intersects(win_box):
+                arr = np.zeros(win_shape, dtype=np.uint8)
+            else:
+                arr = rasterize(shapes=[(study_area, 255)], out_shape=win_shape, fill=0,
+                                transform=win_aff, default_value=255, dtype=rasterio.uint8)
+            dst.write(arr, 1, window=window)
 
     # Create associated xml file
     xml_content = """<?xml version="1.0" ?>
@@ -176,16 +542,168 @@ def make_tarama_mask(point_list, utm_zone, buff=0, TA_dir='TA'):
         dst.write(xml_content)
 
 
-def get_and_georeference_dem(utm_zone):
-    """Retrieve DEM from MEC-Malt directory and move it to the OUTPUT dir, while adding a CRS
+def seam_labels(ortho_dir, transform, shape, pc_max=254):
+    """Image labels of a Tawny mosaic grid
+
+    Every pixel is assigned the orthoimage of ``ortho_dir`` with the lowest
+    ``PC_*`` (hidden parts) value, the same criterion as the Tawny seamlines
+
+    Args:
+        ortho_dir (str): Malt ortho directory (e.g. ``Ortho-red``)
+        transform (affine.Affine): Transform of the (possibly decimated) mosaic grid
+        shape (tuple): (height, width) of the mosaic grid
+        pc_max (int): Largest ``PC_*`` value of visible pixels
+
+    Return:
+        numpy.ndarray: Array of image indices, -1 where no image is visible
+    """
+    labels = np.full(shape, -1, dtype=np.int32)
+    best = np.full(shape, pc_max + 1, dtype=np.int32)
+    pc_list = sorted(glob.glob(os.path.join(ortho_dir, 'PC_*.tif')))
+    for i, pc_path in enumerate(pc_list):
+        with rasterio.open(pc_path) as src:
+            win = windows.from_bounds(*src.bounds, transform=transform)
+            row_off, col_off = int(round(win.row_off)), int(round(win.col_off))
+            height, width = int(round(win.height)), int(round(win.width))
+            if height < 1 or width < 1:
+                continue
+            pc = src.read(1, out_shape=(height, width),
+                          resampling=Resampling.nearest).astype(np.int32)
+        r0, c0 = max(row_off, 0), max(col_off, 0)
+        r1, c1 = min(row_off + height, shape[0]), min(col_off + width, shape[1])
+        if r1 <= r0 or c1 <= c0:
+            continue
+        pc = pc[r0 - row_off:r1 - row_off, c0 - col_off:c1 - col_off]
+        better = pc < best[r0:r1,c0:c1]
+        best[r0:r1,c0:c1][better] = pc[better]
+        labels[r0:r1,c0:c1][better] = i
+    return labels
+
+
+def mosaic_seam_score(path, ortho_dir, max_size=1024, pc_max=254):
+    """Seam discontinuity metric of a Tawny mosaic
+
+    The mosaic is read at reduced resolution and labelled with the orthoimage
+    each pixel comes from (see ``seam_labels``). The mean absolute step between
+    neighbouring pixels on either side of a seamline is divided by the mean
+    absolute step between neighbouring pixels of the same image, so that the
+    score does not depend on the scene texture nor on the overall contrast of
+    the equalized mosaic. Values close to 1 indicate invisible seams
+
+    Args:
+        path (str): Single band mosaic written by Tawny
+        ortho_dir (str): Malt ortho directory the mosaic was computed from
+        max_size (int): Size of the largest dimension of the decimated mosaic
+        pc_max (int): See ``seam_labels``
+
+    Return:
+        float: The score, ``nan`` when the mosaic has no seamline
+    """
+    with rasterio.open(path) as src:
+        factor = max(1, max(src.width, src.height) / max_size)
+        shape = (max(1, int(src.height / factor)), max(1, int(src.width / factor)))
+        band = src.read(1, out_shape=shape, resampling=Resampling.nearest)
+        transform = src.transform * Affine.scale(src.width / shape[1],
+                                                 src.height / shape[0])
+    band = band.astype(np.float32)
+    labels = seam_labels(ortho_dir, transform, shape, pc_max=pc_max)
+    labels[band <= 0] = -1
+    seam_steps = []
+    inner_steps = []
+    for a, b, la, lb in [(band[:,1:], band[:,:-1], labels[:,1:], labels[:,:-1]),
+                         (band[1:], band[:-1], labels[1:], labels[:-1])]:
+        valid = (la >= 0) & (lb >= 0)
+        steps = np.abs(a - b)
+        seam_steps.append(steps[valid & (la != lb)])
+        inner_steps.append(steps[valid & (la == lb)])
+    seam_steps = np.concatenate(seam_steps)
+    inner_steps = np.concatenate(inner_steps)
+    if not seam_steps.size or not inner_steps.size or inner_steps.mean() == 0:
+        return float('nan')
+    return float(seam_steps.mean() / inner_steps.mean())
+
+
+def malt_dem_params(dem_filename):
+    """Altitude conversion and mask of a Malt depth map
+
+    Args:
+        dem_filename (str): Path to a ``Z_Num*_DeZoom*_STD-MALT.tif`` file
+
+    Return:
+        tuple: (origin, resolution, mask_filename); ``OrigineAlti`` and
+        ``ResolutionAlti`` of the associated xml file (0 and 1 when it is
+        missing) and the corresponding Malt mask (``None`` when it is missing)
     """
-    dem_filename = sorted(glob.glob('MEC-Malt/Z_Num*_DeZoom*tif'))[-1]
-    # gdal_translate -a_srs "+proj=utm +zone=33 +ellps=WGS84 +datum=WGS84 +units=m +no_defs" MEC-Malt/Z_Num7_DeZoom4_STD-MALT.tif OUTPUT/dem_aac_1.tif
-    subprocess.call(['gdal_translate', '-a_srs',
-                     '+proj=utm +zone=%d +ellps=WGS84 +datum=WGS84 +units=m +no_defs' % utm_zone,
-                     dem_filename, 'OUTPUT/dem.tif'])
+    origin, resolution = 0.0, 1.0
+    xml_filename = '%s.xml' % os.path.splitext(dem_filename)[0]
+    if os.path.exists(xml_filename):
+        root = ET.parse(xml_filename).getroot()
+        origin = float(root.findtext('OrigineAlti'))
+        resolution = float(root.findtext('ResolutionAlti'))
+    mask_filename = None
+    zoom = re.search(r'DeZoom(\d+)', os.path.basename(dem_filename))
+    if zoom is not None:
+        mask_filename = os.path.join(os.path.dirname(dem_filename),
+                                     'Masq_STD-MALT_DeZoom%s.tif' % zoom.group(1))
+        if not os.path.exists(mask_filename):
+            mask_filename = None
+    return origin, resolution, mask_filename
+
+
+def final_malt_dem(mec_dir='MEC-Malt'):
+    """Depth map of the last Malt correlation step
+
+    Steps are numbered in ``Z_Num<step>_DeZoom<zoom>_STD-MALT.tif`` file names;
+    the highest step number (compared as an integer) is the final one
 
+    Args:
+        mec_dir (str): Malt ``DirMEC`` directory
 
+    Return:
+        str: Path to the depth map
+
+    Raises:
+        ValueError: If the directory contains no Malt depth map
+    """
+    candidates = []
+    for path in glob.glob(os.path.join(mec_dir, 'Z_Num*_DeZoom*_STD-MALT.tif')):
+        match = re.match(r'^Z_Num(\d+)_DeZoom(\d+)_STD-MALT\.tif$', os.path.basename(path))
+        if match is not None:
+            candidates.append(((int(match.group(1)), -int(match.group(2))), path))
+    if not candidates:
+        raise ValueError('No Z_Num*_DeZoom*_STD-MALT.tif depth map in %s' % mec_dir)
+    return max(candidates)[1]
 
 
+def read_malt_dem(dem_filename):
+    """Read a Malt depth map as altitudes
 
+    Values are converted using the ``OrigineAlti`` and ``ResolutionAlti`` of the
+    associated xml file, and pixels outside of the corresponding Malt mask
+    (``Masq_STD-MALT_DeZoom*.tif``) are set to nan (see ``malt_dem_params``)
+
+    Args:
+        dem_filename (str): Path to a ``Z_Num*_DeZoom*_STD-MALT.tif`` file
+
+    Return:
+        tuple: Tuple (array, transform) of the float32 altitudes and their affine transform
+    """
+    with rasterio.open(dem_filename) as src:
+        arr = src.read(1).astype(np.float32)
+        aff = src.transform
+    origin, resolution, mask_filename = malt_dem_params(dem_filename)
+    arr = origin + resolution * arr
+    if mask_filename is not None:
+        with rasterio.open(mask_filename) as src:
+            mask = src.read(1)
+        if mask.shape == arr.shape:
+            arr[mask == 0] = np.nan
+    return arr, aff
+
+
+def get_and_georeference_dem(utm_zone, ncores=4):
+    """Retrieve DEM from MEC-Malt directory and write it to the OUTPUT dir as a COG, while adding a CRS
+    """
+    dem_filename = final_malt_dem()
+    stack_to_cog([dem_filename], 'OUTPUT/dem.tif', crs=utm_crs(utm_zone),
+                 ncores=ncores, descriptions=['dem'])
@@ -0,0 +1,341 @@
+import os
+import re
+import glob
+import shutil
+import tempfile
+import warnings
+import functools
+import contextlib
+import concurrent.futures
+import xml.etree.ElementTree as ET
+
+import numpy as np
+import cv2
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.errors import NotGeoreferencedWarning
+from rasterio.transform import array_bounds
+from rasterio.windows import Window
+from affine import Affine
+
+from micamac.export_utils import write_cog
+
+
+def list_orthos(ortho_dir):
+    """List the individual orthoimages of a Malt ortho directory
+
+    Return:
+        list: List of (ort_path, pc_path) tuples; pc_path is ``None`` when the
+        ``PC_*`` hidden parts mask of the image does not exist
+    """
+    out = []
+    for ort_path in sorted(glob.glob(os.path.join(ortho_dir, 'Ort_*.tif'))):
+        pc_path = os.path.join(ortho_dir,
+                               'PC_%s' % os.path.basename(ort_path)[len('Ort_'):])
+        out.append((ort_path, pc_path if os.path.exists(pc_path) else None))
+    return out
+
+
+@contextlib.contextmanager
+def open_ortho(path):
+    """Open a raster, without warning when it is not georeferenced (Malt ``Ort_*``
+    images, see ``ortho_transform``)
+    """
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', NotGeoreferencedWarning)
+        with rasterio.open(path) as src:
+            yield src
+
+
+def ortho_transform(path):
+    """Affine transform of an image
+
+    Georeferenced images (geotiff tags or world file) use their own transform.
+    Malt writes its ``Ort_*`` images without georeferencing; they are placed on
+    the grid of the ``MTDOrtho.xml`` file of their directory, at the pixel
+    offset found in their ``PC_*.xml`` metadata
+
+    Raises:
+        ValueError: If the image is neither georeferenced nor described by Malt
+            metadata
+    """
+    with open_ortho(path) as src:
+        transform = src.transform
+    if transform != Affine.identity():
+        return transform
+    ortho_dir, name = os.path.split(path)
+    mtd_path = os.path.join(ortho_dir, 'MTDOrtho.xml')
+    meta_path = os.path.join(ortho_dir, 'PC_%s.xml' % os.path.splitext(name)[0][len('Ort_'):])
+    if not (os.path.exists(mtd_path) and os.path.exists(meta_path)):
+        raise ValueError('%s is not georeferenced and has no MTDOrtho.xml or PC_*.xml metadata'
+                         % path)
+    root = ET.parse(mtd_path).getroot()
+    x_ori, y_ori = [float(x) for x in root.find('OriginePlani').text.split()]
+    x_res, y_res = [float(x) for x in root.find('ResolutionPlani').text.split()]
+    col_off, row_off = [float(x) for x in
+                        ET.parse(meta_path).getroot().find('.//Offset').text.split()]
+    return Affine(x_res, 0, x_ori + col_off * x_res, 0, y_res, y_ori + row_off * y_res)
+
+
+def raster_bounds(path_list):
+    """Bounds of a list of rasters, see ``ortho_transform``
+
+    Return:
+        tuple: Tuple (bounds, res, transforms) with bounds an (n, 4) array of
+        (left, bottom, right, top), res the (x, y) resolution of the first raster
+        and transforms the list of affine transforms of the rasters
+    """
+    bounds = np.empty((len(path_list), 4))
+    transforms = []
+    for i, path in enumerate(path_list):
+        transform = ortho_transform(path)
+        with open_ortho(path) as src:
+            bounds[i] = array_bounds(src.height, src.width, transform)
+        transforms.append(transform)
+    res = (transforms[0].a, -transforms[0].e) if transforms else None
+    return bounds, res, transforms
+
+
+def valid_pixels(values, nodata=None):
+    """Mask of the valid pixels of an array
+
+    Nodata pixels, or zero values when there is no nodata value, are invalid
+    """
+    if nodata is None:
+        return values > 0
+    if np.isnan(nodata):
+        return ~np.isnan(values)
+    return (values != nodata) & ~np.isnan(values)
+
+
+def feather_weights(path, mask_path=None, pc_max=254, band=1):
+    """Compute the feathering weights of an image
+
+    The weight of a pixel is its distance (in pixels) to the closest invalid
+    pixel or image edge, so that contributions fade out towards seamlines
+
+    Args:
+        path (str): Image (e.g. ``Ort_*.tif``), see ``valid_pixels``
+        mask_path (str): Optional ``PC_*`` mask, resampled to the image grid if
+            needed; pixels above ``pc_max`` (hidden parts) are invalid
+        pc_max (int): Largest mask value of visible pixels
+        band (int): Band of the image defining its valid pixels
+
+    Return:
+        numpy.ndarray: float32 weights, on the grid of the image
+    """
+    with open_ortho(path) as src:
+        valid = valid_pixels(src.read(band), src.nodata)
+    if mask_path is not None:
+        with open_ortho(mask_path) as src:
+            pc = src.read(1, out_shape=valid.shape, resampling=Resampling.nearest)
+        valid &= pc <= pc_max
+    padded = np.pad(valid.astype(np.uint8), 1, mode='constant')
+    weights = cv2.distanceTransform(padded, cv2.DIST_L2, 3)[1:-1,1:-1]
+    return weights.astype(np.float32)
+
+
+def write_weights(job, weight_dir, pc_max=254):
+    """Compute the feathering weights of an image and save them to disk
+
+    Weights are saved as float16 ``.npy`` files (half the size of a 16 bits
+    band), that the blocks of every band read through memory maps
+
+    Args:
+        job (tuple): Tuple (index, (path, mask_path)), see ``list_orthos``
+        weight_dir (str): Directory of the ``.npy`` files
+        pc_max (int): See ``feather_weights``
+
+    Return:
+        str: Path of the weights file
+    """
+    i, (path, mask_path) = job
+    weights = feather_weights(path, mask_path, pc_max)
+    weights_path = os.path.join(weight_dir, 'weights_%d.npy' % i)
+    np.save(weights_path, np.minimum(weights, np.finfo(np.float16).max).astype(np.float16))
+    return weights_path
+
+
+def feather_window(window, dst_transform, layers, transforms, weights, bounds,
+                   power=1, nodata=0, dtype='uint16'):
+    """Compute a block of a feathered mosaic
+
+    Values are read from the source rasters by window; the pixels invalid in a
+    band (see ``valid_pixels``) get a zero weight in that band only
+
+    Args:
+        window (rasterio.windows.Window): Output block
+        dst_transform (affine.Affine): Transform of the output mosaic
+        layers (list): For every output band, list of (path, band) tuples giving
+            the source of each image, see ``feather_rasters``
+        transforms (list): Affine transforms of the images, see ``raster_bounds``
+        weights (list): Weights files of the images, see ``write_weights``
+        bounds (numpy.ndarray): Bounds of the images, see ``raster_bounds``
+        power (float): Exponent applied to the distance weights; larger values
+            give sharper transitions
+        nodata (float): Value of the output pixels not covered by any image
+        dtype (str): Data type of the output
+
+    Return:
+        numpy.ndarray: Array of shape (len(layers), height, width), or ``None`` if
+        no image overlaps the block
+    """
+    height, width = int(window.height), int(window.width)
+    win_transform = dst_transform * Affine.translation(window.col_off, window.row_off)
+    left, top = win_transform * (0, 0)
+    right, bottom = win_transform * (width, height)
+    overlapping = np.flatnonzero((bounds[:,0] < right) & (bounds[:,2] > left) &
+                                 (bounds[:,1] < top) & (bounds[:,3] > bottom))
+    acc = np.zeros((len(layers), height, width), dtype=np.float32)
+    weight_sum = np.zeros((len(layers), height, width), dtype=np.float32)
+    covered = False
+    for i in overlapping:
+        image_weights = np.load(weights[i], mmap_mode='r')
+        # Images and mosaic share the same ground resolution, offsets are
+        # rounded to whole pixels
+        col_off, row_off = ~transforms[i] * (left, top)
+        col_off, row_off = int(round(col_off)), int(round(row_off))
+        r0, c0 = max(row_off, 0), max(col_off, 0)
+        r1 = min(row_off + height, image_weights.shape[0])
+        c1 = min(col_off + width, image_weights.shape[1])
+        if r1 <= r0 or c1 <= c0:
+            continue
+        covered = True
+        w = image_weights[r0:r1,c0:c1].astype(np.float32) ** power
+        dst_slice = (slice(r0 - row_off, r1 - row_off), slice(c0 - col_off, c1 - col_off))
+        # Bands stored in the same file are read at once
+        reads = {}
+        for k, layer in enumerate(layers):
+            path, band = layer[i]
+            reads.setdefault(path, []).append((k, band))
+        for path, targets in reads.items():
+            with open_ortho(path) as src:
+                values = src.read([x[1] for x in targets],
+                                  window=Window(c0, r0, c1 - c0, r1 - r0))
+                src_nodata = src.nodata
+            for (k, _), arr in zip(targets, values):
+                valid = valid_pixels(arr, src_nodata)
+                wk = np.where(valid, w, 0)
+                acc[k][dst_slice] += wk * np.where(valid, arr, 0)
+                weight_sum[k][dst_slice] += wk
+    if not covered:
+        return None
+    out = np.full(acc.shape, nodata, dtype=np.float32)
+    np.divide(acc, weight_sum, out=out, where=weight_sum > 0)
+    if np.issubdtype(np.dtype(dtype), np.integer):
+        out = np.round(out)
+    return out.astype(dtype)
+
+
+def feather_rasters(images, dst_path, crs=None, ncores=4, power=1, pc_max=254,
+                    bands=(1,), band_paths=None, descriptions=None, blocksize=1024):
+    """Distance weighted feathering of a list of rasters sharing the same resolution
+
+    The weights of every image are computed once, from its first band and mask,
+    saved next to the output (see ``write_weights``) and shared by all output
+    bands. The output grid covers the union of the inputs, it is split in blocks
+    computed by a pool of processes, reading the values by window from the
+    source rasters, and streamed to a COG on disk
+
+    Args:
+        images (list): List of (path, mask_path) tuples, mask_path may be ``None``
+        dst_path (str): Output file
+        crs (rasterio.crs.CRS): Coordinate reference system of the output
+        ncores (int): Number of processes
+        power (float): See ``feather_window``
+        pc_max (int): See ``feather_weights``
+        bands (list): Bands of the inputs to mosaic, one output band each
+        band_paths (list): Alternatively to ``bands``, one list per output band
+            of single band rasters, in the order of and on the same grid as
+            ``images`` (e.g. the other spectral bands of the images)
+        descriptions (list): Optional band descriptions
+        blocksize (int): Size of the processing blocks
+    """
+    if band_paths is None:
+        layers = [[(x[0], band) for x in images] for band in bands]
+    else:
+        layers = [[(x, 1) for x in paths] for paths in band_paths]
+    bounds, res, transforms = raster_bounds([x[0] for x in images])
+    left, bottom = bounds[:,0].min(), bounds[:,1].min()
+    right, top = bounds[:,2].max(), bounds[:,3].max()
+    with open_ortho(layers[0][0][0]) as src:
+        dtype = src.dtypes[0]
+        nodata = src.nodata if src.nodata is not None else 0
+    profile = {'width': int(round((right - left) / res[0])),
+               'height': int(round((top - bottom) / res[1])),
+               'count': len(layers),
+               'dtype': dtype,
+               'nodata': nodata,
+               'crs': crs,
+               'transform': Affine(res[0], 0, left, 0, -res[1], top)}
+    weight_dir = tempfile.mkdtemp(prefix='weights_',
+                                  dir=os.path.dirname(os.path.abspath(dst_path)))
+    try:
+        with concurrent.futures.ProcessPoolExecutor(ncores) as executor:
+            weights = list(executor.map(functools.partial(write_weights,
+                                                          weight_dir=weight_dir,
+                                                          pc_max=pc_max),
+                                        enumerate(images)))
+            block_func = functools.partial(feather_window,
+                                           dst_transform=profile['transform'],
+                                           layers=layers, transforms=transforms,
+                                           weights=weights, bounds=bounds,
+                                           power=power, nodata=nodata, dtype=dtype)
+            write_cog(dst_path, profile, block_func, ncores=ncores, blocksize=blocksize,
+                      descriptions=descriptions, executor=executor)
+    finally:
+        shutil.rmtree(weight_dir)
+
+
+def capture_key(path):
+    """Name of an orthoimage without its ``Ort_<color>_`` prefix, e.g. ``00012.tif``
+    for ``Ortho-red/Ort_red_00012.tif``
+    """
+    return re.sub(r'^Ort_[^_]+_', '', os.path.basename(path))
+
+
+def feather_mosaic(ortho_dirs, dst_path, crs=None, ncores=4, power=1, pc_max=254,
+                   descriptions=None, blocksize=1024):
+    """Distance weighted feathering of the orthoimages of Malt ortho directories
+
+    Alternative to ``mm3d Tawny`` and ``mm3d TestLib SeamlineFeathering``; see
+    ``feather_rasters``. With several directories (one per band of aligned
+    images, orthorectified on the same DEM), the orthoimages are matched on
+    their ``capture_key`` and the weights of the first directory are used for
+    all bands, which are written to a single multiband output
+
+    Args:
+        ortho_dirs (str or list): Malt ortho directory (e.g. ``Ortho-red``) or
+            list of directories
+        dst_path (str): Output file
+        crs (rasterio.crs.CRS): Coordinate reference system of the output
+        ncores (int): Number of processes
+        power (float): See ``feather_window``
+        pc_max (int): See ``feather_weights``
+        descriptions (list): Optional band descriptions
+        blocksize (int): Size of the processing blocks
+
+    Raises:
+        ValueError: If a directory has no orthoimage, or the orthoimages of the
+            directories do not match
+    """
+    if isinstance(ortho_dirs, str):
+        ortho_dirs = [ortho_dirs]
+    images = list_orthos(ortho_dirs[0])
+    if not images:
+        raise ValueError('No Ort_*.tif image in %s' % ortho_dirs[0])
+    band_paths = [[x[0] for x in images]]
+    bounds = raster_bounds(band_paths[0])[0]
+    for ortho_dir in ortho_dirs[1:]:
+        others = {capture_key(x[0]): x[0] for x in list_orthos(ortho_dir)}
+        missing = [capture_key(x[0]) for x in images if capture_key(x[0]) not in others]
+        if missing:
+            raise ValueError('No orthoimage matching %s in %s' % (', '.join(missing), ortho_dir))
+        paths = [others[capture_key(x[0])] for x in images]
+        if not np.allclose(raster_bounds(paths)[0], bounds):
+            raise ValueError('Orthoimages of %s and %s are not on the same grid'
+                             % (ortho_dirs[0], ortho_dir))
+        band_paths.append(paths)
+    feather_rasters(images, dst_path, crs=crs, ncores=ncores, power=power,
+                    pc_max=pc_max, band_paths=band_paths, descriptions=descriptions,
+                    blocksize=blocksize)
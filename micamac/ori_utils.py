@@ -0,0 +1,128 @@
+import os
+import re
+import glob
+import csv
+import json
+import shutil
+import xml.etree.ElementTree as ET
+
+import numpy as np
+import fiona
+from fiona.crs import from_string
+
+
+ORI_DTYPE = np.dtype([('image', 'U64'),
+                      ('x', 'f8'), ('y', 'f8'), ('z', 'f8'),
+                      ('rotation', 'f8', (3, 3)),
+                      ('calibration', 'U256')])
+
+
+def read_orientation(path):
+    """Parse a MicMac orientation file (``Orientation-<image>.xml``)
+
+    Args:
+        path (str): Path to the orientation xml file
+
+    Return:
+        tuple: A tuple (image, center, rotation, calibration) where center is
+        an array of 3 coordinates, rotation the (3, 3) rotation matrix and
+        calibration the path of the internal calibration file
+    """
+    root = ET.parse(path).getroot()
+    conique = root.find('OrientationConique')
+    externe = conique.find('Externe')
+    center = np.array(externe.find('Centre').text.split(), dtype=np.float64)
+    matrix = externe.find('ParamRotation/CodageMatr')
+    rotation = np.array([matrix.find(line).text.split() for line in ['L1', 'L2', 'L3']],
+                        dtype=np.float64)
+    calibration = conique.findtext('FileInterne', default='')
+    image = re.sub(r'^Orientation-(.*)\.xml$', r'\1', os.path.basename(path))
+    return image, center, rotation, calibration.strip()
+
+
+def read_ori_dir(path='Ori-Ground_UTM', pattern='Orientation-pan*xml'):
+    """Load all camera poses of an orientation directory in a structured array
+
+    Args:
+        path (str): Orientation directory
+        pattern (str): Glob pattern of the orientation files to read
+
+    Return:
+        numpy.ndarray: Structured array (see ``ORI_DTYPE``) with one element per image
+    """
+    file_list = sorted(glob.glob(os.path.join(path, pattern)))
+    arr = np.empty(len(file_list), dtype=ORI_DTYPE)
+    for i, filename in enumerate(file_list):
+        image, center, rotation, calibration = read_orientation(filename)
+        arr[i] = (image, center[0], center[1], center[2], rotation, calibration)
+    return arr
+
+
+def poses_to_csv(arr, filename):
+    """Write camera poses to a csv file
+
+    Args:
+        arr (numpy.ndarray): Structured array of poses; see ``read_ori_dir``
+        filename (str): Output csv file
+    """
+    rot_names = ['r%d%d' % (i, j) for i in range(1, 4) for j in range(1, 4)]
+    with open(filename, 'w', newline='') as dst:
+        writer = csv.writer(dst)
+        writer.writerow(['image', 'x', 'y', 'z'] + rot_names + ['calibration'])
+        for row in arr:
+            writer.writerow([row['image'], row['x'], row['y'], row['z']] +
+                            row['rotation'].ravel().tolist() +
+                            [row['calibration']])
+
+
+def poses_to_file(arr, filename, utm_zone, driver='GPKG'):
+    """Write camera poses to an OGR vector file (3D points)
+
+    Args:
+        arr (numpy.ndarray): Structured array of poses; see ``read_ori_dir``
+        filename (str): Output file
+        utm_zone (int): Utm zone of the orientation (e.g. ``Ori-Ground_UTM``)
+        driver (str): OGR driver. Defaults to GeoPackage
+    """
+    schema = {'geometry': '3D Point',
+              'properties': {'image': 'str',
+                             'rotation': 'str',
+                             'calibration': 'str'}}
+    crs = from_string('+proj=utm +zone=%d +ellps=WGS84 +datum=WGS84 +units=m +no_defs' % utm_zone)
+    if os.path.exists(filename):
+        os.remove(filename)
+    with fiona.open(filename, 'w', driver=driver, schema=schema, crs=crs) as dst:
+        dst.writerecords({'type': 'Feature',
+                          'geometry': {'type': 'Point',
+                                       'coordinates': (row['x'], row['y'], row['z'])},
+                          'properties': {'image': str(row['image']),
+                                         'rotation': json.dumps(row['rotation'].tolist()),
+                                         'calibration': str(row['calibration'])}}
+                         for row in arr)
+
+
+def link_file(src, dst, link='hard'):
+    """Make ``dst`` point to the content of ``src`` without copying when possible
+
+    Args:
+        src (str): Existing file
+        dst (str): File to create, replaced if it exists
+        link (str): One of ``'hard'``, ``'sym'`` or ``'copy'``. Hard links fall
+            back to a copy when the file system does not support them
+
+    Return:
+        str: The method actually used
+    """
+    if os.path.lexists(dst):
+        os.remove(dst)
+    if link == 'hard':
+        try:
+            os.link(src, dst)
+            return 'hard'
+        except OSError:
+            link = 'copy'
+    if link == 'sym':
+        os.symlink(os.path.relpath(src, os.path.dirname(dst) or '.'), dst)
+        return 'sym'
+    shutil.copyfile(src, dst)
+    return 'copy'
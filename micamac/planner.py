@@ -0,0 +1,335 @@
+import os
+import re
+import glob
+import json
+import shutil
+import datetime
+
+import numpy as np
+import rasterio
+
+from micamac.resource_utils import available_memory, format_bytes
+
+
+HISTORY_FILE = os.path.join(os.path.expanduser('~'), '.micamac', 'history.jsonl')
+
+MB = 1024 ** 2
+
+# Default cost model: seconds, disk bytes and memory bytes per unit of work of
+# every step (see ``step_units``). Rough values for a RedEdge block, replaced by
+# values calibrated on previous runs (see ``calibrate``) as soon as available
+DEFAULT_MODEL = {'thinning': (0.02, 0, 50 * MB),
+                 'exif': (0.05, 2000, 50 * MB),
+                 'tapioca': (1.0, 100000, 400 * MB),
+                 'schnaps': (0.005, 20000, 2000 * MB),
+                 'tapas_subset': (3.0, 10000, 5 * MB),
+                 'martini': (0.05, 10000, 1 * MB),
+                 'tapas_full': (2.0, 10000, 5 * MB),
+                 'tapas_reference': (1.0, 10000, 5 * MB),
+                 'centerbascule': (0.01, 10000, 1 * MB),
+                 'campari': (1.0, 10000, 5 * MB),
+                 'chgsysco': (0.01, 10000, 1 * MB),
+                 'tarama': (0.2, 50000, 2 * MB),
+                 'malt_pan': (3600.0, 6 * MB, 300 * MB),
+                 'malt_multi': (60.0, 3 * MB, 300 * MB),
+                 'tawny': (2.0, 0.5 * MB, 1 * MB),
+                 'ortho_export': (0.05, 0.3 * MB, 500 * MB),
+                 'dem_export': (1.0, 2 * MB, 500 * MB),
+                 'ply': (2.0, 20 * MB, 200 * MB)}
+
+# Steps run inside every tile of a partitioned run
+TILE_STEPS = ['tarama', 'malt_pan', 'malt_multi', 'tawny', 'ortho_export', 'dem_export']
+
+
+def project_features(resolution, ncores, tiepoint_factor=1, auto_subset=None,
+                     zoomf=4, nb_neighbours=20):
+    """Describe the project of the current directory for the cost model
+
+    The number of image pairs is read from ``FileImagesNeighbour.xml`` when it
+    exists, and estimated from ``nb_neighbours`` otherwise
+
+    Args:
+        resolution (float): Ground resolution in meters
+        ncores (int): Number of cores
+        tiepoint_factor (int): Downsampling factor of the tie points images
+        auto_subset (int): Size of the pre-orientation subset (20 when ``None``)
+        zoomf (int): Malt ZoomF
+        nb_neighbours (int): Neighbours per image used by OriConvert
+
+    Return:
+        dict: Project features
+    """
+    img_list = sorted(glob.glob('pan*tif'))
+    if not img_list:
+        raise ValueError('No panchromatic image (pan*tif) in %s' % os.getcwd())
+    with rasterio.open(img_list[0]) as src:
+        width, height = src.width, src.height
+    n_images = len(img_list)
+    if os.path.exists('FileImagesNeighbour.xml'):
+        with open('FileImagesNeighbour.xml') as src:
+            n_pairs = len(re.findall('<Cple>', src.read()))
+    else:
+        n_pairs = n_images * min(nb_neighbours, n_images - 1)
+    return {'n_images': n_images,
+            'width': width,
+            'height': height,
+            'image_bytes': os.path.getsize(img_list[0]),
+            'n_pairs': n_pairs,
+            'resolution': resolution,
+            'zoomf': zoomf,
+            'ncores': ncores,
+            'tiepoint_factor': tiepoint_factor,
+            'subset_size': auto_subset or 20}
+
+
+def step_units(step, f):
+    """Amount of work of a step, for the runtime, disk and memory models
+
+    Args:
+        step (str): Step name
+        f (dict): Project features, see ``project_features``
+
+    Return:
+        tuple: (time_units, disk_units, memory_units)
+    """
+    n, p, c = f['n_images'], f['n_pairs'], f['ncores']
+    mpx = f['width'] * f['height'] / 1e6
+    # Ground pixels scale with the inverse square of the resolution (relative to 10 cm)
+    gpx = n * mpx * (0.1 / f['resolution']) ** 2
+    tp_mpx = mpx / f['tiepoint_factor'] ** 2
+    z2 = f['zoomf'] ** 2
+    units = {'thinning': (n / c, n, c),
+             'exif': (n, n, 1),
+             'tapioca': (p * tp_mpx / c, p, min(c, p) * tp_mpx),
+             'schnaps': (p, p, 1),
+             'tapas_subset': (f['subset_size'],) * 3,
+             'martini': (n, n, n),
+             'tapas_full': (n, n, n),
+             'tapas_reference': (n, n, n),
+             'centerbascule': (n, n, n),
+             'campari': (n, n, n),
+             'chgsysco': (n, n, n),
+             'tarama': (n, n, n),
+             'malt_pan': (gpx / z2 / c, gpx, c * mpx),
+             'malt_multi': (5 * gpx / c, 5 * gpx, c * mpx),
+             'tawny': (5 * gpx / min(c, 5), 5 * gpx, min(c, 5) * gpx),
+             'ortho_export': (5 * gpx, 5 * gpx, 1),
+             'dem_export': (gpx / z2, gpx / z2, 1),
+             'ply': (gpx / z2 / c, gpx / z2, c)}
+    return units[step]
+
+
+def planned_tile_steps(startfrom, ortho, dem):
+    """Steps run inside every tile of a partitioned run (see ``micamac.tiling.process_tile``)
+    """
+    steps = []
+    if startfrom <= 9:
+        steps += ['tarama', 'malt_pan']
+    if ortho:
+        if startfrom <= 10:
+            steps.append('malt_multi')
+        steps += ['tawny', 'ortho_export']
+    if dem:
+        steps.append('dem_export')
+    return steps
+
+
+def planned_steps(startfrom, ortho, dem, tiled, ply=False, reference=False,
+                  reference_images=False, thinning=False):
+    """Steps run by run_micmac.py for a set of options (see its ``main``)
+
+    Args:
+        startfrom (int): See ``run_micmac.py --startfrom``
+        ortho (bool): ``--ortho`` is set
+        dem (bool): ``--dem`` is set
+        tiled (bool): ``--tile-size`` is set; the steps of the tiles are given
+            by ``planned_tile_steps``
+        ply (bool): ``--ply`` is set
+        reference (bool): ``--reference`` is set (no pre-orientation subset)
+        reference_images (bool): Reference images are oriented with the new
+            ones (``--reference`` without ``--reference-calib-only``); a single
+            ``tapas_reference`` adjustment replaces martini, tapas_full,
+            centerbascule and campari
+        thinning (bool): ``--thin-overlap`` is set
+
+    Return:
+        list: Step names
+    """
+    steps = ['thinning'] if thinning and startfrom == 0 else []
+    steps.append('exif')
+    for i, step in enumerate(['tapioca', 'schnaps', 'tapas_subset', 'martini', 'tapas_full',
+                              'centerbascule', 'campari', 'chgsysco'], 1):
+        if step == 'tapas_subset' and reference:
+            continue
+        if step in ['martini', 'centerbascule', 'campari'] and reference_images:
+            continue
+        if step == 'tapas_full' and reference_images:
+            step = 'tapas_reference'
+        if startfrom <= i:
+            steps.append(step)
+    if tiled:
+        steps.append('tiles')
+    else:
+        if startfrom <= 9:
+            steps += ['tarama', 'malt_pan']
+        if startfrom <= 10:
+            steps.append('malt_multi')
+        if ortho:
+            steps += ['tawny', 'ortho_export']
+        if dem:
+            steps.append('dem_export')
+    if ply:
+        steps.append('ply')
+    return steps
+
+
+def load_history(path=HISTORY_FILE):
+    """Load the records of previous runs (see ``record_run``)
+    """
+    if not os.path.exists(path):
+        return []
+    out = []
+    with open(path) as src:
+        for line in src:
+            try:
+                out.append(json.loads(line))
+            except ValueError:
+                continue
+    return out
+
+
+def record_run(path, features, report, img_dir='.'):
+    """Append the step timings of a run to the history file
+
+    Args:
+        path (str): History file (json lines)
+        features (dict): Project features, see ``project_features``
+        report (dict): Step report, see ``micamac.resource_utils.StepTimer``
+        img_dir (str): Project directory
+    """
+    dirname = os.path.dirname(path)
+    if dirname and not os.path.exists(dirname):
+        os.makedirs(dirname)
+    record = {'date': datetime.datetime.now().isoformat(),
+              'img_dir': os.path.abspath(img_dir),
+              'features': features,
+              'disk_start': report.get('disk_start'),
+              'disk_peak': report.get('disk_peak'),
+              'disk_final': report.get('disk_final'),
+              'steps': report['steps']}
+    with open(path, 'a') as dst:
+        dst.write(json.dumps(record) + '\n')
+
+
+def calibrate(history):
+    """Fit the per unit costs of every step on previous runs
+
+    Costs are the median, over runs, of the measured quantity divided by the
+    step units. Disk is the growth of the project directory during the step
+    and memory the peak of child processes, when it increased during the step
+
+    Args:
+        history (list): Run records, see ``load_history``
+
+    Return:
+        dict: Model, ``{step: (seconds, disk, memory, n_runs)}``; steps absent
+        from the history keep their default costs with ``n_runs`` 0
+    """
+    samples = {}
+    for record in history:
+        f = record['features']
+        prev_disk = record.get('disk_start')
+        prev_rss = 0
+        for step in record['steps']:
+            name = step['name']
+            # Disk usage after the step, once its intermediate artifacts were released
+            after_disk = step['disk'] - step.get('released', 0) if 'disk' in step else prev_disk
+            # Steps restored from cache tell nothing about the cost of running them
+            if name not in DEFAULT_MODEL or step.get('cached'):
+                prev_disk = after_disk
+                prev_rss = max(prev_rss, step.get('peak_rss', 0))
+                continue
+            t_units, d_units, m_units = step_units(name, f)
+            s = samples.setdefault(name, ([], [], []))
+            if t_units > 0:
+                s[0].append(step['duration'] / t_units)
+            if 'disk' in step and prev_disk is not None and d_units > 0:
+                s[1].append(max(step['disk'] - prev_disk, 0) / d_units)
+            if step.get('peak_rss', 0) > prev_rss and m_units > 0:
+                s[2].append(step['peak_rss'] / m_units)
+            prev_disk = after_disk
+            prev_rss = max(prev_rss, step.get('peak_rss', 0))
+    model = {}
+    for name, default in DEFAULT_MODEL.items():
+        s = samples.get(name, ([], [], []))
+        model[name] = tuple(float(np.median(x)) if x else d for x, d in zip(s, default)) + (len(s[0]),)
+    return model
+
+
+def plan(features, steps, model, tile_jobs=2, tile_steps=TILE_STEPS):
+    """Predict runtime, peak memory and disk growth of every step
+
+    Args:
+        features (dict): Project features, see ``project_features``
+        steps (list): Step names, see ``planned_steps``
+        model (dict): Cost model, see ``calibrate``
+        tile_jobs (int): Concurrent tiles of a partitioned run, each running
+            with ``ncores // tile_jobs`` cores
+        tile_steps (list): Steps run inside every tile, see ``planned_tile_steps``
+
+    Return:
+        list: List of dict with ``step``, ``seconds``, ``disk``, ``memory`` and
+        ``n_runs`` (number of runs the costs are calibrated on) keys
+    """
+    out = []
+    for step in steps:
+        if step == 'tiles':
+            # Tiles overlap, so that a bit more work is done than for the whole
+            # block; tile_jobs tiles share the cores and run concurrently
+            tile_features = dict(features, ncores=max(1, features['ncores'] // tile_jobs))
+            parts = plan(tile_features, tile_steps, model)
+            out.append({'step': step,
+                        'seconds': 1.2 * sum(x['seconds'] for x in parts) / tile_jobs,
+                        'disk': 1.2 * sum(x['disk'] for x in parts),
+                        'memory': tile_jobs * max(x['memory'] for x in parts),
+                        'n_runs': min(x['n_runs'] for x in parts)})
+            continue
+        t_units, d_units, m_units = step_units(step, features)
+        seconds, disk, memory, n_runs = model[step]
+        out.append({'step': step,
+                    'seconds': seconds * t_units,
+                    'disk': disk * d_units,
+                    'memory': memory * m_units,
+                    'n_runs': n_runs})
+    return out
+
+
+def print_plan(rows, features, history_path=HISTORY_FILE, n_history=0):
+    """Print a step plan and check it against free disk space and available memory
+    """
+    f = features
+    print('Plan for %d images (%dx%d), %d image pairs, resolution %.2f m, ZoomF %d, %d cores'
+          % (f['n_images'], f['width'], f['height'], f['n_pairs'], f['resolution'],
+             f['zoomf'], f['ncores']))
+    print('Cost model calibrated on %d previous runs (%s)' % (n_history, history_path))
+    print('%-15s %12s %12s %12s  %s' % ('step', 'runtime', 'peak RAM', 'disk', 'model'))
+    disk = 0
+    peak_disk = 0
+    for row in rows:
+        disk += row['disk']
+        peak_disk = max(peak_disk, disk)
+        print('%-15s %12s %12s %12s  %s'
+              % (row['step'], datetime.timedelta(seconds=int(row['seconds'])),
+                 format_bytes(row['memory']), '+' + format_bytes(row['disk']),
+                 '%d runs' % row['n_runs'] if row['n_runs'] else 'default'))
+    total = sum(x['seconds'] for x in rows)
+    peak_memory = max(x['memory'] for x in rows)
+    print('%-15s %12s %12s %12s' % ('total', datetime.timedelta(seconds=int(total)),
+                                    format_bytes(peak_memory), format_bytes(peak_disk)))
+    free = shutil.disk_usage('.').free
+    print('Free disk space: %s, available memory: %s' % (format_bytes(free),
+                                                        format_bytes(available_memory())))
+    if peak_disk > free:
+        print('WARNING: intermediate files are expected to exceed the free disk space')
+    if peak_memory > available_memory():
+        print('WARNING: peak memory is expected to exceed the available memory')
@@ -0,0 +1,197 @@
+import os
+import json
+import concurrent.futures
+
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+
+from micamac.export_utils import block_windows
+from micamac.micmac_utils import malt_dem_params
+
+try:
+    import laspy
+except ImportError:
+    _has_laspy = False
+else:
+    _has_laspy = True
+
+
+PLY_TYPES = {'f8': 'double', 'f4': 'float', 'u2': 'ushort', 'u1': 'uchar'}
+
+
+def tile_points(dem_path, window, ortho_path=None, band_names=None, voxel=None):
+    """Build the points of a window of a DEM, colored by an orthomosaic
+
+    One point is created at the center of every valid DEM pixel, altitudes being
+    converted and masked as Malt depth maps (see
+    ``micamac.micmac_utils.malt_dem_params``). Band values are sampled from the
+    orthomosaic at the point location (nearest neighbour)
+
+    Args:
+        dem_path (str): DEM, e.g. the final Malt depth map (see ``final_malt_dem``)
+        window (rasterio.windows.Window): Window of the DEM
+        ortho_path (str): Optional multiband orthomosaic
+        band_names (list): Names of the orthomosaic bands
+        voxel (float): Optional voxel size (m); a single point is kept per voxel
+
+    Return:
+        numpy.ndarray: Structured array with ``x``, ``y``, ``z`` and band fields
+    """
+    origin, resolution, mask_path = malt_dem_params(dem_path)
+    with rasterio.open(dem_path) as src:
+        z = src.read(1, window=window).astype(np.float64)
+        valid = np.ones(z.shape, dtype=bool) if src.nodata is None else z != src.nodata
+        aff = src.window_transform(window)
+    if mask_path is not None:
+        with rasterio.open(mask_path) as src:
+            valid &= src.read(1, window=window, boundless=True, fill_value=0) != 0
+    valid &= np.isfinite(z)
+    rows, cols = np.nonzero(valid)
+    x = aff.c + (cols + 0.5) * aff.a + (rows + 0.5) * aff.b
+    y = aff.f + (cols + 0.5) * aff.d + (rows + 0.5) * aff.e
+    z = origin + resolution * z[rows, cols]
+    if voxel is not None and len(x):
+        keys = np.floor(np.column_stack([x, y, z]) / voxel).astype(np.int64)
+        _, idx = np.unique(keys, axis=0, return_index=True)
+        idx.sort()
+        x, y, z = x[idx], y[idx], z[idx]
+    bands = []
+    if ortho_path is not None:
+        with rasterio.open(ortho_path) as src:
+            if band_names is None:
+                band_names = [d or 'band%d' % i for i, d in enumerate(src.descriptions, 1)]
+            dtype = src.dtypes[0]
+            inv = ~src.transform
+            o_cols = np.floor(inv.c + x * inv.a + y * inv.b).astype(np.int64)
+            o_rows = np.floor(inv.f + x * inv.d + y * inv.e).astype(np.int64)
+            if len(x):
+                ortho_window = Window(o_cols.min(), o_rows.min(),
+                                      o_cols.max() - o_cols.min() + 1,
+                                      o_rows.max() - o_rows.min() + 1)
+                arr = src.read(window=ortho_window, boundless=True, fill_value=0)
+                bands = list(arr[:, o_rows - ortho_window.row_off, o_cols - ortho_window.col_off])
+            else:
+                bands = [np.zeros(0, dtype=dtype) for _ in band_names]
+    fields = [('x', 'f8'), ('y', 'f8'), ('z', 'f8')]
+    fields += [(name, band.dtype.str[1:]) for name, band in zip(band_names or [], bands)]
+    out = np.empty(len(x), dtype=np.dtype([(name, '<' + t) for name, t in fields]))
+    out['x'], out['y'], out['z'] = x, y, z
+    for name, band in zip(band_names or [], bands):
+        out[name] = band
+    return out
+
+
+def write_ply(points, path, comment=None):
+    """Write a structured array of points to a binary PLY file
+    """
+    header = ['ply', 'format binary_little_endian 1.0']
+    if comment is not None:
+        header.append('comment %s' % comment)
+    header.append('element vertex %d' % len(points))
+    for name in points.dtype.names:
+        header.append('property %s %s' % (PLY_TYPES[points.dtype[name].str[1:]], name))
+    header.append('end_header')
+    with open(path, 'wb') as dst:
+        dst.write(('\n'.join(header) + '\n').encode('ascii'))
+        points.tofile(dst)
+
+
+def write_las(points, path):
+    """Write a structured array of points to LAS (or LAZ, depending on the extension)
+
+    Red, green, blue and nir fields are stored as LAS colors (point format 8),
+    other fields as extra dimensions
+    """
+    if not _has_laspy:
+        raise ImportError('laspy must be installed to write LAS/LAZ point clouds')
+    header = laspy.LasHeader(point_format=8, version='1.4')
+    extra = [x for x in points.dtype.names if x not in ['x', 'y', 'z', 'red', 'green', 'blue', 'nir']]
+    for name in extra:
+        header.add_extra_dim(laspy.ExtraBytesParams(name=name, type=points.dtype[name]))
+    if len(points):
+        header.offsets = [np.floor(points[x].min()) for x in ['x', 'y', 'z']]
+    header.scales = [0.001, 0.001, 0.001]
+    las = laspy.LasData(header)
+    las.x, las.y, las.z = points['x'], points['y'], points['z']
+    for name in points.dtype.names[3:]:
+        setattr(las, name, points[name])
+    las.write(path)
+
+
+def export_tile(job):
+    """Build and write the point cloud of a DEM window (see ``export_point_cloud``)
+
+    Return:
+        dict: Tile ``file``, number of ``points`` and ``bounds``
+    """
+    window = Window(*job['window'])
+    points = tile_points(job['dem_path'], window, ortho_path=job['ortho_path'],
+                         band_names=job['band_names'], voxel=job['voxel'])
+    if not len(points):
+        return {'file': None, 'points': 0, 'bounds': None}
+    if job['path'].endswith('.ply'):
+        write_ply(points, job['path'], comment=job['comment'])
+    else:
+        write_las(points, job['path'])
+    return {'file': os.path.basename(job['path']),
+            'points': len(points),
+            'bounds': [float(points['x'].min()), float(points['y'].min()),
+                       float(points['x'].max()), float(points['y'].max())]}
+
+
+def export_point_cloud(dem_path, dst_dir, ortho_path=None, band_names=None,
+                       voxel=None, fmt='ply', tile_size=1024, ncores=4, crs=None):
+    """Export a dense point cloud as tiles, processed in parallel
+
+    Every tile of ``tile_size`` DEM pixels is read, converted to points and written
+    by a separate worker, so that memory use does not depend on the size of the
+    cloud. An ``index.json`` file lists the tiles with their bounds and point counts
+
+    Args:
+        dem_path (str): DEM (Malt depth map or georeferenced DEM)
+        dst_dir (str): Output directory
+        ortho_path (str): Optional multiband orthomosaic, sampled for point colors
+        band_names (list): Names of the orthomosaic bands, defaults to the band
+            descriptions
+        voxel (float): Optional voxel size (m) for decimation, within every tile
+        fmt (str): ply, las or laz (las and laz require laspy, and a laz backend
+            for laz)
+        tile_size (int): Tile size in DEM pixels
+        ncores (int): Number of processes
+        crs (rasterio.crs.CRS): Coordinate reference system, recorded in the index
+            and PLY headers
+
+    Return:
+        dict: The index
+    """
+    if fmt in ['las', 'laz'] and not _has_laspy:
+        raise ImportError('laspy must be installed to write LAS/LAZ point clouds')
+    if not os.path.exists(dst_dir):
+        os.makedirs(dst_dir)
+    with rasterio.open(dem_path) as src:
+        windows = block_windows(src.width, src.height, tile_size)
+    comment = 'micamac dense point cloud%s' % ('' if crs is None else ', %s' % crs.to_string())
+    jobs = [{'dem_path': dem_path,
+             'ortho_path': ortho_path,
+             'band_names': band_names,
+             'voxel': voxel,
+             'window': (w.col_off, w.row_off, w.width, w.height),
+             'path': os.path.join(dst_dir, 'tile_%d_%d.%s' % (w.row_off // tile_size,
+                                                               w.col_off // tile_size, fmt)),
+             'comment': comment}
+            for w in windows]
+    tiles = []
+    with concurrent.futures.ProcessPoolExecutor(ncores) as executor:
+        for tile in executor.map(export_tile, jobs):
+            if tile['file'] is not None:
+                tiles.append(tile)
+    index = {'dem': os.path.abspath(dem_path),
+             'ortho': os.path.abspath(ortho_path) if ortho_path else None,
+             'crs': None if crs is None else crs.to_string(),
+             'voxel': voxel,
+             'points': sum(x['points'] for x in tiles),
+             'tiles': tiles}
+    with open(os.path.join(dst_dir, 'index.json'), 'w') as dst:
+        json.dump(index, dst, indent=2)
+    return index
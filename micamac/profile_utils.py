@@ -0,0 +1,161 @@
+import os
+import glob
+import signal
+import cProfile
+import pstats
+import collections
+
+
+PROFILE_ENV = 'MICAMAC_PROFILE'
+PROFILE_MODE_ENV = 'MICAMAC_PROFILE_MODE'
+
+# Profilers and active profiled calls, by process id (forked workers inherit those of their parent)
+_PROFILERS = {}
+_ACTIVE = []
+
+
+class StackSampler(object):
+    """Statistical profiler counting Python stacks at regular intervals of CPU time
+
+    Relies on ``SIGPROF`` so it only samples the main thread of a process, which is
+    where multiprocessing pool workers run their tasks
+
+    Args:
+        interval (float): Sampling interval in seconds of CPU time
+    """
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = collections.Counter()
+        signal.signal(signal.SIGPROF, self._sample)
+
+    def _sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename),
+                                         code.co_firstlineno))
+            frame = frame.f_back
+        self.stacks[';'.join(reversed(stack))] += 1
+
+    def enable(self):
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def disable(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+
+    def dump_stats(self, path):
+        with open(path, 'w') as dst:
+            for stack, count in self.stacks.items():
+                dst.write('%s %d\n' % (stack, count))
+
+
+class Profiled(object):
+    """Picklable wrapper profiling every call of a function, see ``profiled``
+    """
+    def __init__(self, func, name, out_dir, mode='cprofile'):
+        self.func = func
+        self.name = name
+        self.out_dir = out_dir
+        self.mode = mode
+
+    def __call__(self, *args, **kwargs):
+        pid = os.getpid()
+        # Nested profiled calls in the same process are accounted to the outer one
+        if pid in _ACTIVE:
+            return self.func(*args, **kwargs)
+        # Stop the profilers a forked worker inherited from its parent
+        for key in [k for k in _PROFILERS if k[1] != pid]:
+            _PROFILERS.pop(key).disable()
+        profiler = _PROFILERS.get((self.name, pid))
+        if profiler is None:
+            profiler = StackSampler() if self.mode == 'sample' else cProfile.Profile()
+            _PROFILERS[(self.name, pid)] = profiler
+        _ACTIVE.append(pid)
+        profiler.enable()
+        try:
+            return self.func(*args, **kwargs)
+        finally:
+            profiler.disable()
+            _ACTIVE.remove(pid)
+            ext = 'folded' if self.mode == 'sample' else 'prof'
+            profiler.dump_stats(os.path.join(self.out_dir, '%s.%d.%s' % (self.name, pid, ext)))
+
+
+def profiled(func, name=None):
+    """Wrap a function so that its calls are profiled when profiling is enabled
+
+    Profiling is enabled by setting the ``MICAMAC_PROFILE`` environment variable to
+    a directory (see ``enable_profiling``), inherited by worker processes. Every
+    process writes its statistics to that directory after each call, so that
+    nothing is lost when pools are terminated. ``MICAMAC_PROFILE_MODE`` selects
+    deterministic ``cProfile`` statistics (cprofile, default) or the low overhead
+    ``StackSampler`` (sample), whose collapsed stacks are flamegraph compatible
+
+    Args:
+        func (callable): Function or ``functools.partial``, picklable for use in
+            process pools
+        name (str): Name of the profile files, defaults to the function name
+
+    Return:
+        callable: ``func`` itself when the ``MICAMAC_PROFILE`` environment variable
+        is not set, a ``Profiled`` wrapper otherwise
+    """
+    out_dir = os.environ.get(PROFILE_ENV)
+    if not out_dir:
+        return func
+    if name is None:
+        name = getattr(func, '__name__', None) or func.func.__name__
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    return Profiled(func, name, out_dir, mode=os.environ.get(PROFILE_MODE_ENV, 'cprofile'))
+
+
+def enable_profiling(out_dir, mode='cprofile'):
+    """Turn profiling on for the current process and the processes it starts
+    """
+    os.environ[PROFILE_ENV] = os.path.abspath(out_dir)
+    os.environ[PROFILE_MODE_ENV] = mode
+
+
+def merge_profiles(out_dir, n_lines=30):
+    """Merge the per process profiles of every profiled function
+
+    Writes ``<name>.prof`` (merged cProfile statistics, e.g. for snakeviz) with a
+    ``<name>.txt`` summary sorted by cumulative time, or ``<name>.folded``
+    (merged collapsed stacks) for sampled profiles
+
+    Args:
+        out_dir (str): Profile directory
+        n_lines (int): Number of functions listed in the text summaries
+
+    Return:
+        list: The merged files
+    """
+    groups = collections.defaultdict(list)
+    for path in glob.glob(os.path.join(out_dir, '*.*.prof')) + glob.glob(os.path.join(out_dir, '*.*.folded')):
+        name, pid, ext = os.path.basename(path).rsplit('.', 2)
+        if pid.isdigit():
+            groups[(name, ext)].append(path)
+    out = []
+    for (name, ext), paths in sorted(groups.items()):
+        merged = os.path.join(out_dir, '%s.%s' % (name, ext))
+        if ext == 'prof':
+            stats = pstats.Stats(*paths)
+            stats.dump_stats(merged)
+            with open(os.path.join(out_dir, '%s.txt' % name), 'w') as dst:
+                dst.write('%s: %d processes\n' % (name, len(paths)))
+                pstats.Stats(merged, stream=dst).sort_stats('cumulative').print_stats(n_lines)
+        else:
+            stacks = collections.Counter()
+            for path in paths:
+                with open(path) as src:
+                    for line in src:
+                        stack, count = line.rstrip('\n').rsplit(' ', 1)
+                        stacks[stack] += int(count)
+            with open(merged, 'w') as dst:
+                for stack, count in stacks.most_common():
+                    dst.write('%s %d\n' % (stack, count))
+        for path in paths:
+            os.remove(path)
+        out.append(merged)
+    return out
@@ -0,0 +1,248 @@
+import os
+import glob
+import math
+import concurrent.futures
+
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.warp import transform
+from affine import Affine
+import exiftool
+
+from micamac.export_utils import write_cog, utm_crs
+from micamac.micmac_utils import COLORS
+
+
+def find_captures(img_dir):
+    """List the band files of every raw RedEdge capture of a directory tree
+
+    Return:
+        list: List of lists of the 5 band files (IMG_XXXX_1.tif to IMG_XXXX_5.tif)
+        of every complete capture
+    """
+    first_bands = sorted(glob.glob(os.path.join(img_dir, '**', 'IMG_*_1.tif'),
+                                   recursive=True))
+    out = []
+    for path in first_bands:
+        paths = [path[:-len('1.tif')] + '%d.tif' % band for band in range(1, 6)]
+        if all(os.path.exists(x) for x in paths):
+            out.append(paths)
+    return out
+
+
+def read_capture_meta(paths):
+    """Read position, DLS yaw and camera geometry of captures in a single exiftool run
+
+    Args:
+        paths (list): First band file of every capture
+
+    Return:
+        list: List of dict with ``lon``, ``lat``, ``alt`` (above sea level),
+        ``yaw`` (radians) and ``pixel_angle`` (pixel size over focal length) keys
+    """
+    with exiftool.ExifTool() as et:
+        get_batch = getattr(et, 'get_metadata_batch', et.get_metadata)
+        meta_list = get_batch(paths)
+    out = []
+    for meta in meta_list:
+        lat = meta.get('Composite:GPSLatitude', meta['EXIF:GPSLatitude'])
+        lon = meta.get('Composite:GPSLongitude', meta['EXIF:GPSLongitude'])
+        out.append({'lon': float(lon),
+                    'lat': float(lat),
+                    'alt': float(meta['EXIF:GPSAltitude']),
+                    'yaw': float(meta.get('XMP:Yaw', 0)),
+                    'pixel_angle': 1 / (float(meta['EXIF:FocalPlaneXResolution'])
+                                        * float(meta['EXIF:FocalLength']))})
+    return out
+
+
+def capture_transform(x, y, yaw, width, height, gsd):
+    """Affine transform of a nadir capture centered on its projected position
+
+    Same rotation convention as ``micamac.micasense_utils.affine_from_capture``,
+    but in projected coordinates, with the capture center (rather than its corner)
+    on the camera position
+
+    Args:
+        x (float): Projected x coordinate of the camera
+        y (float): Projected y coordinate of the camera
+        yaw (float): DLS yaw in radians
+        width (int): Image width in pixels
+        height (int): Image height in pixels
+        gsd (float): Ground size of a pixel in meters
+
+    Return:
+        affine.Affine: Transform from image (col, row) to projected coordinates
+    """
+    return (Affine.translation(x, y) * Affine.scale(gsd, -gsd)
+            * Affine.rotation(360 - math.degrees(yaw))
+            * Affine.translation(-width / 2.0, -height / 2.0))
+
+
+def write_thumbnail(job, thumbs_path, factor):
+    """Write the decimated bands of a capture to its slot of the thumbnails array
+
+    Args:
+        job (tuple): Tuple of (index, band files)
+        thumbs_path (str): ``.npy`` array of shape (n_captures, 5, height, width)
+        factor (int): Decimation factor
+    """
+    index, paths = job
+    thumbs = np.load(thumbs_path, mmap_mode='r+')
+    for band, path in enumerate(paths):
+        with rasterio.open(path) as src:
+            thumbs[index, band] = src.read(1, out_shape=thumbs.shape[2:],
+                                           resampling=Resampling.average)
+    thumbs.flush()
+
+
+def footprint_bounds(transforms, width, height):
+    """Bounding boxes of image footprints
+
+    Return:
+        numpy.ndarray: Array of shape (n, 4) of (xmin, ymin, xmax, ymax)
+    """
+    corners = [(0, 0), (width, 0), (width, height), (0, height)]
+    bounds = []
+    for aff in transforms:
+        xs, ys = zip(*[aff * c for c in corners])
+        bounds.append((min(xs), min(ys), max(xs), max(ys)))
+    return np.array(bounds)
+
+
+class QuicklookBlock(object):
+    """Paste the thumbnails covering a block of the mosaic, nearest to nadir first
+
+    Every pixel takes the value of the capture whose center is closest (in image
+    space) to where the pixel projects, which is the least oblique view of it
+
+    Args:
+        thumbs_path (str): Thumbnails array, see ``write_thumbnail``
+        transforms (list): Affine transforms of the thumbnails, see ``capture_transform``
+        dst_transform (affine.Affine): Transform of the mosaic
+    """
+    def __init__(self, thumbs_path, transforms, dst_transform):
+        self.thumbs_path = thumbs_path
+        self.transforms = transforms
+        self.dst_transform = dst_transform
+        self.inverse = [~x for x in transforms]
+        self.height, self.width = np.load(thumbs_path, mmap_mode='r').shape[2:]
+        self.bounds = footprint_bounds(transforms, self.width, self.height)
+
+    def __call__(self, window):
+        aff = self.dst_transform * Affine.translation(window.col_off, window.row_off)
+        cols, rows = np.meshgrid(np.arange(window.width) + 0.5, np.arange(window.height) + 0.5)
+        xs = aff.c + cols * aff.a + rows * aff.b
+        ys = aff.f + cols * aff.d + rows * aff.e
+        b = self.bounds
+        candidates = np.flatnonzero((b[:, 0] <= xs.max()) & (b[:, 2] >= xs.min())
+                                    & (b[:, 1] <= ys.max()) & (b[:, 3] >= ys.min()))
+        if not len(candidates):
+            return None
+        thumbs = np.load(self.thumbs_path, mmap_mode='r')
+        out = np.zeros((thumbs.shape[1], window.height, window.width), dtype=thumbs.dtype)
+        best = np.full(xs.shape, np.inf)
+        for i in candidates:
+            inv = self.inverse[i]
+            c = inv.c + xs * inv.a + ys * inv.b
+            r = inv.f + xs * inv.d + ys * inv.e
+            dist = (c - self.width / 2.0) ** 2 + (r - self.height / 2.0) ** 2
+            mask = ((c >= 0) & (c < self.width) & (r >= 0) & (r < self.height)
+                    & (dist < best))
+            if not mask.any():
+                continue
+            best[mask] = dist[mask]
+            out[:, mask] = thumbs[i][:, r[mask].astype(int), c[mask].astype(int)]
+        if np.isinf(best).all():
+            return None
+        return out
+
+
+def make_quicklook(img_dir, dst_path, utm_zone=None, factor=8, resolution=None,
+                   altitude=None, ncores=4, blocksize=512):
+    """Quick, direct georeferencing mosaic of a raw RedEdge flight
+
+    Captures are placed using their GPS position and DLS yaw only (no tie points,
+    no terrain model), from images decimated by ``factor``, at which scale the
+    misalignment of the bands is negligible. Meant to check coverage in the field,
+    minutes after landing, before the full MicMac workflow
+
+    Args:
+        img_dir (str): Directory of raw captures (nested directories are fine)
+        dst_path (str): Output multiband Cloud Optimized GeoTiff
+        utm_zone (int): Utm zone of the mosaic, derived from the captures when ``None``
+        factor (int): Decimation factor of the captures
+        resolution (float): Mosaic resolution in meters, defaults to the ground
+            size of a decimated pixel
+        altitude (float): Flight height above ground in meters, defaults to the
+            height above the lowest capture (usually the pre-flight panel capture)
+        ncores (int): Number of processes
+        blocksize (int): Mosaic processing block size
+
+    Return:
+        dict: Number of ``captures`` used, ``resolution`` and ``utm_zone``
+    """
+    captures = find_captures(img_dir)
+    if not captures:
+        raise ValueError('No RedEdge capture (IMG_XXXX_1.tif to IMG_XXXX_5.tif) found in %s' % img_dir)
+    # One exiftool process per core
+    n_chunks = min(ncores, len(captures))
+    chunks = [[x[0] for x in captures[i::n_chunks]] for i in range(n_chunks)]
+    with concurrent.futures.ProcessPoolExecutor(n_chunks) as executor:
+        meta_chunks = list(executor.map(read_capture_meta, chunks))
+    meta_list = [None] * len(captures)
+    for i, chunk in enumerate(meta_chunks):
+        meta_list[i::n_chunks] = chunk
+    alt = np.array([x['alt'] for x in meta_list])
+    if altitude is None:
+        height = alt - alt.min()
+        altitude = np.median(height)
+    else:
+        height = alt - (np.median(alt) - altitude)
+    # Ground captures (panels) and steep climbs or descents are left out
+    keep = np.flatnonzero(height > 0.5 * altitude)
+    captures = [captures[i] for i in keep]
+    meta_list = [meta_list[i] for i in keep]
+    height = height[keep]
+    if utm_zone is None:
+        utm_zone = int((np.mean([x['lon'] for x in meta_list]) + 180) // 6) + 1
+    crs = utm_crs(utm_zone)
+    xs, ys = transform('EPSG:4326', crs, [x['lon'] for x in meta_list],
+                       [x['lat'] for x in meta_list])
+
+    with rasterio.open(captures[0][0]) as src:
+        width = src.width // factor
+        img_height = src.height // factor
+    gsd = np.array([x['pixel_angle'] for x in meta_list]) * height * factor
+    if resolution is None:
+        resolution = float(np.median(gsd))
+    transforms = [capture_transform(x, y, m['yaw'], width, img_height, g)
+                  for x, y, m, g in zip(xs, ys, meta_list, gsd)]
+    bounds = footprint_bounds(transforms, width, img_height)
+    xmin, ymin = bounds[:, :2].min(axis=0)
+    xmax, ymax = bounds[:, 2:].max(axis=0)
+    dst_transform = Affine(resolution, 0, xmin, 0, -resolution, ymax)
+    profile = {'width': int(math.ceil((xmax - xmin) / resolution)),
+               'height': int(math.ceil((ymax - ymin) / resolution)),
+               'count': len(COLORS),
+               'dtype': 'uint16',
+               'nodata': 0,
+               'crs': crs,
+               'transform': dst_transform}
+
+    thumbs_path = '%s.thumbs.npy' % os.path.splitext(dst_path)[0]
+    thumbs = np.lib.format.open_memmap(thumbs_path, mode='w+', dtype=np.uint16,
+                                       shape=(len(captures), len(COLORS), img_height, width))
+    del thumbs
+    try:
+        with concurrent.futures.ProcessPoolExecutor(ncores) as executor:
+            list(executor.map(write_thumbnail, enumerate(captures),
+                              [thumbs_path] * len(captures),
+                              [factor] * len(captures), chunksize=8))
+            block_func = QuicklookBlock(thumbs_path, transforms, dst_transform)
+            write_cog(dst_path, profile, block_func, ncores=ncores,
+                      blocksize=blocksize, descriptions=COLORS, executor=executor)
+    finally:
+        os.remove(thumbs_path)
+    return {'captures': len(captures), 'resolution': resolution, 'utm_zone': utm_zone}
@@ -0,0 +1,170 @@
+import os
+import re
+import glob
+import shutil
+import xml.etree.ElementTree as ET
+
+import numpy as np
+from shapely.geometry import Polygon
+
+from micamac.ori_utils import link_file
+from micamac.quicklook import footprint_bounds
+from micamac.thinning import image_footprints
+
+
+REF_PREFIX = 'ref_'
+
+
+def link_reference(ref_dir, ori='Ori-Ground_UTM', out_ori='Ori-Reference',
+                   images=True, link='sym'):
+    """Import the orientation, and optionally the imagery, of a reference project
+
+    Calibration files of the reference orientation are copied to ``out_ori``.
+    When ``images`` is set, the panchromatic images of the reference project that
+    have an orientation are linked to the current working directory with a
+    ``ref_`` prefix (``ref_pan_XXXXX.tif``, out of the ``pan*tif`` patterns of the
+    workflow), and their orientation files copied to ``out_ori`` under the same
+    names, pointing to the copied calibration
+
+    Args:
+        ref_dir (str): Directory of a previous run_micmac.py project
+        ori (str): Orientation directory of the reference project, relative to ``ref_dir``
+        out_ori (str): Orientation directory to create in the current working directory
+        images (bool): Link the reference images
+        link (str): How reference images are linked, see ``micamac.ori_utils.link_file``
+
+    Return:
+        list: Names of the linked reference images (empty when ``images`` is ``False``)
+    """
+    src_ori = os.path.join(ref_dir, ori)
+    calib_list = glob.glob(os.path.join(src_ori, 'AutoCal*.xml'))
+    if not calib_list:
+        raise ValueError('No calibration (AutoCal*.xml) found in %s' % src_ori)
+    if not os.path.exists(out_ori):
+        os.makedirs(out_ori)
+    for calib in calib_list:
+        shutil.copy(calib, out_ori)
+    if not images:
+        return []
+    img_list = []
+    ori_file_pattern = re.compile(r'^Orientation-(pan_\d{5}\.tif)\.xml$')
+    calib_pattern = re.compile(r'<FileInterne>\s*(?:[^<]*/)?([^</]+?)\s*</FileInterne>')
+    for path in sorted(glob.glob(os.path.join(src_ori, 'Orientation-pan*xml'))):
+        match = ori_file_pattern.match(os.path.basename(path))
+        if match is None:
+            continue
+        img = match.group(1)
+        img_path = os.path.join(ref_dir, img)
+        if not os.path.exists(img_path):
+            continue
+        ref_img = REF_PREFIX + img
+        link_file(os.path.abspath(img_path), ref_img, link=link)
+        with open(path) as src:
+            content = src.read()
+        content = calib_pattern.sub(r'<FileInterne>%s/\1</FileInterne>' % out_ori, content)
+        with open(os.path.join(out_ori, 'Orientation-%s.xml' % ref_img), 'w') as dst:
+            dst.write(content)
+        img_list.append(ref_img)
+    return img_list
+
+
+def merge_ori_dirs(src_dirs, dst_dir, pattern='Orientation-*.xml'):
+    """Gather the orientation files of several orientation directories
+
+    Files are linked (see ``micamac.ori_utils.link_file``); in case of duplicates
+    the last directory wins
+
+    Return:
+        int: Number of orientation files in ``dst_dir``
+    """
+    if not os.path.exists(dst_dir):
+        os.makedirs(dst_dir)
+    names = set()
+    for src_dir in src_dirs:
+        for path in glob.glob(os.path.join(src_dir, pattern)):
+            name = os.path.basename(path)
+            link_file(path, os.path.join(dst_dir, name))
+            names.add(name)
+    return len(names)
+
+
+def read_pairs(path):
+    """Read the image pairs of a MicMac pairs file (e.g. ``FileImagesNeighbour.xml``)
+
+    Return:
+        list: List of (image, image) tuples
+    """
+    root = ET.parse(path).getroot()
+    return [tuple(x.text.split()) for x in root.iter('Cple')]
+
+
+def write_pairs(pairs, path):
+    """Write image pairs to a MicMac pairs file, usable with ``Tapioca File``
+    """
+    with open(path, 'w') as dst:
+        dst.write('<?xml version="1.0" ?>\n<SauvegardeNamedRel>\n')
+        for a, b in pairs:
+            dst.write('     <Cple>%s %s</Cple>\n' % (a, b))
+        dst.write('</SauvegardeNamedRel>\n')
+
+
+def footprint_pairs(transforms, ref_transforms, width, height, min_overlap=0.2):
+    """Pairs of overlapping footprints between two sets of images
+
+    Args:
+        transforms (list): Footprint transforms of the new images, see
+            ``micamac.thinning.image_footprints``
+        ref_transforms (list): Footprint transforms of the reference images
+        width (int): Image width
+        height (int): Image height
+        min_overlap (float): Minimum intersection area of two footprints,
+            relative to the smallest one
+
+    Return:
+        list: List of (index, reference index) tuples
+    """
+    corners = [(0, 0), (width, 0), (width, height), (0, height)]
+    polygons = [Polygon([aff * c for c in corners]) for aff in transforms]
+    ref_polygons = [Polygon([aff * c for c in corners]) for aff in ref_transforms]
+    ref_bounds = footprint_bounds(ref_transforms, width, height)
+    out = []
+    for i, poly in enumerate(polygons):
+        xmin, ymin, xmax, ymax = poly.bounds
+        candidates = np.flatnonzero((ref_bounds[:, 0] <= xmax) & (ref_bounds[:, 2] >= xmin)
+                                    & (ref_bounds[:, 1] <= ymax) & (ref_bounds[:, 3] >= ymin))
+        for j in candidates:
+            ref_poly = ref_polygons[j]
+            area = poly.intersection(ref_poly).area
+            if area >= min_overlap * min(poly.area, ref_poly.area):
+                out.append((i, int(j)))
+    return out
+
+
+def reference_pairs(img_list, ref_list, utm_zone, flight_height, min_overlap=0.2,
+                    ncores=4):
+    """Image pairs between a new flight and the reference images it overlaps
+
+    Footprints are estimated independently for both flights (see
+    ``micamac.thinning.image_footprints``), so that a GPS altitude offset between
+    the two flights does not bias them
+
+    Args:
+        img_list (list): Panchromatic images of the new flight
+        ref_list (list): Reference images, see ``link_reference``
+        utm_zone (int): Utm zone of the project
+        flight_height (float): Flight height above ground (m) of both flights
+        min_overlap (float): See ``footprint_pairs``
+        ncores (int): Number of processes used to read the image metadata
+
+    Return:
+        list: List of (image, reference image) tuples
+    """
+    if not img_list or not ref_list:
+        return []
+    _, transforms, width, height, _ = image_footprints(img_list, utm_zone, flight_height,
+                                                       ncores=ncores)
+    _, ref_transforms, _, _, _ = image_footprints(ref_list, utm_zone, flight_height,
+                                                  ncores=ncores)
+    return [(img_list[i], ref_list[j])
+            for i, j in footprint_pairs(transforms, ref_transforms, width, height,
+                                        min_overlap=min_overlap)]
@@ -0,0 +1,314 @@
+import os
+import json
+import time
+import sys
+import datetime
+import resource
+import threading
+
+
+def available_memory():
+    """Memory available for new processes, in bytes
+
+    Read from ``/proc/meminfo`` (MemAvailable) on Linux, falls back to the
+    amount of free physical pages otherwise
+    """
+    try:
+        with open('/proc/meminfo') as src:
+            for line in src:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+
+
+def peak_children_rss():
+    """Largest resident set size reached by a terminated child process, in bytes
+
+    Includes grandchildren (e.g. mm3d processes started by pool workers) once
+    they have been waited for
+    """
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+
+
+def descendants_rss(pid=None):
+    """Current resident set size of all descendants of a process, in bytes
+
+    Read from ``/proc`` (Linux); children, grandchildren (e.g. mm3d processes
+    started by pool workers) and so on are summed
+
+    Args:
+        pid (int): Process id, defaults to the current process
+
+    Return:
+        int: The summed resident set size, ``None`` when ``/proc`` is not available
+    """
+    pid = pid or os.getpid()
+    if not os.path.isdir('/proc'):
+        return None
+    children = {}
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % name) as src:
+                # The command name may contain spaces, fields follow its closing parenthesis
+                ppid = int(src.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(name))
+    total = 0
+    stack = list(children.get(pid, []))
+    while stack:
+        child = stack.pop()
+        stack += children.get(child, [])
+        try:
+            with open('/proc/%d/status' % child) as src:
+                for line in src:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+                        break
+        except OSError:
+            continue
+    return total
+
+
+class PeakMemoryMonitor(object):
+    """Sample the summed memory of the descendants of the current process in a
+    background thread, to measure the peak of concurrently running processes
+
+    Unlike ``peak_children_rss``, which is the peak of the largest single child,
+    this is comparable with the memory planned for processes running together.
+    Use as a context manager; the peak is then available as ``peak`` (bytes,
+    ``None`` when ``/proc`` is not available)
+
+    Args:
+        interval (float): Sampling interval in seconds
+    """
+    def __init__(self, interval=0.5):
+        self.interval = interval
+        self.peak = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def sample(self):
+        rss = descendants_rss()
+        if rss is not None:
+            self.peak = max(self.peak or 0, rss)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def __enter__(self):
+        self.sample()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop.set()
+        self._thread.join()
+
+
+def disk_usage(path):
+    """Disk space used by the files of a directory tree, in bytes
+
+    Hard linked files are counted once and symbolic links are not followed
+    """
+    total = 0
+    seen = set()
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                st = os.lstat(os.path.join(root, name))
+            except OSError:
+                continue
+            if st.st_nlink > 1:
+                if (st.st_dev, st.st_ino) in seen:
+                    continue
+                seen.add((st.st_dev, st.st_ino))
+            total += st.st_blocks * 512
+    return total
+
+
+def format_bytes(n):
+    """Human readable size
+    """
+    for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
+        if abs(n) < 1024 or unit == 'TB':
+            return '%.1f %s' % (n, unit)
+        n /= 1024.0
+
+
+class StepTimer(object):
+    """Record the wall clock time of the successive steps of a workflow
+
+    The report is rewritten every time a step starts or ends, so that progress
+    can be followed (e.g. by ``micamac.service``) while the workflow runs
+
+    Every completed step also records the peak memory of child processes and,
+    when ``disk_path`` is set, the disk usage of that directory at its end
+
+    Args:
+        path (str): Optional json file where the report is written
+        disk_path (str): Optional directory whose disk usage is recorded
+        on_stop (callable): Optional function called with the step name when a
+            step ends, after its disk usage was recorded, and returning the
+            number of bytes it freed (e.g. ``micamac.micmac_utils.release_artifacts``)
+    """
+    def __init__(self, path=None, disk_path=None, on_stop=None):
+        self.path = path
+        self.disk_path = disk_path
+        self.on_stop = on_stop
+        self.steps = []
+        self.current = None
+        self.notes = {}
+        self.start = time.time()
+        self.disk_start = disk_usage(disk_path) if disk_path else None
+
+    def step(self, name, **notes):
+        """End the current step (if any) and start a new one
+
+        Keyword arguments are added to the record of the step, see ``note``
+        """
+        self.stop()
+        self.current = (name, time.time())
+        self.notes = notes
+        self.write()
+
+    def note(self, **kwargs):
+        """Add json serializable values to the record of the current step
+
+        E.g. ``cached=True`` for a step whose artifacts were restored from cache
+        """
+        self.notes.update(kwargs)
+
+    def stop(self):
+        """End the current step
+        """
+        if self.current is None:
+            return
+        name, t0 = self.current
+        step = {'name': name, 'start': t0, 'duration': time.time() - t0,
+                'peak_rss': peak_children_rss()}
+        if self.disk_path:
+            step['disk'] = disk_usage(self.disk_path)
+        if self.on_stop is not None:
+            step['released'] = self.on_stop(name)
+        step.update(self.notes)
+        self.steps.append(step)
+        self.current = None
+        self.notes = {}
+        self.write()
+
+    def report(self):
+        """Return:
+            dict: Completed ``steps``, name of the ``current`` step, ``elapsed``
+            time, disk usage at start (``disk_start``), largest disk usage at the
+            end of a step (``disk_peak``, with its ``disk_peak_step``) and after
+            the last completed step (``disk_final``)
+        """
+        out = {'steps': self.steps,
+               'current': self.current[0] if self.current else None,
+               'elapsed': time.time() - self.start,
+               'disk_start': self.disk_start}
+        disk_steps = [x for x in self.steps if 'disk' in x]
+        if disk_steps:
+            peak = max(disk_steps, key=lambda x: x['disk'])
+            out['disk_peak'] = peak['disk']
+            out['disk_peak_step'] = peak['name']
+            out['disk_final'] = disk_steps[-1]['disk'] - disk_steps[-1].get('released', 0)
+        return out
+
+    def write(self):
+        if self.path is None:
+            return
+        dirname = os.path.dirname(self.path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        with open(self.path, 'w') as dst:
+            json.dump(self.report(), dst, indent=2)
+
+
+class ProgressMeter(object):
+    """Follow the processing of a stream of items, with a live progress line
+
+    Every result is a dict of per phase durations (in seconds), optionally with
+    the number of ``bytes`` written and a ``valid`` flag (items skipped without
+    processing are excluded from the phase means), as returned by
+    ``micamac.micasense_utils.capture_to_files``
+
+    Args:
+        total (int): Number of items expected
+        phases (list): Names of the timed phases
+        unit (str): Name of the items in the progress line
+        interval (float): Minimum time between progress line updates, in seconds
+        stream (file): Where the progress line is written (stdout when ``None``)
+    """
+    def __init__(self, total, phases, unit='items', interval=1.0, stream=None):
+        self.total = total
+        self.phases = list(phases)
+        self.unit = unit
+        self.interval = interval
+        self.stream = stream
+        self.results = []
+        self.bytes = 0
+        self.start = time.time()
+        self.last_print = 0
+
+    def update(self, result):
+        """Record the result of an item and refresh the progress line
+        """
+        self.results.append(result)
+        self.bytes += result.get('bytes', 0)
+        now = time.time()
+        if now - self.last_print >= self.interval or len(self.results) == self.total:
+            self.last_print = now
+            self.print_line(now)
+
+    def print_line(self, now=None):
+        elapsed = (now or time.time()) - self.start
+        done = len(self.results)
+        rate = done / elapsed if elapsed > 0 else 0
+        eta = (self.total - done) / rate if rate > 0 else float('nan')
+        line = '\r%d/%d %s, %.2f %s/s, %.1f MB/s, ETA %s' % (
+            done, self.total, self.unit, rate, self.unit, self.bytes / 1024.0 ** 2 / max(elapsed, 1e-9),
+            datetime.timedelta(seconds=int(eta)) if eta == eta else '--:--:--')
+        stream = self.stream or sys.stdout
+        stream.write(line + ('\n' if done == self.total else ''))
+        stream.flush()
+
+    def report(self):
+        """Return:
+            dict: Number of items (``n_items``, ``n_valid``), ``elapsed`` time, throughput (``items_per_s``,
+            ``mb_per_s``) and per phase ``total``, ``mean`` and ``share`` of the
+            summed phase times, plus the ``items`` results
+        """
+        elapsed = time.time() - self.start
+        phases = {}
+        n_valid = len([x for x in self.results if x.get('valid', True)])
+        grand_total = sum(sum(x.get(p, 0) for x in self.results) for p in self.phases)
+        for phase in self.phases:
+            total = sum(x.get(phase, 0) for x in self.results)
+            phases[phase] = {'total': total,
+                             'mean': total / n_valid if n_valid else 0,
+                             'share': total / grand_total if grand_total else 0}
+        return {'n_items': len(self.results),
+                'n_valid': n_valid,
+                'elapsed': elapsed,
+                'items_per_s': len(self.results) / elapsed if elapsed else 0,
+                'bytes': self.bytes,
+                'mb_per_s': self.bytes / 1024.0 ** 2 / elapsed if elapsed else 0,
+                'phases': phases,
+                'items': self.results}
+
+    def write(self, path, **extra):
+        """Write the report (see ``report``) to a json file, with optional extra keys
+        """
+        out = self.report()
+        out.update(extra)
+        with open(path, 'w') as dst:
+            json.dump(out, dst, indent=2)
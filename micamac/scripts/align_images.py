@@ -15,27 +15,33 @@ import glob
 import random
 import argparse
 import multiprocessing as mp
-import functools
 import tempfile
 import json
+import threading
 
 import numpy as np
 import matplotlib.pyplot as plt
 import exiftool
 import fiona
-from shapely.geometry import mapping, shape
+from shapely.geometry import shape
 from flask import Flask, render_template, jsonify, request, session
 
 from micasense import imageutils
 import micasense.imageset as imageset
 
-from micamac.micasense_utils import capture_to_point, capture_to_files
-from micamac.flask_utils import shutdown_server
+from micamac.micasense_utils import capture_to_point, points_to_fc
+from micamac.micasense_utils import write_capture_index, capture_job_to_files
+from micamac.flask_utils import serve_until
+from micamac.resource_utils import StepTimer, ProgressMeter
+from micamac.profile_utils import profiled, enable_profiling, merge_profiles
 from micamac.sixs import modeled_irradiance_from_capture
 
 
 app = Flask(__name__, template_folder='../../templates')
 POLYGONS = []
+POLYGON_RECEIVED = threading.Event()
+# Timed phases of the processing of every capture, see capture_to_files
+PHASES = ['decode', 'reflectance', 'align', 'check', 'write', 'exif']
 
 
 @app.route('/')
@@ -50,7 +56,7 @@ def index():
 def post_polygon():
     content = request.get_json(silent=True)
     POLYGONS.append(content)
-    shutdown_server()
+    POLYGON_RECEIVED.set()
     return jsonify('Bye')
 
 
@@ -64,51 +70,12 @@ def float_or_str(value):
         return value
 
 
-def main(img_dir, out_dir, alt_thresh, ncores, start_count, scaling,
-         irradiance, subset, layer, resolution):
-    # Create output dir it doesn't exist yet
-    if not os.path.exists(out_dir):
-        os.makedirs(out_dir)
-    # Load all images as imageset
-    imgset = imageset.ImageSet.from_directory(img_dir)
-    meta_list = imgset.as_nested_lists()
-    # Make feature collection of image centers and write it to tmp file
-    point_list = [capture_to_point(c) for c in imgset.captures]
-    feature_list = [{'type': 'Feature',
-                     'properties': {},
-                     'geometry': mapping(x)}
-                    for x in point_list]
-    fc = {'type': 'FeatureCollection',
-          'features': feature_list}
-
-    ###########################
-    #### Optionally cut a spatial subset of the images
-    ##########################
-    if subset == 'interactive':
-        # Write feature collection to tmp file, to make it accessible to the flask app
-        # without messing up with the session context
-        fc_tmp_file = os.path.join(tempfile.gettempdir(), 'micamac_fc.geojson')
-        with open(fc_tmp_file, 'w') as dst:
-            json.dump(fc, dst)
-        # Select spatial subset interactively (available as feature in POLYGONS[0])
-        app.run(debug=False, host= '0.0.0.0')
-        # Check which images intersect with the user defined polygon (list of booleans)
-        poly_shape = shape(POLYGONS[0]['geometry'])
-        in_polygon = [x.intersects(poly_shape) for x in point_list]
-        print('Centroid of drawn polygon: %s' % poly_shape.centroid.wkt)
-    elif subset is None:
-        in_polygon = [True for x in point_list]
-    elif os.path.exists(subset):
-        with fiona.open(subset, layer) as src:
-            poly_shape = shape(src[0]['geometry'])
-        in_polygon = [x.intersects(poly_shape) for x in point_list]
-        print('Centroid of supplied polygon: %s' % poly_shape.centroid.wkt)
-    else:
-        raise ValueError('--subset must be interactive, the path to an OGR file or left empty')
+def altitude_filter(meta_list, alt_thresh):
+    """Threshold captures on altitude, asking for the threshold when ``alt_thresh`` is interactive
 
-    ##################################
-    ### Threshold on altitude
-    ##################################
+    Return:
+        list: List of booleans, True for captures above the threshold
+    """
     if alt_thresh == 'interactive':
         alt_arr = np.array([x[3] for x in meta_list[0]])
         n, bins, patches = plt.hist(alt_arr, 100)
@@ -118,18 +85,19 @@ def main(img_dir, out_dir, alt_thresh, ncores, start_count, scaling,
         # Ask user for alt threshold
         alt_thresh = input('Enter altitude threshold:')
         alt_thresh = float(alt_thresh)
-        above_alt = [x[3] > alt_thresh for x in meta_list[0]]
+        return [x[3] > alt_thresh for x in meta_list[0]]
     elif isinstance(alt_thresh, float):
-        above_alt = [x[3] > alt_thresh for x in meta_list[0]]
+        return [x[3] > alt_thresh for x in meta_list[0]]
     else:
         raise ValueError('--alt_thresh argument must be a float or interactive')
 
-    # Combine both boolean lists (altitude and in_polygon)
-    is_valid = [x and y for x,y in zip(above_alt, in_polygon)]
 
-    #########################
-    ### Optionally retrieve irradiance values
-    #########################
+def get_irradiance(imgset, irradiance):
+    """Retrieve irradiance values of a flight (see --irradiance)
+
+    Return:
+        tuple: (img_type, irradiance_list) to pass to ``capture_to_files``
+    """
     if irradiance == 'panel':
         # Trying first capture, then last if doesn't work
         try:
@@ -169,13 +137,16 @@ def main(img_dir, out_dir, alt_thresh, ncores, start_count, scaling,
         irradiance_list = None
     else:
         raise ValueError('Incorrect value for --reflectance, must be panel, dls or left empty')
+    return img_type, irradiance_list
 
 
-    #########################
-    ### Alignment parameters
-    #########################
-    # Select an arbitrary image, find warping and croping parameters, apply to image,
-    # assemble a rgb composite to perform visual check
+def get_alignment(imgset, yes):
+    """Find bands warping and cropping parameters of a flight, with visual check unless ``yes``
+
+    Return:
+        dict: ``warp_matrices``, ``warp_mode``, ``cropped_dimensions`` and
+        ``match_index`` arguments of ``capture_to_files``
+    """
     alignment_confirmed = False
     while not alignment_confirmed:
         warp_cap_ind = random.randint(1, len(imgset.captures) - 1)
@@ -188,6 +159,8 @@ def main(img_dir, out_dir, alt_thresh, ncores, start_count, scaling,
         cropped_dimensions, edges = imageutils.find_crop_bounds(warp_cap, warp_matrices)
         warp_mode = alignment_pairs[0]['warp_mode']
         match_index = alignment_pairs[0]['ref_index']
+        if yes:
+            break
         # Apply warping and cropping to the Capture used for finding the parameters to
         # later perform a visual check
         im_aligned = imageutils.aligned_capture(warp_cap, warp_matrices, warp_mode,
@@ -211,25 +184,124 @@ Are all bands properly aligned? (y/n)
             alignment_confirmed = True
         else:
             print('Trying another image')
+    return {'warp_matrices': warp_matrices,
+            'warp_mode': warp_mode,
+            'cropped_dimensions': cropped_dimensions,
+            'match_index': match_index}
+
+
+def main(img_dir, out_dir, alt_thresh, ncores, start_count, scaling,
+         irradiance, subset, layer, resolution, yes, max_residual, on_misaligned):
+    if len(irradiance) not in [1, len(img_dir)]:
+        raise ValueError('--irradiance must be set once, or once per input directory')
+    if len(irradiance) == 1:
+        irradiance = irradiance * len(img_dir)
+    irradiance = [None if x in [None, 'none', 'None'] else x for x in irradiance]
+    # Create output dir it doesn't exist yet
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    timer = StepTimer(os.path.join(out_dir, 'steps.json'))
+    timer.step('load')
+    # Load all images of every flight as imagesets
+    imgset_list = [imageset.ImageSet.from_directory(x) for x in img_dir]
+    # Make feature collection of image centers and write it to tmp file
+    point_list = [capture_to_point(c) for imgset in imgset_list for c in imgset.captures]
+    fc = points_to_fc(point_list)
+    timer.step('subset')
+
+    ###########################
+    #### Optionally cut a spatial subset of the images (one area of interest for all flights)
+    ##########################
+    if subset == 'interactive':
+        # Write feature collection to tmp file, to make it accessible to the flask app
+        # without messing up with the session context
+        fc_tmp_file = os.path.join(tempfile.gettempdir(), 'micamac_fc.geojson')
+        with open(fc_tmp_file, 'w') as dst:
+            json.dump(fc, dst)
+        # Select spatial subset interactively (available as feature in POLYGONS[0])
+        serve_until(app, POLYGON_RECEIVED, host='0.0.0.0')
+        # Check which images intersect with the user defined polygon (list of booleans)
+        poly_shape = shape(POLYGONS[0]['geometry'])
+        in_polygon = [x.intersects(poly_shape) for x in point_list]
+        print('Centroid of drawn polygon: %s' % poly_shape.centroid.wkt)
+    elif subset is None:
+        in_polygon = [True for x in point_list]
+    elif os.path.exists(subset):
+        with fiona.open(subset, layer) as src:
+            poly_shape = shape(src[0]['geometry'])
+        in_polygon = [x.intersects(poly_shape) for x in point_list]
+        print('Centroid of supplied polygon: %s' % poly_shape.centroid.wkt)
+    else:
+        raise ValueError('--subset must be interactive, the path to an OGR file or left empty')
+
+    ##################################
+    ### Per flight altitude threshold, irradiance and alignment parameters
+    ##################################
+    # Captures are numbered continuously across flights
+    flights = []
+    first_count = start_count
+    for flight_dir, imgset, flight_irradiance in zip(img_dir, imgset_list, irradiance):
+        print('Flight %s: %d captures' % (flight_dir, len(imgset.captures)))
+        timer.step('altitude')
+        above_alt = altitude_filter(imgset.as_nested_lists(), alt_thresh)
+        timer.step('irradiance')
+        img_type, irradiance_list = get_irradiance(imgset, flight_irradiance)
+        # Select an arbitrary image, find warping and croping parameters, apply to image,
+        # assemble a rgb composite to perform visual check
+        timer.step('alignment')
+        process_kwargs = get_alignment(imgset, yes)
+        process_kwargs.update(out_dir=out_dir,
+                              irradiance_list=irradiance_list,
+                              img_type=img_type,
+                              resolution=resolution,
+                              scaling=scaling,
+                              max_residual=max_residual,
+                              on_misaligned=on_misaligned)
+        flights.append({'img_dir': flight_dir,
+                        'captures': imgset.captures,
+                        'above_alt': above_alt,
+                        'first_count': first_count,
+                        'process_kwargs': process_kwargs})
+        first_count += len(imgset.captures)
 
     ##################
     ### Processing
     #################
-    # Build iterator of captures
-    cap_tuple_iterator = zip(imgset.captures, is_valid,
-                             range(start_count, len(is_valid) + start_count))
-    process_kwargs = {'warp_matrices': warp_matrices,
-                      'warp_mode': warp_mode,
-                      'cropped_dimensions': cropped_dimensions,
-                      'match_index': match_index,
-                      'out_dir': out_dir,
-                      'irradiance_list': irradiance_list,
-                      'img_type': img_type,
-                      'resolution': resolution,
-                      'scaling': scaling}
-    # Run process function with multiprocessing
-    pool = mp.Pool(ncores)
-    pool.map(functools.partial(capture_to_files, **process_kwargs), cap_tuple_iterator)
+    # Build iterator of (capture tuple, processing arguments) of all flights, so that
+    # a single pool keeps busy across flight boundaries
+    jobs = []
+    for flight in flights:
+        n = len(flight['captures'])
+        # Combine both boolean lists (altitude and in_polygon)
+        flight_in_polygon = in_polygon[flight['first_count'] - start_count:][:n]
+        is_valid = [x and y for x,y in zip(flight['above_alt'], flight_in_polygon)]
+        cap_tuples = zip(flight['captures'], is_valid,
+                         range(flight['first_count'], flight['first_count'] + n))
+        jobs.extend((x, flight['process_kwargs']) for x in cap_tuples)
+    # Run process function with multiprocessing, results are streamed back as captures
+    # complete to report progress and per phase timings
+    timer.step('processing')
+    meter = ProgressMeter(total=len(jobs), phases=PHASES, unit='captures')
+    with mp.Pool(ncores) as pool:
+        for result in pool.imap_unordered(profiled(capture_job_to_files), jobs):
+            meter.update(result)
+    meter.write(os.path.join(out_dir, 'processing.json'), ncores=ncores,
+                flights=[{'img_dir': x['img_dir'],
+                          'first_count': x['first_count'],
+                          'n_captures': len(x['captures']),
+                          'img_type': x['process_kwargs']['img_type']} for x in flights])
+    timer.stop()
+    report = meter.report()
+    write_capture_index(report['items'], point_list, os.path.join(out_dir, 'captures.csv'),
+                        start_count=start_count)
+    status = [x['status'] for x in report['items'] if x['valid']]
+    if max_residual is not None:
+        print('Band registration: %d captures over %.1f pixels residual (%d realigned, %d skipped, %d flagged); see captures.csv'
+              % (len([x for x in status if x != 'ok']), max_residual, status.count('realigned'),
+                 status.count('skipped'), status.count('flagged')))
+    print('Processed %d captures (%.2f captures/s, %.1f MB/s); time per capture: %s'
+          % (report['n_valid'], report['items_per_s'], report['mb_per_s'],
+             ', '.join('%s %.2f s' % (k, report['phases'][k]['mean']) for k in PHASES)))
 
 
 if __name__ == '__main__':
@@ -241,6 +313,14 @@ Process set of micasense rededge images from a flight. Performs:
       either panel capture or DLS.
     - Write 6 single band geotiff in UInt16 for each capture (panchromatique + 5 rededge bands)
 
+Processing progress (captures/s, MB/s written, ETA) is displayed live, and the
+per capture time spent decoding, computing reflectance, aligning, writing and
+tagging images is written to processing.json in the output directory
+
+The registration of the bands is checked on every capture (residual shift of every
+band relative to the reference band, in pixels), and written with the capture status
+to captures.csv in the output directory
+
 The cli requires plotting capabilities for user confirmation, so X-window must
 be enabled when working over ssh
 
@@ -254,6 +334,15 @@ align_images.py --help
 
 # Process the whole directory, to reflectance, with interactive drawing of AOI
 align_images.py -i /path/to/images -o /path/to/output/dir -irr panel -subset interactive -n 40
+
+# Same, re-aligning the captures whose bands are more than 2 pixels apart
+align_images.py -i /path/to/images -o /path/to/output/dir -irr panel -subset interactive -n 40 -maxres 2 -misaligned realign
+
+# Two flights over the same site, numbered continuously, panels for the first one and DLS for the second
+align_images.py -i /path/to/flight1 /path/to/flight2 -o /path/to/output/dir -irr panel dls -subset interactive -n 40
+
+# Same, profiling the workers to find which processing phase is slowest
+align_images.py -i /path/to/images -o /path/to/output/dir -irr panel -subset interactive -n 40 --profile /tmp/prof
 """
     # Instantiate argparse parser
     parser = argparse.ArgumentParser(epilog=epilog,
@@ -263,7 +352,12 @@ align_images.py -i /path/to/images -o /path/to/output/dir -irr panel -subset int
     parser.add_argument('-i', '--img_dir',
                         required=True,
                         type=str,
-                        help='directory containing images (nested directories are fine)')
+                        nargs='+',
+                        help="""
+directory containing images (nested directories are fine). Several directories
+(e.g. flights over the same site) can be given; their captures are numbered
+continuously from --start_count and processed by a single pool, with per flight
+altitude threshold, irradiance and alignment parameters""")
 
     parser.add_argument('-o', '--out_dir',
                         required=True,
@@ -277,14 +371,17 @@ align_images.py -i /path/to/images -o /path/to/output/dir -irr panel -subset int
 
     parser.add_argument('-irr', '--irradiance',
                         type=str,
-                        default=None,
+                        nargs='+',
+                        default=[None],
                         help="""
-Way of retrieving irradiance values for computing reflectance:
+Way of retrieving irradiance values for computing reflectance, either once for all
+input directories (each flight uses its own panel captures, DLS or 6S values) or once
+per input directory:
     panel: Use reflectance panel. It is assumed that panel images are present in the
            first and/or the last image of the set
     dls: Use onboad Downwelling Light Sensor
     sixs: Model clear sky irradiance values using sixs radiative transfer modeling
-    None (leave empty): Reflectance is not computed and radiance images are returned instead
+    none (or leave empty): Reflectance is not computed and radiance images are returned instead
                         """)
 
     parser.add_argument('-subset', '--subset',
@@ -324,5 +421,48 @@ Expected ground resolution in meters. Not very important, only used for
                         type=int,
                         help='Number of first image processed (useful for merging several batches)')
 
+    parser.add_argument('-maxres', '--max-residual',
+                        default=None,
+                        type=float,
+                        help='Band registration residual (pixels) above which a capture is considered misaligned')
+
+    parser.add_argument('-misaligned', '--on-misaligned',
+                        default='flag',
+                        choices=['flag', 'realign', 'skip'],
+                        help="""
+What to do with captures over --max-residual:
+    flag: Write them anyway, only mark them in captures.csv (default)
+    realign: Estimate warp matrices for that capture, and keep them if they do better
+    skip: Do not write them""")
+
+    parser.add_argument('-y', '--yes',
+                        action='store_true',
+                        help='Skip the visual check of bands alignment (non interactive runs)')
+
+    parser.add_argument('-profile', '--profile',
+                        default=None,
+                        type=str,
+                        help="""
+Optional directory where profiles of this process and of its capture processing workers
+are written and merged at the end of the run (see micamac.profile_utils). Profiling
+can also be enabled by setting the MICAMAC_PROFILE environment variable""")
+
+    parser.add_argument('-pmode', '--profile-mode',
+                        default='cprofile',
+                        choices=['cprofile', 'sample'],
+                        help="""
+    cprofile: Deterministic cProfile statistics (.prof and .txt summary)
+    sample: Low overhead sampling of the stacks, written as flamegraph compatible collapsed stacks (.folded)""")
+
     parsed_args = parser.parse_args()
-    main(**vars(parsed_args))
+    kwargs = vars(parsed_args)
+    profile = kwargs.pop('profile')
+    profile_mode = kwargs.pop('profile_mode')
+    if profile is not None:
+        # Resolved once, so that the merge does not depend on the working
+        # directory at the end of the run
+        profile = os.path.abspath(profile)
+        enable_profiling(profile, mode=profile_mode)
+    profiled(main, 'align_images')(**kwargs)
+    if profile is not None:
+        print('Profiles written to %s' % ', '.join(merge_profiles(profile)))
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+
+from micamac.indices import compute_indices, find_malt_mask, INDICES
+
+
+def main(img_dir, src, dst, indices, expression, scaling, mask, ncores):
+    os.chdir(img_dir)
+    index_dict = {name: INDICES[name.lower()] for name in indices}
+    for expr in expression:
+        name, value = expr.split('=', 1)
+        index_dict[name] = value
+    if not index_dict:
+        raise ValueError('You must select at least one index with --indices or --expression')
+    # Malt correlation mask of the project, in addition to the pixels outside of the Tawny mosaic
+    mask_paths = [x for x in mask if x != 'auto']
+    if 'auto' in mask:
+        malt_mask = find_malt_mask()
+        if malt_mask is not None:
+            mask_paths.append(malt_mask)
+    print('Computing %s' % ', '.join('%s = %s' % x for x in index_dict.items()))
+    if mask_paths:
+        print('Masks: %s' % ', '.join(mask_paths))
+    compute_indices(src, dst, indices=index_dict, scaling=scaling,
+                    ncores=ncores, mask_paths=mask_paths)
+
+
+if __name__ == '__main__':
+    epilog = """
+Compute spectral indices from the multiband orthomosaic of a finished project
+Indices are written as bands of a float32 Cloud Optimized GeoTiff; pixels outside
+of the Tawny mosaic or of the Malt correlation mask are set to nan
+
+Example usage:
+--------------
+# Display help
+compute_indices.py --help
+
+# NDVI and NDRE, plus a custom expression
+compute_indices.py -i /path/to/images --indices ndvi ndre --expression "sr=nir / red"
+
+# Custom expression using numpy
+compute_indices.py -i /path/to/images --indices --expression "sr=np.where(red > 0, nir / red, 0)"
+"""
+    # Instantiate argparse parser
+    parser = argparse.ArgumentParser(epilog=epilog,
+                                     formatter_class=argparse.RawTextHelpFormatter)
+
+    # parser arguments
+    parser.add_argument('-i', '--img_dir',
+                        required=True,
+                        type=str,
+                        help='directory containing images')
+
+    parser.add_argument('-src', '--src',
+                        default='OUTPUT/ortho.tif',
+                        type=str,
+                        help='Multiband orthomosaic, relative to img_dir')
+
+    parser.add_argument('-dst', '--dst',
+                        default='OUTPUT/indices.tif',
+                        type=str,
+                        help='Output file, relative to img_dir')
+
+    parser.add_argument('-indices', '--indices',
+                        nargs='*',
+                        default=['ndvi', 'ndre', 'gndvi'],
+                        choices=sorted(INDICES.keys()),
+                        help='Predefined indices to compute')
+
+    parser.add_argument('-expr', '--expression',
+                        action='append',
+                        default=[],
+                        help='Additional index as name=expression, using blue, green, red, nir and edge as variables. Can be repeated')
+
+    parser.add_argument('-scaling', '--scaling',
+                        type=float,
+                        default=60000,
+                        help='Scaling factor used when running align_images.py')
+
+    parser.add_argument('-mask', '--mask',
+                        nargs='*',
+                        default=['auto'],
+                        help="""
+Mask rasters (0 is nodata), resampled to the orthomosaic grid. auto (default) uses
+the finest MEC-Malt/Masq_STD-MALT_DeZoom*.tif of the project when it exists; pass
+--mask without value to only mask the pixels outside of the mosaic""")
+
+    parser.add_argument('-n', '--ncores',
+                        default=8,
+                        type=int,
+                        help='Number of threads used to process blocks')
+
+    parsed_args = parser.parse_args()
+    main(**vars(parsed_args))
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import json
+
+from micamac.homol_utils import homol_report
+from micamac.micmac_utils import prune_images, update_poubelle
+
+
+def main(img_dir, homol_dir, min_points, min_links, prune, json_report):
+    os.chdir(img_dir)
+    report = homol_report(homol_dir, min_points=min_points, min_links=min_links)
+
+    for img in report['images']:
+        print('%s: %d tie points, %d links, component %d' % (img['name'],
+                                                             img['tie_points'],
+                                                             img['links'],
+                                                             img['component']))
+    print('Connected components (sizes): %s' % report['components'])
+    print('%d weak links (< %d tie points)' % (len(report['weak_links']), min_points))
+    print('Weak images: %s' % ', '.join(report['weak_images']))
+
+    if json_report is not None:
+        with open(json_report, 'w') as dst:
+            json.dump(report, dst, indent=2)
+
+    if prune:
+        prune_images(report['weak_images'])
+        update_poubelle()
+
+
+if __name__ == '__main__':
+    epilog = """
+Tie points quality assessment of a micmac project. Reports per image tie points counts,
+connected components of the image graph and weak links
+
+Example usage:
+--------------
+# Display help
+homol_qa.py --help
+
+# Report on the Homol directory and move weak images (all bands) to Poubelle
+homol_qa.py -i /path/to/images --prune
+"""
+    # Instantiate argparse parser
+    parser = argparse.ArgumentParser(epilog=epilog,
+                                     formatter_class=argparse.RawTextHelpFormatter)
+
+    # parser arguments
+    parser.add_argument('-i', '--img_dir',
+                        required=True,
+                        type=str,
+                        help='directory containing images')
+
+    parser.add_argument('-homol', '--homol_dir',
+                        default='Homol',
+                        type=str,
+                        help='Homol directory, relative to img_dir (e.g. Homol_mini)')
+
+    parser.add_argument('-mtp', '--min_points',
+                        default=30,
+                        type=int,
+                        help='Minimum number of tie points for an image pair to count as a link')
+
+    parser.add_argument('-ml', '--min_links',
+                        default=2,
+                        type=int,
+                        help='Images with fewer links are reported as weak')
+
+    parser.add_argument('--prune',
+                        action='store_true',
+                        help='Move weak images of all bands to Poubelle')
+
+    parser.add_argument('-json', '--json_report',
+                        default=None,
+                        type=str,
+                        help='Optional path to a json file where the full report is written')
+
+    parsed_args = parser.parse_args()
+    main(**vars(parsed_args))
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+import argparse
+
+from micamac.service import create_app
+
+
+def main(host, port, max_jobs, max_queued, state_dir):
+    app = create_app(state_dir=state_dir, max_jobs=max_jobs, max_queued=max_queued)
+    try:
+        app.run(host=host, port=port, debug=False, threaded=True)
+    finally:
+        app.config['EXECUTOR'].shutdown(wait=False, cancel_futures=True)
+
+
+if __name__ == '__main__':
+    epilog = """
+Long running local service to queue align_images.py, run_micmac.py and rerun_tawny.py
+runs, follow their status and step timings and list their outputs, without
+starting a new command line for every flight
+
+Jobs run without a terminal, so align jobs must be non interactive (--yes,
+numeric --alt_thresh, --subset pointing to a file or left empty). The area of
+interest can be drawn beforehand with the /aoi endpoints
+
+Example usage:
+--------------
+# Display help
+micamac_service.py --help
+
+# Start the service, running two jobs at a time
+micamac_service.py --port 5000 --max-jobs 2
+
+# Draw an area of interest (open the returned url in a browser), then get the polygon file
+curl -X POST -H 'Content-Type: application/json' -d '{"img_dir": "/path/to/raw"}' localhost:5000/aoi
+curl localhost:5000/aoi/<aoi_id>/polygon
+
+# Submit runs
+curl -X POST -H 'Content-Type: application/json' \\
+    -d '{"command": "align", "args": ["-i", "/path/to/raw", "-o", "/path/to/images", "-alt", "100", "-subset", "/path/to/aoi.geojson", "--yes"]}' \\
+    localhost:5000/jobs
+curl -X POST -H 'Content-Type: application/json' \\
+    -d '{"command": "micmac", "args": ["-i", "/path/to/images", "--auto-subset", "40", "--utm", "33", "--ortho"]}' \\
+    localhost:5000/jobs
+
+# Follow a job (status and step timings), its log and outputs
+curl localhost:5000/jobs/<job_id>
+curl localhost:5000/jobs/<job_id>/log?tail=20
+curl localhost:5000/jobs/<job_id>/outputs
+"""
+    # Instantiate argparse parser
+    parser = argparse.ArgumentParser(epilog=epilog,
+                                     formatter_class=argparse.RawTextHelpFormatter)
+
+    # parser arguments
+    parser.add_argument('-host', '--host',
+                        default='127.0.0.1',
+                        type=str,
+                        help='Interface to listen on (0.0.0.0 to make the service reachable from other hosts)')
+
+    parser.add_argument('-p', '--port',
+                        default=5000,
+                        type=int,
+                        help='Port to listen on')
+
+    parser.add_argument('-n', '--max-jobs',
+                        default=1,
+                        type=int,
+                        help='Number of jobs running concurrently (each job uses its own --ncores)')
+
+    parser.add_argument('-mq', '--max-queued',
+                        default=8,
+                        type=int,
+                        help='Maximum number of jobs waiting to run; further submissions are refused')
+
+    parser.add_argument('-s', '--state-dir',
+                        default='~/.micamac_service',
+                        type=str,
+                        help='Directory where job records, logs and area of interest polygons are kept')
+
+    parsed_args = parser.parse_args()
+    main(**vars(parsed_args))
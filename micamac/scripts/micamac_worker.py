@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+
+import argparse
+
+from micamac.workqueue import run_worker, job_status
+
+
+def main(queue, lease, idle_timeout, status):
+    if status:
+        for job in job_status(queue):
+            print('%4d  %-10s  %-8s  attempts %d  %s' % (job['id'], job['kind'], job['status'],
+                                                         job['attempts'], job['worker'] or ''))
+        return
+    run_worker(queue, lease=lease, idle_timeout=idle_timeout)
+
+
+if __name__ == '__main__':
+    epilog = """
+Work queue worker for run_micmac.py jobs (per band Tawny, per tile processing)
+Start as many workers as wanted, on any host mounting the shared file system where
+the queue database and the project directories live (at the same paths)
+
+Example usage:
+--------------
+# Display help
+micamac_worker.py --help
+
+# Run jobs until the queue stays empty for one hour
+micamac_worker.py -q /shared/micamac_queue.sqlite --idle-timeout 3600
+
+# Show status of all jobs
+micamac_worker.py -q /shared/micamac_queue.sqlite --status
+"""
+    # Instantiate argparse parser
+    parser = argparse.ArgumentParser(epilog=epilog,
+                                     formatter_class=argparse.RawTextHelpFormatter)
+
+    # parser arguments
+    parser.add_argument('-q', '--queue',
+                        required=True,
+                        type=str,
+                        help='Path to the queue database')
+
+    parser.add_argument('-lease', '--lease',
+                        default=600,
+                        type=float,
+                        help='Job lease duration in seconds; jobs of workers that stop renewing it are re-queued')
+
+    parser.add_argument('-idle', '--idle-timeout',
+                        default=None,
+                        type=float,
+                        help='Exit after that many seconds without pending jobs (default: run forever)')
+
+    parser.add_argument('--status',
+                        action='store_true',
+                        help='Print the status of the jobs and exit')
+
+    parsed_args = parser.parse_args()
+    main(**vars(parsed_args))
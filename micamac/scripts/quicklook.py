@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+import argparse
+import time
+
+from micamac.quicklook import make_quicklook
+
+
+def main(img_dir, dst, utm, factor, resolution, altitude, ncores):
+    t0 = time.time()
+    info = make_quicklook(img_dir, dst, utm_zone=utm, factor=factor,
+                          resolution=resolution, altitude=altitude, ncores=ncores)
+    print('Quicklook of %d captures written to %s (UTM zone %d, %.2f m resolution) in %.0f s'
+          % (info['captures'], dst, info['utm_zone'], info['resolution'], time.time() - t0))
+
+
+if __name__ == '__main__':
+    epilog = """
+Build a low resolution preview mosaic of a raw RedEdge flight, to check coverage in
+the field before running align_images.py and run_micmac.py
+
+Captures are decimated and pasted in a UTM mosaic using their GPS position and DLS
+yaw only (no band alignment, tie points or terrain model); where captures overlap,
+the least oblique one (nearest to nadir) is kept. Expect positional errors of a few
+meters and visible seams, the preview is written as a 5 bands Cloud Optimized GeoTiff
+
+Example usage:
+--------------
+# Display help
+quicklook.py --help
+
+# Preview of a flight, at 1/8 of the original resolution
+quicklook.py -i /path/to/raw/images -o /path/to/quicklook.tif -n 8
+
+# Coarser and faster, for a very large flight, flown 120 m above ground
+quicklook.py -i /path/to/raw/images -o /path/to/quicklook.tif -f 16 -alt 120
+"""
+    # Instantiate argparse parser
+    parser = argparse.ArgumentParser(epilog=epilog,
+                                     formatter_class=argparse.RawTextHelpFormatter)
+
+    # parser arguments
+    parser.add_argument('-i', '--img_dir',
+                        required=True,
+                        type=str,
+                        help='directory containing raw images (nested directories are fine)')
+
+    parser.add_argument('-o', '--dst',
+                        required=True,
+                        type=str,
+                        help='Output file')
+
+    parser.add_argument('-utm', '--utm',
+                        default=None,
+                        type=int,
+                        help='UTM zone of the mosaic, derived from the capture positions by default')
+
+    parser.add_argument('-f', '--factor',
+                        default=8,
+                        type=int,
+                        help='Decimation factor of the captures')
+
+    parser.add_argument('-res', '--resolution',
+                        default=None,
+                        type=float,
+                        help='Resolution of the mosaic in meters, defaults to the ground size of a decimated pixel')
+
+    parser.add_argument('-alt', '--altitude',
+                        default=None,
+                        type=float,
+                        help="""
+Flight height above ground in meters, used to scale the captures. Defaults to the
+height above the lowest capture, usually the pre-flight panel capture""")
+
+    parser.add_argument('-n', '--ncores',
+                        default=4,
+                        type=int,
+                        help='Number of cores to use for multiprocessing')
+
+    parsed_args = parser.parse_args()
+    main(**vars(parsed_args))
@@ -8,8 +8,14 @@ import re
 import subprocess
 import multiprocessing as mp
 import functools as ft
+import itertools
+import hashlib
+import json
+import csv
 
-from micamac.micmac_utils import run_tawny
+from micamac.micmac_utils import run_tawny, mosaic_seam_score
+from micamac.export_utils import stack_to_cog, utm_crs
+from micamac.resource_utils import StepTimer
 
 
 COLORS = ['blue', 'green', 'red', 'nir', 'edge']
@@ -21,34 +27,148 @@ def tawny_runner(color, args):
                      'Ortho-%s' % color,
                      *args])
 
-def main(img_dir, filename_prefix, utm, **kwargs):
+
+def tawny_job(job):
+    """Run Tawny for a (color, args, out) tuple, for use in a multiprocessing map
+
+    The mosaic is written to a temporary name and only renamed to ``out`` once
+    Tawny succeeded, so that an interrupted sweep never leaves a partial output
+    that later runs would consider done
+    """
+    color, args, out = job
+    ortho_dir = 'Ortho-%s' % color
+    tmp_out = '%s.tmp.tif' % os.path.splitext(out)[0]
+    returncode = subprocess.call(['mm3d', 'Tawny', ortho_dir,
+                                  *args, 'Out=%s' % tmp_out])
+    if returncode != 0:
+        print('Tawny failed for %s (%s)' % (color, out))
+        return
+    for tmp_path, out_path in [(tmp_out, out),
+                               (tmp_out[:-4] + '.tfw', out[:-4] + '.tfw')]:
+        if os.path.exists(os.path.join(ortho_dir, tmp_path)):
+            os.replace(os.path.join(ortho_dir, tmp_path),
+                       os.path.join(ortho_dir, out_path))
+
+
+def format_value(v):
+    """Format a parameter value the way mm3d expects it (``[a,b]`` for lists)
+    """
+    if isinstance(v, (list, tuple)):
+        return '[%s]' % ','.join(str(x) for x in v)
+    return str(v)
+
+
+def parse_sweep(sweep):
+    """Parse ``NAME=v1,v2,...`` sweep specifications into a list of parameter dicts
+
+    Values of XY parameters are given as ``a:b``, e.g. ``DEqXY=1:1,2:2``
+    """
+    names = []
+    values = []
+    for spec in sweep:
+        name, value_str = spec.split('=', 1)
+        names.append(name)
+        values.append([[int(y) for y in x.split(':')] if ':' in x else x
+                       for x in value_str.split(',')])
+    return [dict(zip(names, combination)) for combination in itertools.product(*values)]
+
+
+def param_hash(params):
+    """Short, stable hash of a set of Tawny parameters
+    """
+    params_str = json.dumps({k: format_value(v) for k,v in params.items()},
+                            sort_keys=True)
+    return hashlib.sha1(params_str.encode('utf-8')).hexdigest()[:8]
+
+
+def main(img_dir, filename_prefix, utm, sweep, ncores, **kwargs):
     ## kwargs should contain:
         # RadiomEgal, DEq, DEqXY, AddCste, DegRap, DegRapXY, SzV
     # Filter unset
     tawny_kwargs = {k:v for k,v in kwargs.items() if v is not None}
 
-    Out = '%s.tif' % filename_prefix
-    tawny_kwargs['Out'] = Out
-
-    arg_list = ['{k}={v}'.format(k=k,v=v) for k,v in tawny_kwargs.items()]
-    print(arg_list)
-
     # Set workdir
     os.chdir(img_dir)
 
-    # Create output dir and run gdal_translate
+    # Create output dir
     if not os.path.exists('OUTPUT'):
         os.makedirs('OUTPUT')
-
-    # Run Tawny for every band
-    pool = mp.Pool(5)
-    pool.map(ft.partial(tawny_runner, args=arg_list),  COLORS)
-
-    for color in COLORS:
-        subprocess.call(['gdal_translate', '-a_srs',
-                         '+proj=utm +zone=%d +ellps=WGS84 +datum=WGS84 +units=m +no_defs' % utm,
-                         'Ortho-%s/%s.tif' % (color, filename_prefix),
-                         'OUTPUT/%s_%s.tif' % (filename_prefix, color)])
+    timer = StepTimer('OUTPUT/tawny_steps.json')
+
+    if not sweep:
+        tawny_kwargs['Out'] = '%s.tif' % filename_prefix
+        arg_list = ['{k}={v}'.format(k=k,v=format_value(v)) for k,v in tawny_kwargs.items()]
+        print(arg_list)
+
+        # Run Tawny for every band
+        timer.step('tawny')
+        pool = mp.Pool(5)
+        pool.map(ft.partial(tawny_runner, args=arg_list),  COLORS)
+
+        timer.step('export')
+        stack_to_cog(['Ortho-%s/%s.tif' % (color, filename_prefix) for color in COLORS],
+                     'OUTPUT/%s.tif' % filename_prefix, crs=utm_crs(utm), ncores=5,
+                     descriptions=COLORS)
+        timer.stop()
+        return
+
+    # Parameter sweep; every parameter set is identified by a hash used in the
+    # output names, so that combinations already produced are skipped
+    param_sets = []
+    for sweep_params in parse_sweep(sweep):
+        params = dict(tawny_kwargs)
+        params.update(sweep_params)
+        param_sets.append((param_hash(params), params))
+
+    jobs = []
+    for hash_str, params in param_sets:
+        out = '%s_%s.tif' % (filename_prefix, hash_str)
+        arg_list = ['{k}={v}'.format(k=k,v=format_value(v)) for k,v in params.items()]
+        jobs += [(color, arg_list, out) for color in COLORS
+                 if not os.path.exists(os.path.join('Ortho-%s' % color, out))]
+    print('Running %d Tawny jobs (%d parameter sets x %d bands, %d already done) on %d cores'
+          % (len(jobs), len(param_sets), len(COLORS),
+             len(param_sets) * len(COLORS) - len(jobs), ncores))
+    timer.step('tawny')
+    pool = mp.Pool(ncores)
+    pool.map(tawny_job, jobs, chunksize=1)
+    pool.close()
+    pool.join()
+
+    timer.step('export')
+    results = []
+    for hash_str, params in param_sets:
+        name = '%s_%s' % (filename_prefix, hash_str)
+        band_paths = ['Ortho-%s/%s.tif' % (color, name) for color in COLORS]
+        if not all(os.path.exists(x) for x in band_paths):
+            print('%s: Tawny failed for some bands, skipped' % name)
+            continue
+        dst = 'OUTPUT/%s.tif' % name
+        if not os.path.exists(dst):
+            tmp_dst = 'OUTPUT/%s.tmp.tif' % name
+            stack_to_cog(band_paths, tmp_dst, crs=utm_crs(utm), ncores=ncores,
+                         descriptions=COLORS)
+            os.replace(tmp_dst, dst)
+        scores = [mosaic_seam_score(path, 'Ortho-%s' % color)
+                  for color, path in zip(COLORS, band_paths)]
+        scores = [x for x in scores if x == x]
+        score = sum(scores) / len(scores) if scores else float('nan')
+        results.append((score, name, params))
+
+    # Ranked table, smoothest mosaic first (mosaics without seamline last)
+    results.sort(key=lambda x: (x[0] != x[0], x[0]))
+    param_names = sorted(set(k for _, _, params in results for k in params))
+    with open('OUTPUT/%s_sweep.csv' % filename_prefix, 'w', newline='') as dst:
+        writer = csv.writer(dst)
+        writer.writerow(['rank', 'seam_score', 'file'] + param_names)
+        for rank, (score, name, params) in enumerate(results, 1):
+            row = [rank, '%.5f' % score, 'OUTPUT/%s.tif' % name]
+            row += [format_value(params.get(k, '')) for k in param_names]
+            writer.writerow(row)
+            print('%2d  %.5f  %s  %s' % (rank, score, name,
+                                         ' '.join('%s=%s' % (k, format_value(v))
+                                                  for k,v in sorted(params.items()))))
+    timer.stop()
 
 
 if __name__ == '__main__':
@@ -63,6 +183,10 @@ Example usage:
 
 # With specific parameters
 ./rerun_tawny.py -i /path/to/images --utm 33 --filename-prefix ortho_zero_deq --DEq 0
+
+# Parameter sweep over 3 x 2 x 2 combinations on 20 cores, ranked by seam score
+./rerun_tawny.py -i /path/to/images --utm 33 --filename-prefix sweep -n 20 \\
+    --sweep DEq=0,1,2 --sweep SzV=1,25 --sweep DegRap=0,1
 """
     # Instantiate argparse parser
     parser = argparse.ArgumentParser(epilog=epilog,
@@ -82,7 +206,7 @@ Example usage:
     parser.add_argument('--filename-prefix', '--filename-prefix',
                         default='Ortho2',
                         type=str,
-                        help='Prefix used for the orthomosaic name (suffix is {color}.tif)')
+                        help='Name of the output multiband orthomosaic (OUTPUT/{prefix}.tif)')
 
     parser.add_argument('--RadiomEgal', dest='RadiomEgal', action='store_const', const=1)
     parser.add_argument('--no-RadiomEgal', dest='RadiomEgal', action='store_const', const=0)
@@ -121,6 +245,22 @@ Example usage:
                         type=int,
                         default=1)
 
+    parser.add_argument('--sweep',
+                        action='append',
+                        default=[],
+                        help="""
+Parameter values to sweep, as NAME=v1,v2,... (XY parameters as NAME=a:b,c:d). Can be
+repeated; all combinations are run, outputs are named {prefix}_{hash}.tif and
+combinations already produced are skipped. A table ranking the mosaics by seam
+discontinuity (mean step across the seamlines relative to the mean step within
+the images, averaged over bands; 1 means invisible seams) is written to
+OUTPUT/{prefix}_sweep.csv""")
+
+    parser.add_argument('-n', '--ncores',
+                        default=5,
+                        type=int,
+                        help='Number of Tawny processes run concurrently in sweep mode')
+
 # RadiomEgal, DEq, DEqXY, AddCste, DegRap, DegRapXY, SzV
 
     parsed_args = parser.parse_args()
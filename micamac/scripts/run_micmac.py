@@ -5,14 +5,37 @@ import os
 import glob
 import shutil
 import re
+import json
 import subprocess
+import functools
 import multiprocessing as mp
 
+import numpy as np
 from shapely.geometry import Point
 
 from micamac.micmac_utils import run_tawny, dir_to_points, update_poubelle, update_ori
-from micamac.micmac_utils import create_proj_file, clean_intermediary, clean_images
-from micamac.micmac_utils import make_tarama_mask, get_and_georeference_dem
+from micamac.micmac_utils import create_proj_file, release_artifacts
+from micamac.micmac_utils import clean_intermediary as remove_intermediary
+from micamac.micmac_utils import clean_images as remove_images
+from micamac.micmac_utils import make_tarama_mask, get_and_georeference_dem, final_malt_dem
+from micamac.micmac_utils import build_tiepoint_pyramid, prune_images
+from micamac.micmac_utils import points_to_utm, select_dense_cluster
+from micamac.micmac_utils import run_malt_pan, run_malt_ortho
+from micamac.homol_utils import rescale_homol, homol_report
+from micamac.ori_utils import read_ori_dir, poses_to_file, poses_to_csv
+from micamac.export_utils import stack_to_cog, utm_crs
+from micamac.tiling import run_tiles
+from micamac.thinning import thin_images
+from micamac.pointcloud import export_point_cloud
+from micamac.reference import link_reference, merge_ori_dirs, reference_pairs
+from micamac.reference import read_pairs, write_pairs
+from micamac.workqueue import run_jobs
+from micamac.cache import ArtifactCache, step_key, images_digest, file_digest
+from micamac.resource_utils import StepTimer, format_bytes
+from micamac.planner import project_features, planned_steps, planned_tile_steps
+from micamac.planner import plan, print_plan
+from micamac.planner import load_history, calibrate, record_run, HISTORY_FILE
+from micamac.profile_utils import profiled, enable_profiling, merge_profiles
 
 
 COLORS = ['blue', 'green', 'red', 'nir', 'edge']
@@ -30,13 +53,43 @@ STARTFROM_MAPPING = {'exif': 0, # Default
                      'malt_multi': 10,
                      'tawny': 11}
 
-def main(img_dir, lon, lat, radius, resolution, ortho, dem, ply,
-         ncores, utm, clean_intermediary, clean_images, startfrom):
+def main(img_dir, lon, lat, radius, auto_subset, resolution, ortho, dem, ply,
+         ncores, utm, clean_intermediary, clean_images, startfrom,
+         tiepoint_factor, prune_weak, min_tiepoints, mask_footprint,
+         tile_size, tile_overlap, tile_jobs, queue, local_workers, dry_run,
+         history, gc, retain, thin_overlap, min_views, flight_height,
+         ply_voxel, ply_format, reference, reference_calib_only, reference_overlap,
+         cache, cache_size):
     if not any([ortho, dem, ply]):
         raise ValueError('You must select at least one of --ortho, --dem and --ply')
+    if reference is None and auto_subset is None and None in [lon, lat, radius]:
+        raise ValueError('You must either provide --lon, --lat and --radius or --auto-subset')
+    if thin_overlap is not None and flight_height is None:
+        raise ValueError('--thin-overlap requires --flight-height')
+    if reference is not None and not reference_calib_only and flight_height is None:
+        raise ValueError('--reference requires --flight-height, unless --reference-calib-only is set')
+    if reference is not None:
+        reference = os.path.abspath(reference)
     startfrom = STARTFROM_MAPPING[startfrom.lower()]
+    tiled = tile_size is not None
     # Set workdir
     os.chdir(img_dir)
+
+    features = project_features(resolution=resolution, ncores=ncores,
+                                tiepoint_factor=tiepoint_factor,
+                                auto_subset=auto_subset)
+    if dry_run:
+        # Print predicted runtime, memory and disk usage of every step and exit
+        runs = load_history(history)
+        steps = planned_steps(startfrom, ortho, dem, tiled, ply=ply,
+                              reference=reference is not None,
+                              reference_images=reference is not None and not reference_calib_only,
+                              thinning=thin_overlap is not None)
+        rows = plan(features, steps, calibrate(runs), tile_jobs=tile_jobs,
+                    tile_steps=planned_tile_steps(max(startfrom, 9), ortho, dem or ply))
+        print_plan(rows, features, history_path=history, n_history=len(runs))
+        return
+
     proj_xml = """
     <SystemeCoord>
              <BSC>
@@ -53,6 +106,37 @@ def main(img_dir, lon, lat, radius, resolution, ortho, dem, ply,
     with open('SysUTM.xml', 'w') as dst:
         dst.write(proj_xml)
 
+    # Step timings, updated as the workflow progresses
+    # With gc, intermediate artifacts are released as soon as their last consumer step ended
+    on_stop = functools.partial(release_artifacts, retain=retain) if gc else None
+    timer = StepTimer('OUTPUT/steps.json', disk_path='.', on_stop=on_stop)
+
+    if startfrom == 0 and thin_overlap is not None:
+        timer.step('thinning')
+        # Drop redundant captures before building the image pairs
+        removed, report = thin_images(sorted(glob.glob('pan*tif')), utm_zone=utm,
+                                      flight_height=flight_height, overlap=thin_overlap,
+                                      min_views=min_views, ncores=ncores)
+        print('Thinning: removing %d of %d images; %.1f%% of the covered area and %.1f%% of the area seen by %d images kept'
+              % (report['n_removed'], report['n_images'], 100 * report['coverage_kept'],
+                 100 * report['multiview_coverage_kept'], min_views))
+        prune_images(removed)
+        update_poubelle()
+        if not os.path.exists('OUTPUT'):
+            os.makedirs('OUTPUT')
+        with open('OUTPUT/thinning.json', 'w') as dst:
+            json.dump(report, dst, indent=2)
+
+    timer.step('exif')
+
+    if startfrom == 0 and reference is not None:
+        # Calibration (and imagery) of an earlier project over the same site
+        ref_list = link_reference(reference, images=not reference_calib_only)
+        print('Reference: calibration and %d images imported from %s' % (len(ref_list), reference))
+    ref_list = sorted(glob.glob('ref_pan*tif'))
+    # Images of the new flight, and with --reference, the reference images
+    img_pattern = '(ref_)?pan.*tif' if ref_list else 'pan.*tif'
+    pairs_file = 'FileImagesNeighbour.xml'
 
     # mm3d XifGps2Txt "rgb.*tif" 
     subprocess.call(['mm3d', 'XifGps2Txt', 'pan.*tif'])
@@ -66,70 +150,181 @@ def main(img_dir, lon, lat, radius, resolution, ortho, dem, ply,
                      'ChSys=DegreeWGS84@RTLFromExif.xml', 'MTD1=1',
                      'NameCple=FileImagesNeighbour.xml', 'NbImC=20'])
 
-    if startfrom <= 1:
+    if ref_list:
+        pairs_file = 'FileImagesReference.xml'
+    if ref_list and startfrom == 0:
+        # Reference poses in the local frame of the new flight, frozen in the
+        # bundle adjustment; with the GPS trajectory poses of the new images
+        # (OriConvert MTD1) they are its initial orientation
+        subprocess.call(['mm3d', 'ChgSysCo', 'ref_pan.*tif', 'Reference',
+                         'SysUTM.xml@RTLFromExif.xml', 'Reference_RTL'])
+        merge_ori_dirs(['Ori-RAWGNSS_N', 'Ori-Reference_RTL'], 'Ori-RAWGNSS_Ref')
+        # New image pairs, plus new to reference pairs of overlapping footprints
+        new_pairs = [x for x in read_pairs('FileImagesNeighbour.xml')
+                     if not any(img.startswith('ref_') for img in x)]
+        ref_pairs = reference_pairs(sorted(glob.glob('pan*tif')), ref_list, utm_zone=utm,
+                                    flight_height=flight_height,
+                                    min_overlap=reference_overlap, ncores=ncores)
+        write_pairs(new_pairs + ref_pairs, pairs_file)
+        print('Reference: %d new to reference image pairs' % len(ref_pairs))
+
+    # Artifacts are keyed by their inputs and parameters, and by the keys of the
+    # artifacts they were computed from
+    artifacts = None
+    if cache is not None:
+        artifacts = ArtifactCache(cache, max_size=int(cache_size * 1e9))
+
+    timer.step('tapioca')
+    homol_cached = False
+    if artifacts is not None:
+        homol_key = step_key('tapioca',
+                             {'images': images_digest(glob.glob('pan*tif') + ref_list),
+                              'pairs': file_digest(pairs_file),
+                              'tiepoint_factor': tiepoint_factor})
+        homol_cached = startfrom <= 1 and artifacts.restore(homol_key) is not None
+        if homol_cached:
+            timer.note(cached=True)
+    if startfrom <= 1 and not homol_cached and tiepoint_factor > 1:
+        # Match tie points on reduced 8 bits copies of the images and scale
+        # them back to full resolution
+        build_tiepoint_pyramid(factor=tiepoint_factor, ncores=ncores,
+                               img_pattern='*pan*tif' if ref_list else 'pan*tif')
+        shutil.copy(pairs_file, 'Pyram-TP')
+        subprocess.call(['mm3d', 'Tapioca', 'File',
+                         pairs_file, '-1'], cwd='Pyram-TP')
+        rescale_homol('Pyram-TP/Homol', 'Homol', factor=tiepoint_factor)
+    elif startfrom <= 1 and not homol_cached:
         # mm3d Tapioca File FileImagesNeighbour.xml -1
         subprocess.call(['mm3d', 'Tapioca', 'File',
-                         'FileImagesNeighbour.xml', '-1'])
+                         pairs_file, '-1'])
+    if startfrom <= 1 and artifacts is not None and not homol_cached:
+        artifacts.store(homol_key, 'tapioca', ['Homol'])
+
+    # Schnaps to ChgSysCo, cached as a whole (final orientation and pruned images)
+    ori_cached = False
+    if artifacts is not None:
+        ori_key = step_key('orientation',
+                           {'prune_weak': prune_weak, 'min_tiepoints': min_tiepoints,
+                            'auto_subset': auto_subset, 'lon': lon, 'lat': lat,
+                            'radius': radius, 'utm': utm,
+                            'reference': images_digest(glob.glob('Ori-Reference/*.xml')),
+                            'reference_calib_only': reference_calib_only},
+                           parents=[homol_key])
+        if startfrom <= 2:
+            meta = artifacts.restore(ori_key)
+            ori_cached = meta is not None
+            if ori_cached:
+                prune_images(meta['extra']['poubelle'])
+                update_poubelle()
+    ori_notes = {'cached': True} if ori_cached else {}
+
+    timer.step('schnaps', **ori_notes)
+    if startfrom <= 2 and prune_weak is not None and not ori_cached:
+        # Remove weakly connected images before they break the orientation
+        report = homol_report('Homol', min_points=min_tiepoints, min_links=prune_weak)
+        print('Tie points connected components (sizes): %s' % report['components'])
+        print('Pruning %d weakly connected images: %s' % (len(report['weak_images']),
+                                                          ', '.join(report['weak_images'])))
+        prune_images(report['weak_images'])
+        update_poubelle()
 
-    if startfrom <= 2:
+    if startfrom <= 2 and not ori_cached:
         # mm3d Schnaps "pan.*tif" MoveBadImgs=1
-        subprocess.call(['mm3d', 'Schnaps', 'pan.*tif', 'MoveBadImgs=1'])
+        subprocess.call(['mm3d', 'Schnaps', img_pattern, 'MoveBadImgs=1'])
 
-    # Build a list of file around the provided coordinate to compute a pre orientation model
-    radius_dd = radius / 111320.0
-    search_polygon = Point(lon, lat).buffer(radius_dd)
     point_list = dir_to_points()
-    img_list = []
-    for point_tuple in point_list:
-        if point_tuple[0].intersects(search_polygon):
-            img_list.append(point_tuple[1])
-
-    if startfrom <= 3:
+    if reference is not None:
+        # The calibration comes from the reference, no pre-orientation subset
+        img_list = []
+    elif auto_subset is not None:
+        # Pick the most compact cluster of images for the pre orientation model
+        xy = points_to_utm(point_list, utm_zone=utm)
+        indices, score = select_dense_cluster(xy, size=auto_subset)
+        img_list = [point_list[i][1] for i in indices]
+        center = point_list[score['center']][0]
+        print('Pre-orientation subset: %d images around %s (radius %.1f m, density %.1f img/ha, overlap %.2f)'
+              % (len(img_list), center.wkt, score['radius'], score['density'], score['overlap']))
+        print('Pre-orientation images: %s' % ', '.join(img_list))
+    else:
+        # Build a list of file around the provided coordinate to compute a pre orientation model
+        radius_dd = radius / 111320.0
+        search_polygon = Point(lon, lat).buffer(radius_dd)
+        img_list = []
+        for point_tuple in point_list:
+            if point_tuple[0].intersects(search_polygon):
+                img_list.append(point_tuple[1])
+
+    if reference is None:
+        timer.step('tapas_subset', **ori_notes)
+    if startfrom <= 3 and reference is None and not ori_cached:
         # mm3d Tapas FraserBasic $file_list Out=Arbitrary_pre SH=_mini
         subprocess.call(['mm3d', 'Tapas', 'FraserBasic',
                          '|'.join(img_list),
                          'Out=Arbitrary_pre', 'SH=_mini'])
 
     # mm3d Martini "pan.*tif" SH=_mini OriCalib=Arbitrary_pre
-    if startfrom <= 4:
-        subprocess.call(['mm3d', 'Martini', 'pan.*tif',
-                         'SH=_mini', 'OriCalib=Arbitrary_pre'])
-
-    if startfrom <= 5:
+    calib = 'Arbitrary_pre' if reference is None else 'Reference'
+    if not ref_list:
+        timer.step('martini', **ori_notes)
+    if startfrom <= 4 and not ref_list and not ori_cached:
+        subprocess.call(['mm3d', 'Martini', img_pattern,
+                         'SH=_mini', 'OriCalib=%s' % calib])
+
+    timer.step('tapas_reference' if ref_list else 'tapas_full', **ori_notes)
+    if startfrom <= 5 and ref_list and not ori_cached:
+        # Single bundle adjustment of the joint block, from the GPS trajectory
+        # poses of the new images and the reference poses, with the calibration
+        # of the reference and the reference poses frozen: the result is in the
+        # local frame of the reference block, no Martini, free Tapas,
+        # CenterBascule or Campari
+        # mm3d Tapas FraserBasic "(ref_)?pan.*tif" Out=Ground_RTL SH=_mini InCal=Reference InOri=RAWGNSS_Ref FrozenPoses="ref_pan.*tif"
+        tapas_args = ['mm3d', 'Tapas', 'FraserBasic', img_pattern,
+                      'Out=Ground_RTL', 'SH=_mini', 'InCal=Reference',
+                      'InOri=RAWGNSS_Ref', 'FrozenPoses=ref_pan.*tif', 'EcMax=50',
+                      'LibFoc=0', 'LibPP=0', 'LibCD=0', 'DegRadMax=0',
+                      'LibDec=0', 'LibAff=0']
+        p = subprocess.Popen(tapas_args, stdin=subprocess.PIPE)
+        p.communicate(input='\n'.encode('utf-8'))
+    elif startfrom <= 5 and not ori_cached:
         # Compute orientation model for the full block
         # mm3d Tapas FraserBasic "pan.*tif" Out=Arbitrary SH=_mini InCal=Arbitrary_pre
         # mm3d Tapas FraserBasic "pan.*tif" Out=Arbitrary InCal=Arbitrary_pre SH=_mini InOri=Martini_miniArbitrary_pre
-        p = subprocess.Popen(['mm3d', 'Tapas', 'FraserBasic', 'pan.*tif',
-                              'Out=Arbitrary', 'SH=_mini', 'InCal=Arbitrary_pre',
-                              'InOri=Martini_miniArbitrary_pre', 'EcMax=50'],
-                             stdin=subprocess.PIPE)
+        tapas_args = ['mm3d', 'Tapas', 'FraserBasic', img_pattern,
+                      'Out=Arbitrary', 'SH=_mini', 'InCal=%s' % calib,
+                      'InOri=Martini_mini%s' % calib, 'EcMax=50']
+        if reference is not None:
+            # Calibration of the reference is kept as is
+            tapas_args += ['LibFoc=0', 'LibPP=0', 'LibCD=0', 'DegRadMax=0',
+                           'LibDec=0', 'LibAff=0']
+        p = subprocess.Popen(tapas_args, stdin=subprocess.PIPE)
         p.communicate(input='\n'.encode('utf-8'))
 
-    if startfrom <= 6:
+    if not ref_list:
+        timer.step('centerbascule', **ori_notes)
+    if startfrom <= 6 and not ref_list and not ori_cached:
         # mm3d CenterBascule "rgb.*tif" Arbitrary RAWGNSS_N Ground_Init_RTL
-        subprocess.call(['mm3d', 'CenterBascule', 'pan.*tif',
-                         'Arbitrary', 'RAWGNSS_N', 'Ground_Init_RTL'])
+        subprocess.call(['mm3d', 'CenterBascule', img_pattern, 'Arbitrary',
+                         'RAWGNSS_N', 'Ground_Init_RTL'])
 
-    if startfrom <= 7:
+    if not ref_list:
+        timer.step('campari', **ori_notes)
+    if startfrom <= 7 and not ref_list and not ori_cached:
         # mm3d Campari "rgb.*tif" Ground_Init_RTL Ground_RTL EmGPS=\[RAWGNSS_N,5\] AllFree=1 SH=_mini
-        subprocess.call(['mm3d', 'Campari', 'pan.*tif', 'Ground_Init_RTL', 'Ground_RTL',
-                         'EmGPS=[RAWGNSS_N,5]', 'AllFree=1', 'SH=_mini'])
-
-    if startfrom <= 8:
+        campari_args = ['mm3d', 'Campari', img_pattern, 'Ground_Init_RTL', 'Ground_RTL',
+                        'EmGPS=[RAWGNSS_N,5]', 'SH=_mini']
+        if reference is None:
+            campari_args.append('AllFree=1')
+        subprocess.call(campari_args)
+
+    timer.step('chgsysco', **ori_notes)
+    if startfrom <= 8 and not ori_cached:
         # mm3d ChgSysCo  "rgb.*tif" Ground_RTL RTLFromExif.xml@SysUTM.xml Ground_UTM
-        subprocess.call(['mm3d', 'ChgSysCo', 'pan.*tif',
+        subprocess.call(['mm3d', 'ChgSysCo', img_pattern,
                          'Ground_RTL', 'RTLFromExif.xml@SysUTM.xml', 'Ground_UTM'])
-
-    if startfrom <= 9:
-        # Run Tarama (projection of all images on a horizontal plan), and auto define a mask for use in Malt
-        subprocess.call(['mm3d', 'Tarama', 'pan_.*tif', 'Ground_UTM'])
-        make_tarama_mask(point_list=point_list, utm_zone=utm, buff=50)
-
-    if startfrom <= 9:
-        # Run malt for panchromatic
-        subprocess.call(['mm3d', 'Malt', 'Ortho',
-                         'pan.*tif', 'Ground_UTM', 'DirTA=TA', 'NbProc=%d' % ncores,
-                         'DefCor=0.0005', 'ZoomF=4', 'ResolTerrain=%f' % resolution])
+    if startfrom <= 2 and artifacts is not None and not ori_cached:
+        poubelle = [os.path.basename(x) for x in glob.glob('Poubelle/*pan*tif')]
+        artifacts.store(ori_key, 'orientation', ['Ori-Ground_UTM'],
+                        extra={'poubelle': poubelle})
 
     # MIrror content of POubelle for all colors
     # In a try-except so that it doesn't fail on re-runs
@@ -144,45 +339,108 @@ def main(img_dir, lon, lat, radius, resolution, ortho, dem, ply,
     except Exception as e:
         pass
 
-    if startfrom <= 10:
-        # Run malt for every band
-        for color in COLORS:
-            subprocess.call(['mm3d', 'Malt', 'Ortho',
-                             '(pan|%s).*tif' % color,
-                             'Ground_UTM', 'DoMEC=0', 'DoOrtho=1',
-                             'ImOrtho="%s.*.tif"' % color,
-                             'DirOF=Ortho-%s' % color,
-                             'DirMEC=MEC-Malt',
-                             'ZoomF=4',
-                             'NbProc=%d' % ncores,
-                             'ImMNT="pan.*tif"',
-                             'ResolTerrain=%f' % resolution])
-
-    # Create output dir and run gdal_translate
+    # Create output dir
     if not os.path.exists('OUTPUT'):
         os.makedirs('OUTPUT')
 
-    if ortho:
-        # Run Tawny for every band
-        pool = mp.Pool(ncores)
-        pool.map(run_tawny, COLORS)
+    # Export camera poses of the final orientation
+    if os.path.exists('Ori-Ground_UTM'):
+        poses = read_ori_dir('Ori-Ground_UTM')
+        poses_to_csv(poses, 'OUTPUT/camera_poses.csv')
+        poses_to_file(poses, 'OUTPUT/camera_poses.gpkg', utm_zone=utm)
+
+    if tiled:
+        timer.step('tiles')
+        # Partitioned processing, Tarama/Malt/Tawny run per ground tile
+        poses = read_ori_dir('Ori-Ground_UTM')
+        centers = {str(x['image']): (x['x'], x['y']) for x in poses}
+        tile_points = [x for x in point_list if x[1] in centers]
+        xy = np.array([centers[x[1]] for x in tile_points])
+        run_tiles(tile_points, xy, utm_zone=utm, resolution=resolution,
+                  tile_size=tile_size, overlap=tile_overlap,
+                  tile_jobs=tile_jobs, ncores=ncores, queue=queue,
+                  local_workers=local_workers, startfrom=max(startfrom, 9),
+                  ortho=ortho, dem=dem or ply, mask_footprint=mask_footprint)
+
+    mec_cached = False
+    if artifacts is not None and not tiled:
+        mec_key = step_key('malt_pan', {'resolution': resolution,
+                                        'mask_footprint': mask_footprint,
+                                        'artifacts': ['MEC-Malt', 'TA']},
+                           parents=[ori_key])
+        mec_cached = startfrom <= 9 and artifacts.restore(mec_key) is not None
+    mec_notes = {'cached': True} if mec_cached else {}
+
+    if startfrom <= 9 and not tiled and not mec_cached:
+        timer.step('tarama')
+        # Run Tarama (projection of all images on a horizontal plan), and auto define a mask for use in Malt
+        subprocess.call(['mm3d', 'Tarama', 'pan_.*tif', 'Ground_UTM'])
+        make_tarama_mask(point_list=point_list, utm_zone=utm, buff=50,
+                         footprint=mask_footprint)
 
+    if startfrom <= 9 and not tiled:
+        timer.step('malt_pan', **mec_notes)
+    if startfrom <= 9 and not tiled and not mec_cached:
+        # Run malt for panchromatic
+        run_malt_pan(resolution=resolution, ncores=ncores)
+        if artifacts is not None:
+            # Copied rather than linked, Malt writes the band orthos to MEC-Malt.
+            # TA is stored too, Tarama is skipped on a cache hit
+            artifacts.store(mec_key, 'malt_pan', ['MEC-Malt', 'TA'], link='copy')
+
+    if startfrom <= 10 and not tiled:
+        timer.step('malt_multi')
+        # Run malt for every band, one after the other: the runs share MEC-Malt,
+        # Pyram and Tmp-MM-Dir of the project and are not submitted to the queue
         for color in COLORS:
-            subprocess.call(['gdal_translate', '-a_srs',
-                             '+proj=utm +zone=%d +ellps=WGS84 +datum=WGS84 +units=m +no_defs' % utm,
-                             'Ortho-%s/Orthophotomosaic.tif' % color,
-                             'OUTPUT/ortho_%s.tif' % color])
-    if dem:
-        get_and_georeference_dem(utm_zone=utm)
+            run_malt_ortho(color, resolution=resolution, ncores=ncores)
+
+    if ortho and not tiled:
+        timer.step('tawny')
+        # Run Tawny for every band
+        if queue is not None:
+            run_jobs(queue, 'tawny', [{'color': color, 'cwd': os.getcwd()} for color in COLORS],
+                     local_workers=local_workers)
+        else:
+            pool = mp.Pool(ncores)
+            pool.map(profiled(run_tawny), COLORS)
+
+        # Stack the five bands in a single Cloud Optimized GeoTiff
+        timer.step('ortho_export')
+        stack_to_cog(['Ortho-%s/Orthophotomosaic.tif' % color for color in COLORS],
+                     'OUTPUT/ortho.tif', crs=utm_crs(utm), ncores=ncores,
+                     descriptions=COLORS)
+    if dem and not tiled:
+        timer.step('dem_export')
+        get_and_georeference_dem(utm_zone=utm, ncores=ncores)
 
     if ply:
-        pass
+        timer.step('ply')
+        # Dense point cloud from the DEM, colored by the orthomosaic when exported
+        if tiled:
+            dem_path = 'OUTPUT/dem.tif'
+        else:
+            dem_path = final_malt_dem()
+        ortho_path = 'OUTPUT/ortho.tif' if os.path.exists('OUTPUT/ortho.tif') else None
+        index = export_point_cloud(dem_path, 'OUTPUT/pointcloud', ortho_path=ortho_path,
+                                   band_names=COLORS if ortho_path else None,
+                                   voxel=ply_voxel, fmt=ply_format, ncores=ncores,
+                                   crs=utm_crs(utm))
+        print('Point cloud of %d points written to OUTPUT/pointcloud (%d tiles)'
+              % (index['points'], len(index['tiles'])))
+    timer.stop()
+    report = timer.report()
+    record_run(history, features, report)
+    print('Disk usage: start %s, peak %s (end of %s), final %s, %s released by --gc'
+          % (format_bytes(report['disk_start']), format_bytes(report['disk_peak']),
+             report['disk_peak_step'], format_bytes(report['disk_final']),
+             format_bytes(sum(x.get('released', 0) for x in report['steps']))))
 
     if clean_intermediary:
-        clean_intermediary()
+        remove_intermediary()
 
     if clean_images:
-        clean_images()
+        remove_images()
 
 
 
@@ -197,7 +455,27 @@ Example usage:
 ./run_micmac.py --help
 
 # Run workflow and clean intermediary outputs
-./run_micmac.py -i /path/to/images --lon 12.43 --lat 1.234 --utm 33 --clean
+./run_micmac.py -i /path/to/images --lon 12.43 --lat 1.234 --radius 50 --utm 33 --ortho -c-int
+
+# Same, with automatic selection of the pre-orientation subset
+./run_micmac.py -i /path/to/images --auto-subset 40 --utm 33 --ortho
+
+# Same, dropping redundant captures of a flight flown 100 m above ground
+./run_micmac.py -i /path/to/images --auto-subset 40 --utm 33 --ortho --thin-overlap 0.9 --flight-height 100
+
+# Repeat flight: reuse the calibration of last week's project and orient against its images
+./run_micmac.py -i /path/to/images --utm 33 --ortho --reference /path/to/last_week --flight-height 100
+
+# Share tie points, orientation and DEM with other variants of the same flight
+# (e.g. several resolutions in separate directories of the same images)
+./run_micmac.py -i /path/to/images_10cm --auto-subset 40 --utm 33 --ortho --cache /data/micamac_cache
+./run_micmac.py -i /path/to/images_5cm --auto-subset 40 --utm 33 --ortho --resolution 0.05 --cache /data/micamac_cache
+
+# Release intermediate files as soon as they are no longer needed, keeping tie points
+./run_micmac.py -i /path/to/images --auto-subset 40 --utm 33 --ortho --gc --retain Homol_mini
+
+# Predict runtime, memory and disk usage of every step without running anything
+./run_micmac.py -i /path/to/images --auto-subset 40 --utm 33 --ortho --dem --plan
 """
     # Instantiate argparse parser
     parser = argparse.ArgumentParser(epilog=epilog,
@@ -210,20 +488,27 @@ Example usage:
                         help='directory containing images')
 
     parser.add_argument('-lon', '--lon',
-                        required=True,
+                        default=None,
                         type=float,
                         help='Pre-orientation image cluster center longitude')
 
     parser.add_argument('-lat', '--lat',
-                        required=True,
+                        default=None,
                         type=float,
                         help='Pre-orientation image cluster center latitude')
 
     parser.add_argument('-rad', '--radius',
-                        required=True,
+                        default=None,
                         type=float,
                         help='Search radius in meters around provided coordinates, to select pre-orientation image subset')
 
+    parser.add_argument('-auto', '--auto-subset',
+                        default=None,
+                        type=int,
+                        help="""
+Automatically select the pre-orientation image subset as the most compact cluster
+of that number of images (e.g. 40), instead of using --lon, --lat and --radius""")
+
     parser.add_argument('-res', '--resolution',
                         default=0.1,
                         type=float,
@@ -239,15 +524,35 @@ Example usage:
 
     parser.add_argument('-ply', '--ply',
                         action='store_true',
-                        help='Exporte dense point cloud')
+                        help="""
+Export dense point cloud, one point per DEM pixel colored with the orthomosaic bands
+(when --ortho is set), as tiles processed in parallel in OUTPUT/pointcloud/ with an
+index.json listing their bounds and number of points""")
+
+    parser.add_argument('-voxel', '--ply-voxel',
+                        default=None,
+                        type=float,
+                        help='Optional voxel size in meters, to decimate the point cloud (one point per voxel)')
+
+    parser.add_argument('-plyf', '--ply-format',
+                        default='ply',
+                        choices=['ply', 'las', 'laz'],
+                        help='Point cloud tiles format; las and laz require laspy (and lazrs or laszip for laz)')
 
     parser.add_argument('-n', '--ncores',
                         default=20,
                         type=int,
                         help="""
-Number of cores to use for multiprocessing. There\'s no use in setting it >5,
-for it\'s only used for running Tawny in parallel on the 5 bands. This argument has no impact
-on the other micmac steps that use all threads available""")
+Number of cores used by the pipeline:
+    - NbProc of the Malt runs (panchromatic DEM and band orthoimages)
+    - pool reducing the images of the tie point pyramid (--tiepoint-factor)
+    - tiled processing (--tile-size): each of the --tile-jobs concurrent tiles
+      gets ncores // tile-jobs cores, the merge feathering uses all of them
+    - image thinning (--thin-overlap) and reading of the reference footprints (--reference)
+    - pool running Tawny on the 5 bands (at most 5 useful)
+    - threads writing the exported COGs (ortho, DEM)
+    - point cloud export (--ply)
+Other micmac steps (Tapioca, Tapas, Campari, ...) use all threads available""")
 
     parser.add_argument('-utm', '--utm',
                         default=33,
@@ -262,6 +567,163 @@ on the other micmac steps that use all threads available""")
                         action='store_true',
                         help='Delete all input images after successful completion')
 
+    parser.add_argument('-tpf', '--tiepoint-factor',
+                        default=1,
+                        type=int,
+                        help="""
+Downsampling factor of the images used for tie points matching. When > 1, Tapioca
+runs on reduced, contrast stretched 8 bits copies of the panchromatic images
+(built in parallel in Pyram-TP/) and the tie points are scaled back to full
+resolution. Defaults to 1 (full resolution matching)""")
+
+    parser.add_argument('-pw', '--prune-weak',
+                        default=None,
+                        type=int,
+                        help="""
+Optionally move to Poubelle, before running Schnaps, the images having less than
+that number of links (image pairs with at least --min-tiepoints tie points) or
+that are not part of the largest connected block of images""")
+
+    parser.add_argument('-mtp', '--min-tiepoints',
+                        default=30,
+                        type=int,
+                        help='Minimum number of tie points for an image pair to count as a link (see --prune-weak)')
+
+    parser.add_argument('-mask', '--mask-footprint',
+                        default='convex',
+                        choices=['convex', 'concave', 'lines'],
+                        help="""
+Shape of the Malt mask derived from the capture centers:
+    convex: Convex hull of the captures (default)
+    concave: Morphological closing of the captures, follows concave outlines
+    lines: Buffered flight lines, excludes empty areas between and around strips""")
+
+    parser.add_argument('-tile', '--tile-size',
+                        default=None,
+                        type=float,
+                        help="""
+Optional tile size in meters. When set, the oriented block is split into overlapping
+ground tiles (using the camera centers) processed in separate working directories
+under Tiles/ (Tarama, Malt, Tawny), and the tile DEMs and orthomosaics are merged
+with feathering over the overlaps. Per tile run times are written to OUTPUT/tiles.json.
+Recommended for blocks of several thousand images""")
+
+    parser.add_argument('-tov', '--tile-overlap',
+                        default=50,
+                        type=float,
+                        help='Distance in meters around each tile within which images are included in the tile')
+
+    parser.add_argument('-tj', '--tile-jobs',
+                        default=2,
+                        type=int,
+                        help='Number of tiles processed concurrently; each tile gets ncores / tile-jobs cores')
+
+    parser.add_argument('-q', '--queue',
+                        default=None,
+                        type=str,
+                        help="""
+Optional path to a work queue database (SQLite) on a file system shared by several
+hosts. Per band Tawny and per tile jobs are then submitted to the queue and run by
+micamac_worker.py processes started on any host that sees the project directory at
+the same path. Malt runs of the bands share the project MEC-Malt directory and
+always run sequentially on this machine""")
+
+    parser.add_argument('-lw', '--local-workers',
+                        default=0,
+                        type=int,
+                        help='Number of queue workers started on this machine when --queue is set')
+
+    parser.add_argument('--plan',
+                        dest='dry_run',
+                        action='store_true',
+                        help="""
+Print the steps that would run with their predicted runtime, peak memory and disk
+usage, then exit without running anything. Predictions use a cost model calibrated
+on the previous runs recorded in the --history file""")
+
+    parser.add_argument('--history',
+                        default=HISTORY_FILE,
+                        type=str,
+                        help='File where step timings, memory and disk usage of every run are recorded (json lines)')
+
+    parser.add_argument('-thin', '--thin-overlap',
+                        default=None,
+                        type=float,
+                        help="""
+Optionally drop redundant captures (hovering, turns, dense capture intervals) before
+running MicMac. Image footprints are estimated from the capture positions, altitude
+and yaw, and captures are dropped (moved to Poubelle) as long as that fraction of
+their footprint remains seen by --min-views images, while keeping consecutive images
+of a flight line overlapping. A report is written to OUTPUT/thinning.json (e.g. 0.9)""")
+
+    parser.add_argument('-mv', '--min-views',
+                        default=4,
+                        type=int,
+                        help='Number of images that must still see the area of a dropped capture (see --thin-overlap)')
+
+    parser.add_argument('-fh', '--flight-height',
+                        default=None,
+                        type=float,
+                        help='Flight height above ground in meters, required by --thin-overlap to estimate image footprints')
+
+    parser.add_argument('-ref', '--reference',
+                        default=None,
+                        type=str,
+                        help="""
+Optional directory of an earlier project over the same site (repeat flights). Its
+Ori-Ground_UTM calibration is reused (no pre-orientation subset, calibration kept
+fixed) and, when its panchromatic images are still there, they are linked as
+ref_pan_XXXXX.tif. Tie points are then matched for the new image pairs plus the new
+to reference pairs of overlapping footprints only (reference to reference pairs are
+not matched again), and Martini, the free Tapas, CenterBascule and Campari are
+replaced by a single Tapas with the reference calibration, starting from the GPS
+trajectory poses of the new images, with the reference images frozen at their
+reference poses: the new images are adjusted against them, both dates stay
+co-registered and the orientation is much faster. With --reference-calib-only the
+block is oriented as usual, with the calibration of the reference kept fixed.
+Requires --flight-height, to estimate the footprints""")
+
+    parser.add_argument('-ref-calib', '--reference-calib-only',
+                        action='store_true',
+                        help='Only reuse the calibration of --reference, not its images and poses')
+
+    parser.add_argument('-rov', '--reference-overlap',
+                        default=0.2,
+                        type=float,
+                        help='Minimum footprint overlap of a new to reference image pair (see --reference)')
+
+    parser.add_argument('-gc', '--gc',
+                        action='store_true',
+                        help="""
+Release intermediate artifacts as soon as the step that last consumes them succeeded
+(e.g. Pyram-TP after Tapioca, TA and coarse Malt levels after Malt, Ortho-*/Ort_* tiles
+after the orthomosaic export), deleting them or archiving them to <dir>.tar.gz.
+Lowers peak disk usage, but restarting with --startfrom or running rerun_tawny.py
+may then require the released files (see --retain)""")
+
+    parser.add_argument('-retain', '--retain',
+                        default=[],
+                        nargs='+',
+                        help="""
+Glob patterns of the artifacts --gc must keep (e.g. for debugging), matched
+against their path or name, e.g. --retain Homol* 'Ortho-*'""")
+
+    parser.add_argument('-cache', '--cache',
+                        default=None,
+                        type=str,
+                        help="""
+Optional artifact cache directory, shared by several projects (e.g. parameter variants
+of a flight in separate directories). Tie points (Homol), final orientation
+(Ori-Ground_UTM and pruned images) and the Malt DEM (MEC-Malt) are stored under a
+hash of their input images, parameters and upstream artifacts, and restored instead
+of recomputed when a project needs the same ones. Tie points and orientations are
+shared through hard links when the cache is on the same file system""")
+
+    parser.add_argument('-cs', '--cache-size',
+                        default=200,
+                        type=float,
+                        help='Size cap of --cache in GB, least recently used artifacts are evicted beyond it')
+
     parser.add_argument('-sf', '--startfrom',
                         default='exif',
                         type=str,
@@ -284,8 +746,33 @@ Can be one of:
 """)
 
 
+    parser.add_argument('-profile', '--profile',
+                        default=None,
+                        type=str,
+                        help="""
+Optional directory where profiles of this process and of its pool workers
+are written and merged at the end of the run (see micamac.profile_utils). Profiling
+can also be enabled by setting the MICAMAC_PROFILE environment variable""")
+
+    parser.add_argument('-pmode', '--profile-mode',
+                        default='cprofile',
+                        choices=['cprofile', 'sample'],
+                        help="""
+    cprofile: Deterministic cProfile statistics (.prof and .txt summary)
+    sample: Low overhead sampling of the stacks, written as flamegraph compatible collapsed stacks (.folded)""")
+
     parsed_args = parser.parse_args()
-    main(**vars(parsed_args))
+    kwargs = vars(parsed_args)
+    profile = kwargs.pop('profile')
+    profile_mode = kwargs.pop('profile_mode')
+    if profile is not None:
+        # main changes the working directory, the profile directory must not
+        # be resolved relative to it
+        profile = os.path.abspath(profile)
+        enable_profiling(profile, mode=profile_mode)
+    profiled(main, 'run_micmac')(**kwargs)
+    if profile is not None:
+        print('Profiles written to %s' % ', '.join(merge_profiles(profile)))
 
 
 
@@ -2,44 +2,176 @@
 
 import argparse
 import os
+import json
 import subprocess
 import multiprocessing as mp
+import functools
+import time
+
+import numpy as np
+import rasterio
+
+from micamac.export_utils import stack_to_cog, utm_crs
+from micamac.resource_utils import available_memory, format_bytes, PeakMemoryMonitor
+from micamac.mosaic import feather_mosaic, list_orthos, raster_bounds
 
 
 COLORS = ['blue', 'green', 'red', 'nir', 'edge']
+BOX_SIZES = [5000, 4000, 3000, 2000, 1500, 1000]
 
-def sf_runner(ortho_dir):
+def sf_runner(ortho_dir, box_size=5000):
     os.chdir(ortho_dir)
     subprocess.call(['mm3d', 'TestLib', 'SeamlineFeathering',
                      'Ort_.*tif', 'ApplyRE=1', 'ComputeRE=1',
-                     'SzBox=[5000,5000]'])
+                     'SzBox=[%d,%d]' % (box_size, box_size)])
 
 # MosaicFeathering.tif
 
-def main(img_dir, utm):
-    # Create output dir and run gdal_translate
+def ortho_extent(ortho_dir):
+    """Size of the mosaic covered by the Ort_*.tif tiles of an ortho directory
+
+    Return:
+        dict: Dictionary with ``width``, ``height`` (pixels), ``n_images`` and
+        ``itemsize`` (bytes per pixel) keys
+    """
+    path_list = [x[0] for x in list_orthos(ortho_dir)]
+    if not path_list:
+        return {'width': 0, 'height': 0, 'n_images': 0, 'itemsize': 1}
+    with rasterio.open(path_list[0]) as src:
+        itemsize = np.dtype(src.dtypes[0]).itemsize
+    bounds, res, _ = raster_bounds(path_list)
+    width = (bounds[:,2].max() - bounds[:,0].min()) / res[0]
+    height = (bounds[:,3].max() - bounds[:,1].min()) / res[1]
+    return {'width': int(width), 'height': int(height),
+            'n_images': len(path_list), 'itemsize': itemsize}
+
+
+def estimate_peak_memory(extent, box_size, overlap=8, base=300 * 1024 ** 2):
+    """Rough estimate of SeamlineFeathering peak memory for one band
+
+    A box of the output mosaic (value and float weights) is held in memory
+    together with the parts of the images overlapping it (value, priority mask
+    and float weights)
+
+    Args:
+        extent (dict): See ``ortho_extent``
+        box_size (int): SzBox parameter of SeamlineFeathering
+        overlap (int): Assumed number of images covering every ground point
+        base (int): Fixed memory cost of a process (bytes)
+
+    Return:
+        int: Estimated peak memory in bytes
+    """
+    box_px = min(box_size, extent['width']) * min(box_size, extent['height'])
+    per_px = extent['itemsize'] + 1 + 4
+    overlap = min(overlap, max(extent['n_images'], 1))
+    return int(base + box_px * (extent['itemsize'] + 4) + box_px * per_px * overlap)
+
+
+def plan_feathering(ortho_dirs, ncores=None, memory=None, box_size=None, safety=0.8):
+    """Choose box size and concurrency of SeamlineFeathering to fit memory and cores
+
+    The largest box size for which at least one band fits in memory is used, and
+    as many bands as fit are run concurrently
+
+    Return:
+        dict: The plan, with ``box_size``, ``concurrency``, ``peak_per_band``
+        (estimated bytes), ``memory`` (available bytes) and ``ncores`` keys
+    """
+    ncores = ncores or mp.cpu_count()
+    memory = memory or available_memory()
+    extents = [ortho_extent(x) for x in ortho_dirs]
+    box_sizes = [box_size] if box_size else BOX_SIZES
+    for size in box_sizes:
+        peak = max(estimate_peak_memory(x, size) for x in extents)
+        concurrency = int(safety * memory // peak)
+        if concurrency >= 1:
+            break
+    concurrency = max(1, min(concurrency, ncores, len(ortho_dirs)))
+    return {'box_size': size,
+            'concurrency': concurrency,
+            'peak_per_band': peak,
+            'memory': memory,
+            'ncores': ncores}
+
+
+def run_mm3d(ortho_dirs, ncores, box_size):
+    """Run mm3d SeamlineFeathering on all bands following a memory aware plan
+    """
+    plan = plan_feathering(ortho_dirs, ncores=ncores, box_size=box_size)
+    print('SeamlineFeathering plan: %d bands concurrently, SzBox=%d, estimated %s per band, %s available'
+          % (plan['concurrency'], plan['box_size'],
+             format_bytes(plan['peak_per_band']), format_bytes(plan['memory'])))
+
+    # Run SeamlineFeathering for every band, sampling the summed memory of the
+    # concurrent processes to compare it with the plan
+    with PeakMemoryMonitor() as monitor:
+        pool = mp.Pool(plan['concurrency'])
+        pool.map(functools.partial(sf_runner, box_size=plan['box_size']), ortho_dirs,
+                 chunksize=1)
+        pool.close()
+        pool.join()
+    plan['planned_peak_rss'] = plan['concurrency'] * plan['peak_per_band']
+    plan['measured_peak_rss'] = monitor.peak
+    if monitor.peak is not None:
+        print('Measured peak RSS of the concurrent bands: %s (planned %s)'
+              % (format_bytes(monitor.peak), format_bytes(plan['planned_peak_rss'])))
+    return plan
+
+
+def main(img_dir, utm, ncores, box_size, engine):
+    # Create output dir
+    os.chdir(img_dir)
     if not os.path.exists('OUTPUT'):
         os.makedirs('OUTPUT')
 
     # Build iterable (list of the ortho dirs)
-    ortho_dirs = [os.path.join(img_dir, 'Ortho-%s' % color) for color in COLORS]
-
-    # Run Tawny for every band
-    pool = mp.Pool(2)
-    pool.map(sf_runner, ortho_dirs)
-
-    os.chdir(img_dir)
-
-    for color in COLORS:
-        subprocess.call(['gdal_translate', '-a_srs',
-                         '+proj=utm +zone=%d +ellps=WGS84 +datum=WGS84 +units=m +no_defs' % utm,
-                         'Ortho-%s/MosaicFeathering.tif' % color,
-                         'OUTPUT/mosaicFeathering_%s.tif' % color])
+    ortho_dirs = [os.path.join(os.getcwd(), 'Ortho-%s' % color) for color in COLORS]
+    pixels = sum(x['width'] * x['height'] for x in map(ortho_extent, ortho_dirs))
+    report = {}
+
+    if engine in ['mm3d', 'both']:
+        t0 = time.time()
+        report['mm3d'] = run_mm3d(ortho_dirs, ncores=ncores, box_size=box_size)
+        report['mm3d']['seconds'] = time.time() - t0
+        report['mm3d']['pixels'] = pixels
+        print('mm3d SeamlineFeathering: %.1f s (%.1f Mpx/s)'
+              % (report['mm3d']['seconds'],
+                 pixels / report['mm3d']['seconds'] / 1e6))
+
+        # Export; blocks of the five bands are read concurrently
+        stack_to_cog(['Ortho-%s/MosaicFeathering.tif' % color for color in COLORS],
+                     'OUTPUT/mosaicFeathering.tif', crs=utm_crs(utm),
+                     ncores=report['mm3d']['ncores'], descriptions=COLORS)
+
+    if engine in ['native', 'both']:
+        ncores_native = ncores or mp.cpu_count()
+        t0 = time.time()
+        # Weights are computed once per capture and shared by the five bands
+        with PeakMemoryMonitor() as monitor:
+            feather_mosaic(ortho_dirs, 'OUTPUT/mosaicNative.tif', crs=utm_crs(utm),
+                           ncores=ncores_native, descriptions=COLORS)
+        report['native'] = {'ncores': ncores_native,
+                            'seconds': time.time() - t0,
+                            'pixels': pixels,
+                            'measured_peak_rss': monitor.peak}
+        print('Native feathering: %.1f s (%.1f Mpx/s)'
+              % (report['native']['seconds'], pixels / report['native']['seconds'] / 1e6))
+
+    if engine == 'both':
+        print('Speed-up of native over mm3d: %.2fx'
+              % (report['mm3d']['seconds'] / report['native']['seconds']))
+
+    with open('OUTPUT/seamline_feathering_plan.json', 'w') as dst:
+        json.dump(report, dst, indent=2)
 
 
 if __name__ == '__main__':
     epilog = """
-Run micmac SeamlineFeathering mosaicking tool
+Run micmac SeamlineFeathering mosaicking tool, or its native python equivalent
+Box size and number of bands processed concurrently are chosen to fit the available
+memory and cores; the plan, measured peak memory and run times of each engine are
+written to OUTPUT/seamline_feathering_plan.json
 
 Example usage:
 --------------
@@ -48,6 +180,9 @@ run_seamline_feathering.py --help
 
 # With specific parameters
 run_seamline_feathering.py -i /path/to/images --utm 33
+
+# Compare throughput of mm3d and native feathering
+run_seamline_feathering.py -i /path/to/images --utm 33 --engine both
 """
     # Instantiate argparse parser
     parser = argparse.ArgumentParser(epilog=epilog,
@@ -64,17 +199,27 @@ run_seamline_feathering.py -i /path/to/images --utm 33
                         type=int,
                         help='UTM zone of the output orthomosaic')
 
-    parsed_args = parser.parse_args()
-    main(**vars(parsed_args))
-
-
-
-
-
-
-
-
-
-
+    parser.add_argument('-n', '--ncores',
+                        default=None,
+                        type=int,
+                        help='Maximum number of bands processed concurrently (defaults to all cores)')
 
+    parser.add_argument('-box', '--box-size',
+                        default=None,
+                        type=int,
+                        help='Force SzBox instead of choosing it from the available memory')
+
+    parser.add_argument('-engine', '--engine',
+                        default='mm3d',
+                        choices=['mm3d', 'native', 'both'],
+                        help="""
+Mosaicking engine:
+    mm3d: mm3d TestLib SeamlineFeathering (OUTPUT/mosaicFeathering.tif)
+    native: Distance weighted feathering of the Ort_ images masked by their PC_
+            hidden parts masks, with weights computed once per capture for the
+            five bands, processed by blocks with a pool of processes
+            (OUTPUT/mosaicNative.tif)
+    both: Run both and report their run times""")
 
+    parsed_args = parser.parse_args()
+    main(**vars(parsed_args))
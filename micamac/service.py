@@ -0,0 +1,335 @@
+import os
+import sys
+import json
+import time
+import uuid
+import runpy
+import shutil
+import threading
+import traceback
+import multiprocessing as mp
+import concurrent.futures
+
+from flask import Flask, render_template, jsonify, request, abort, url_for
+
+
+COMMANDS = {'align': 'align_images.py',
+            'micmac': 'run_micmac.py',
+            'tawny': 'rerun_tawny.py'}
+
+# Option giving the working directory of every command, and location of its step
+# timings (see ``micamac.resource_utils.StepTimer``) and outputs within it
+WORKDIR_FLAGS = {'align': ['-o', '--out_dir'],
+                 'micmac': ['-i', '--img_dir'],
+                 'tawny': ['-i', '--img_dir']}
+STEPS_FILES = {'align': 'steps.json',
+               'micmac': 'OUTPUT/steps.json',
+               'tawny': 'OUTPUT/tawny_steps.json'}
+OUTPUT_DIRS = {'align': '.',
+               'micmac': 'OUTPUT',
+               'tawny': 'OUTPUT'}
+
+
+def script_path(command):
+    """Path of the command line script of a command
+
+    Installed scripts (on the ``PATH``) are preferred to the source tree
+    """
+    name = COMMANDS[command]
+    path = shutil.which(name)
+    if path is None:
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scripts', name)
+    return path
+
+
+def arg_value(argv, flags):
+    """Value of a command line option in a list of arguments
+
+    Args:
+        argv (list): Command line arguments
+        flags (list): Option flags, e.g. ``['-i', '--img_dir']``
+
+    Return:
+        str: The option value, ``None`` if not present
+    """
+    for i, arg in enumerate(argv):
+        for flag in flags:
+            if arg == flag and i + 1 < len(argv):
+                return argv[i + 1]
+            if arg.startswith(flag + '='):
+                return arg[len(flag) + 1:]
+    return None
+
+
+def run_script(path, argv, log_path):
+    """Run a command line script in the current process, as if started from a shell
+
+    Standard output and error, including those of subprocesses (mm3d), are
+    redirected to ``log_path``; the working directory is restored afterwards so
+    that the process can run further scripts
+
+    Return:
+        int: Exit code of the script
+    """
+    cwd = os.getcwd()
+    sys_argv = sys.argv
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved_fds = os.dup(1), os.dup(2)
+    with open(log_path, 'a') as log:
+        os.dup2(log.fileno(), 1)
+        os.dup2(log.fileno(), 2)
+        try:
+            sys.argv = [path] + list(argv)
+            runpy.run_path(path, run_name='__main__')
+            code = 0
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                code = e.code or 0
+            else:
+                print(e.code, file=sys.stderr)
+                code = 1
+        except Exception:
+            traceback.print_exc()
+            code = 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(saved_fds[0], 1)
+            os.dup2(saved_fds[1], 2)
+            os.close(saved_fds[0])
+            os.close(saved_fds[1])
+            sys.argv = sys_argv
+            os.chdir(cwd)
+    return code
+
+
+def _run_job(job_dir, path, argv):
+    """Executor side of a job; records its start time in the job directory
+    """
+    with open(os.path.join(job_dir, 'started'), 'w') as dst:
+        dst.write(str(time.time()))
+    return run_script(path, argv, os.path.join(job_dir, 'log.txt'))
+
+
+def _read_json(path):
+    try:
+        with open(path) as src:
+            return json.load(src)
+    except (OSError, ValueError):
+        return None
+
+
+def create_app(state_dir='~/.micamac_service', max_jobs=1, max_queued=8):
+    """Long running local service to queue and follow processing runs
+
+    Jobs are runs of ``align_images.py``, ``run_micmac.py`` or ``rerun_tawny.py``
+    submitted with their command line arguments. They are executed in a pool
+    of ``max_jobs`` reused processes, at most ``max_queued`` further jobs wait in
+    the queue. Job records and logs are kept in ``state_dir``. Endpoints:
+
+    - ``POST /jobs`` with json ``{"command": "micmac", "args": ["-i", ...]}``
+    - ``GET /jobs``, ``GET /jobs/<id>`` (status and step timings),
+      ``GET /jobs/<id>/log``, ``GET /jobs/<id>/outputs``, ``POST /jobs/<id>/cancel``
+    - ``POST /aoi`` with json ``{"img_dir": ...}`` (or ``{"fc": ...}``) creates an
+      interactive area of interest selection map at ``GET /aoi/<id>``; the drawn
+      polygon (``GET /aoi/<id>/polygon``) is written to a file that can be passed
+      to ``align_images.py --subset``
+
+    Jobs run non interactively (no terminal): align jobs need ``--yes``, a
+    numeric ``--alt_thresh`` and a file or empty ``--subset``
+
+    Args:
+        state_dir (str): Directory where job records, logs and polygons are kept
+        max_jobs (int): Number of jobs running concurrently
+        max_queued (int): Number of jobs waiting to run; submissions are refused
+            (503) when the queue is full
+
+    Return:
+        flask.Flask: The app, with the executor in ``app.config['EXECUTOR']``
+    """
+    state_dir = os.path.abspath(os.path.expanduser(state_dir))
+    jobs_dir = os.path.join(state_dir, 'jobs')
+    aoi_dir = os.path.join(state_dir, 'aoi')
+    for d in [jobs_dir, aoi_dir]:
+        if not os.path.exists(d):
+            os.makedirs(d)
+    app = Flask(__name__, template_folder='../templates')
+    executor = concurrent.futures.ProcessPoolExecutor(max_jobs,
+                                                      mp_context=mp.get_context('spawn'))
+    app.config['EXECUTOR'] = executor
+    lock = threading.Lock()
+    jobs = {}
+    futures = {}
+    aois = {}
+
+    # Jobs of previous service instances
+    for job_id in os.listdir(jobs_dir):
+        job = _read_json(os.path.join(jobs_dir, job_id, 'job.json'))
+        if job is None:
+            continue
+        if job['status'] in ['queued', 'running']:
+            job['status'] = 'lost'
+        jobs[job_id] = job
+
+    def save(job):
+        with open(os.path.join(jobs_dir, job['id'], 'job.json'), 'w') as dst:
+            json.dump(job, dst, indent=2)
+
+    def on_done(job_id, future):
+        with lock:
+            job = jobs[job_id]
+            job['finished'] = time.time()
+            if future.cancelled():
+                job['status'] = 'cancelled'
+            elif future.exception() is not None:
+                job['status'] = 'failed'
+                job['error'] = repr(future.exception())
+            else:
+                job['returncode'] = future.result()
+                job['status'] = 'done' if job['returncode'] == 0 else 'failed'
+            job['started'] = status(job)['started']
+            save(job)
+            futures.pop(job_id, None)
+
+    def status(job):
+        job = dict(job)
+        job_dir = os.path.join(jobs_dir, job['id'])
+        if job.get('started') is None and os.path.exists(os.path.join(job_dir, 'started')):
+            with open(os.path.join(job_dir, 'started')) as src:
+                job['started'] = float(src.read())
+        if job['status'] == 'queued' and job.get('started') is not None:
+            job['status'] = 'running'
+        return job
+
+    def get_job(job_id):
+        with lock:
+            if job_id not in jobs:
+                abort(404)
+            return status(jobs[job_id])
+
+    @app.route('/')
+    def index():
+        return jsonify({'commands': sorted(COMMANDS),
+                        'max_jobs': max_jobs,
+                        'max_queued': max_queued})
+
+    @app.route('/jobs', methods=['GET'])
+    def list_jobs():
+        with lock:
+            job_list = [status(x) for x in jobs.values()]
+        return jsonify(sorted(job_list, key=lambda x: x['submitted']))
+
+    @app.route('/jobs', methods=['POST'])
+    def submit_job():
+        content = request.get_json(silent=True) or {}
+        command = content.get('command')
+        argv = content.get('args', [])
+        if command not in COMMANDS:
+            return jsonify({'error': 'command must be one of %s' % ', '.join(sorted(COMMANDS))}), 400
+        if not isinstance(argv, list) or not all(isinstance(x, str) for x in argv):
+            return jsonify({'error': 'args must be a list of strings'}), 400
+        workdir = arg_value(argv, WORKDIR_FLAGS[command])
+        if workdir is None:
+            return jsonify({'error': '%s is required' % '/'.join(WORKDIR_FLAGS[command])}), 400
+        with lock:
+            active = sum(status(x)['status'] in ['queued', 'running'] for x in jobs.values())
+            if active >= max_jobs + max_queued:
+                return jsonify({'error': 'Job queue is full (%d jobs)' % active}), 503
+            job_id = uuid.uuid4().hex[:12]
+            os.makedirs(os.path.join(jobs_dir, job_id))
+            job = {'id': job_id,
+                   'command': command,
+                   'args': argv,
+                   'workdir': os.path.abspath(workdir),
+                   'status': 'queued',
+                   'submitted': time.time(),
+                   'started': None,
+                   'finished': None,
+                   'returncode': None}
+            jobs[job_id] = job
+            save(job)
+            future = executor.submit(_run_job, os.path.join(jobs_dir, job_id),
+                                     script_path(command), argv)
+            futures[job_id] = future
+        future.add_done_callback(lambda f: on_done(job_id, f))
+        return jsonify(job), 202
+
+    @app.route('/jobs/<job_id>', methods=['GET'])
+    def job_detail(job_id):
+        job = get_job(job_id)
+        job['steps'] = _read_json(os.path.join(job['workdir'], STEPS_FILES[job['command']]))
+        return jsonify(job)
+
+    @app.route('/jobs/<job_id>/log', methods=['GET'])
+    def job_log(job_id):
+        get_job(job_id)
+        tail = request.args.get('tail', 100, type=int)
+        log_path = os.path.join(jobs_dir, job_id, 'log.txt')
+        if not os.path.exists(log_path):
+            return ''
+        with open(log_path, errors='replace') as src:
+            lines = src.readlines()
+        return ''.join(lines[-tail:]), 200, {'Content-Type': 'text/plain'}
+
+    @app.route('/jobs/<job_id>/outputs', methods=['GET'])
+    def job_outputs(job_id):
+        job = get_job(job_id)
+        out_dir = os.path.normpath(os.path.join(job['workdir'], OUTPUT_DIRS[job['command']]))
+        out = []
+        if os.path.isdir(out_dir):
+            for name in sorted(os.listdir(out_dir)):
+                path = os.path.join(out_dir, name)
+                if os.path.isfile(path):
+                    out.append({'path': path,
+                                'size': os.path.getsize(path),
+                                'modified': os.path.getmtime(path)})
+        return jsonify(out)
+
+    @app.route('/jobs/<job_id>/cancel', methods=['POST'])
+    def cancel_job(job_id):
+        get_job(job_id)
+        future = futures.get(job_id)
+        if future is None or not future.cancel():
+            return jsonify({'error': 'Only queued jobs can be cancelled'}), 409
+        return jsonify(get_job(job_id))
+
+    @app.route('/aoi', methods=['POST'])
+    def create_aoi():
+        content = request.get_json(silent=True) or {}
+        if 'fc' in content:
+            fc = content['fc']
+        elif 'img_dir' in content:
+            import micasense.imageset as imageset
+            from micamac.micasense_utils import capture_to_point, points_to_fc
+            imgset = imageset.ImageSet.from_directory(content['img_dir'])
+            fc = points_to_fc([capture_to_point(c) for c in imgset.captures])
+        else:
+            return jsonify({'error': 'img_dir or fc is required'}), 400
+        aoi_id = uuid.uuid4().hex[:12]
+        aois[aoi_id] = fc
+        return jsonify({'id': aoi_id,
+                        'url': url_for('aoi_map', aoi_id=aoi_id, _external=True)}), 201
+
+    @app.route('/aoi/<aoi_id>', methods=['GET'])
+    def aoi_map(aoi_id):
+        if aoi_id not in aois:
+            abort(404)
+        return render_template('index.html', fc=aois[aoi_id],
+                               polygon_url=url_for('aoi_polygon', aoi_id=aoi_id))
+
+    @app.route('/aoi/<aoi_id>/polygon', methods=['GET', 'POST'])
+    def aoi_polygon(aoi_id):
+        path = os.path.join(aoi_dir, '%s.geojson' % aoi_id)
+        if request.method == 'POST':
+            if aoi_id not in aois:
+                abort(404)
+            feature = request.get_json(silent=True)
+            with open(path, 'w') as dst:
+                json.dump({'type': 'FeatureCollection', 'features': [feature]}, dst)
+        fc = _read_json(path)
+        if fc is None:
+            abort(404)
+        return jsonify({'path': path, 'feature': fc['features'][0]})
+
+    return app
@@ -0,0 +1,201 @@
+import math
+import concurrent.futures
+
+import numpy as np
+import rasterio
+from rasterio.warp import transform
+
+from micamac.quicklook import read_capture_meta, capture_transform, footprint_bounds
+from micamac.export_utils import utm_crs
+
+
+def read_image_geometry(img_list):
+    """Position, altitude, yaw and camera geometry of aligned images
+
+    The yaw is recovered from the rotation of the geotransform written by
+    ``micamac.micasense_utils.affine_from_capture``
+
+    Args:
+        img_list (list): Images written by align_images.py
+
+    Return:
+        list: List of dict with ``lon``, ``lat``, ``alt``, ``yaw`` (radians),
+        ``pixel_angle``, ``width`` and ``height`` keys
+    """
+    out = read_capture_meta(img_list)
+    for meta, path in zip(out, img_list):
+        with rasterio.open(path) as src:
+            aff = src.transform
+            meta['width'] = src.width
+            meta['height'] = src.height
+        meta['yaw'] = math.radians(360 - math.degrees(math.atan2(-aff.b, aff.a)))
+    return out
+
+
+def footprint_cells(transforms, width, height, cell_size, origin):
+    """Cells of a coverage grid falling in every image footprint
+
+    Args:
+        transforms (list): Image to projected coordinates transforms, see
+            ``micamac.quicklook.capture_transform``
+        width (int): Image width
+        height (int): Image height
+        cell_size (float): Grid cell size in meters
+        origin (tuple): (xmin, ymax) of the grid
+
+    Return:
+        tuple: List of arrays of (row, col) cells (one array of shape (n, 2) per
+        image) and the grid shape
+    """
+    bounds = footprint_bounds(transforms, width, height)
+    x0, y1 = origin
+    n_rows = int(math.ceil((y1 - bounds[:, 1].min()) / cell_size)) + 1
+    n_cols = int(math.ceil((bounds[:, 2].max() - x0) / cell_size)) + 1
+    out = []
+    for aff, (xmin, ymin, xmax, ymax) in zip(transforms, bounds):
+        c0, c1 = int((xmin - x0) // cell_size), int((xmax - x0) // cell_size) + 1
+        r0, r1 = int((y1 - ymax) // cell_size), int((y1 - ymin) // cell_size) + 1
+        rows, cols = np.mgrid[r0:r1, c0:c1]
+        xs = x0 + (cols + 0.5) * cell_size
+        ys = y1 - (rows + 0.5) * cell_size
+        inv = ~aff
+        c = inv.c + xs * inv.a + ys * inv.b
+        r = inv.f + xs * inv.d + ys * inv.e
+        inside = (c >= 0) & (c < width) & (r >= 0) & (r < height)
+        out.append(np.column_stack([rows[inside], cols[inside]]))
+    return out, (n_rows, n_cols)
+
+
+def thin_captures(xy, transforms, width, height, ground_size, overlap=0.9,
+                  min_views=4, link_overlap=0.6, cell_fraction=0.1):
+    """Greedily select redundant captures that can be dropped
+
+    Footprints are rasterized on a coverage grid counting the images that see every
+    cell. Captures are visited from the most to the least redundant (median number
+    of views of their cells) and dropped when at least ``overlap`` of their footprint
+    remains seen by ``min_views`` kept images. To keep flight strips connected for
+    tie points, a capture is kept when dropping it would leave its previous and next
+    kept captures (in capture order) overlapping by less than ``link_overlap``
+
+    Args:
+        xy (numpy.ndarray): Projected positions, of shape (n, 2), in capture order
+        transforms (list): Footprint transforms, see ``micamac.quicklook.capture_transform``
+        width (int): Image width
+        height (int): Image height
+        ground_size (numpy.ndarray): Ground size of the short side of every footprint (m)
+        overlap (float): Fraction of the footprint of a dropped capture that must
+            remain covered
+        min_views (int): Number of kept images that must see the covered part
+        link_overlap (float): Minimum overlap between consecutive kept captures
+        cell_fraction (float): Coverage grid cell size, relative to the median
+            footprint short side
+
+    Return:
+        tuple: (keep, report) with ``keep`` a boolean array and ``report`` a dict
+        of coverage statistics (cells seen by at least one and ``min_views`` images
+        before and after thinning)
+    """
+    n = len(transforms)
+    cell_size = float(np.median(ground_size)) * cell_fraction
+    bounds = footprint_bounds(transforms, width, height)
+    cells, shape = footprint_cells(transforms, width, height, cell_size,
+                                   origin=(bounds[:, 0].min(), bounds[:, 3].max()))
+    flat = [x[:, 0] * shape[1] + x[:, 1] for x in cells]
+    views = np.bincount(np.concatenate(flat), minlength=shape[0] * shape[1])
+    before = {'covered': int((views > 0).sum()), 'multi': int((views >= min_views).sum())}
+    order = np.argsort([-np.median(views[x]) if len(x) else 0 for x in flat], kind='stable')
+    keep = np.ones(n, dtype=bool)
+    # Linked list of kept captures, in capture order
+    prev = np.arange(n) - 1
+    nxt = np.arange(n) + 1
+    max_step = (1 - link_overlap) * np.asarray(ground_size)
+    for i in order:
+        cell_idx = flat[i]
+        if not len(cell_idx):
+            continue
+        if (views[cell_idx] - 1 >= min_views).mean() < overlap:
+            continue
+        p, q = prev[i], nxt[i]
+        if p >= 0 and q < n:
+            gap = np.hypot(*(xy[q] - xy[p]))
+            linked = (np.hypot(*(xy[i] - xy[p])) <= max_step[i]
+                      and np.hypot(*(xy[q] - xy[i])) <= max_step[i])
+            if linked and gap > max_step[i]:
+                continue
+        keep[i] = False
+        views[cell_idx] -= 1
+        if p >= 0:
+            nxt[p] = q
+        if q < n:
+            prev[q] = p
+    after = {'covered': int((views > 0).sum()), 'multi': int((views >= min_views).sum())}
+    report = {'n_images': n,
+              'n_removed': int((~keep).sum()),
+              'cell_size': cell_size,
+              'min_views': min_views,
+              'coverage_kept': after['covered'] / float(before['covered']),
+              'multiview_coverage_kept': (after['multi'] / float(before['multi'])
+                                          if before['multi'] else 1.0)}
+    return keep, report
+
+
+def image_footprints(img_list, utm_zone, flight_height, ncores=4):
+    """Estimate the ground footprints of aligned images
+
+    Args:
+        img_list (list): Images written by align_images.py
+        utm_zone (int): Utm zone of the project
+        flight_height (float): Median flight height above ground (m); the height
+            of every capture follows its GPS altitude around that value
+        ncores (int): Number of processes used to read the image metadata
+
+    Return:
+        tuple: (xy, transforms, width, height, gsd), with ``xy`` the projected
+        positions (array of shape (n, 2)), ``transforms`` the footprint transforms
+        (see ``micamac.quicklook.capture_transform``) and ``gsd`` the ground size of
+        a pixel of every image
+    """
+    n_chunks = max(1, min(ncores, len(img_list)))
+    chunks = [img_list[i::n_chunks] for i in range(n_chunks)]
+    with concurrent.futures.ProcessPoolExecutor(n_chunks) as executor:
+        meta_chunks = list(executor.map(read_image_geometry, chunks))
+    meta_list = [None] * len(img_list)
+    for i, chunk in enumerate(meta_chunks):
+        meta_list[i::n_chunks] = chunk
+    xs, ys = transform('EPSG:4326', utm_crs(utm_zone), [x['lon'] for x in meta_list],
+                       [x['lat'] for x in meta_list])
+    xy = np.column_stack([xs, ys])
+    alt = np.array([x['alt'] for x in meta_list])
+    height_agl = np.clip(flight_height + alt - np.median(alt), 0.1 * flight_height, None)
+    gsd = np.array([x['pixel_angle'] for x in meta_list]) * height_agl
+    width, height = meta_list[0]['width'], meta_list[0]['height']
+    transforms = [capture_transform(x, y, m['yaw'], width, height, g)
+                  for (x, y), m, g in zip(xy, meta_list, gsd)]
+    return xy, transforms, width, height, gsd
+
+
+def thin_images(img_list, utm_zone, flight_height, overlap=0.9, min_views=4,
+                link_overlap=0.6, ncores=4):
+    """Select redundant images of a directory of aligned images
+
+    Args:
+        img_list (list): Panchromatic images, in capture order
+        utm_zone (int): Utm zone of the project
+        flight_height (float): See ``image_footprints``
+        overlap (float): See ``thin_captures``
+        min_views (int): See ``thin_captures``
+        link_overlap (float): See ``thin_captures``
+        ncores (int): Number of processes used to read the image metadata
+
+    Return:
+        tuple: (removed, report), list of images to drop and coverage report
+    """
+    xy, transforms, width, height, gsd = image_footprints(img_list, utm_zone,
+                                                          flight_height, ncores=ncores)
+    keep, report = thin_captures(xy, transforms, width, height,
+                                 ground_size=gsd * min(width, height),
+                                 overlap=overlap, min_views=min_views,
+                                 link_overlap=link_overlap)
+    removed = [x for x, k in zip(img_list, keep) if not k]
+    report['removed'] = removed
+    return removed, report
@@ -0,0 +1,257 @@
+import os
+import glob
+import json
+import time
+import subprocess
+import concurrent.futures
+
+import numpy as np
+import rasterio
+
+from micamac.micmac_utils import COLORS, make_tarama_mask, read_malt_dem, final_malt_dem
+from micamac.micmac_utils import run_malt_pan, run_malt_ortho, run_tawny
+from micamac.export_utils import stack_to_cog, utm_crs
+from micamac.mosaic import feather_rasters
+from micamac.workqueue import run_jobs
+from micamac.profile_utils import profiled
+
+
+def partition_centers(xy, tile_size, overlap=50):
+    """Split a block of camera centers into overlapping square ground tiles
+
+    Args:
+        xy (numpy.ndarray): Array of shape (n, 2) of projected camera centers
+        tile_size (float): Tile size in meters
+        overlap (float): Every tile includes the images whose center lies within
+            that distance (m) of the tile
+
+    Return:
+        list: List of dict with ``name``, ``bounds`` (xmin, ymin, xmax, ymax, not
+        including the overlap) and ``indices`` (array of image indices) keys.
+        Tiles without images are omitted
+    """
+    xmin, ymin = xy.min(axis=0)
+    xmax, ymax = xy.max(axis=0)
+    nx = max(1, int(np.ceil((xmax - xmin) / tile_size)))
+    ny = max(1, int(np.ceil((ymax - ymin) / tile_size)))
+    tiles = []
+    for i in range(nx):
+        for j in range(ny):
+            bounds = (xmin + i * tile_size, ymin + j * tile_size,
+                      xmin + (i + 1) * tile_size, ymin + (j + 1) * tile_size)
+            inside = ((xy[:,0] >= bounds[0] - overlap) & (xy[:,0] <= bounds[2] + overlap) &
+                      (xy[:,1] >= bounds[1] - overlap) & (xy[:,1] <= bounds[3] + overlap))
+            if inside.any():
+                tiles.append({'name': 'tile_%02d_%02d' % (i, j),
+                              'bounds': bounds,
+                              'indices': np.flatnonzero(inside)})
+    return tiles
+
+
+def prepare_tile_dir(tile_dir, img_list, ori_dir='Ori-Ground_UTM'):
+    """Create the working directory of a tile
+
+    Images of all bands, the orientation directory and the xml files of the
+    project are symbolic links to the project files
+
+    Args:
+        tile_dir (str): Tile directory, created if it doesn't exist
+        img_list (list): Panchromatic images of the tile
+        ori_dir (str): Orientation directory
+    """
+    if not os.path.exists(tile_dir):
+        os.makedirs(tile_dir)
+    link_list = list(img_list)
+    for color in COLORS:
+        link_list += [x.replace('pan_', '%s_' % color, 1) for x in img_list]
+    link_list += glob.glob('*.xml') + [ori_dir]
+    for name in link_list:
+        dst = os.path.join(tile_dir, name)
+        if not os.path.lexists(dst) and os.path.exists(name):
+            os.symlink(os.path.abspath(name), dst)
+
+
+def check_returncode(returncode, step):
+    """Raise when a mm3d step failed, so that queued tiles are retried
+
+    Raises:
+        RuntimeError: If ``returncode`` is not zero
+    """
+    if returncode != 0:
+        raise RuntimeError('mm3d %s failed in %s (return code %d)'
+                           % (step, os.getcwd(), returncode))
+
+
+def process_tile(tile_dir, point_list, utm_zone, resolution, ncores, startfrom=9,
+                 ortho=True, dem=True, mask_footprint='convex'):
+    """Run Tarama, Malt and Tawny in a tile directory and export its DEM and ortho
+
+    Changes the working directory to ``tile_dir``; meant to run in a pool worker
+
+    Args:
+        tile_dir (str): Absolute path of the tile directory, see ``prepare_tile_dir``
+        point_list (list): List of (shapely.Point, str) tuples of the tile images
+        utm_zone (int): Utm zone of the project
+        resolution (float): Ground resolution in meters
+        ncores (int): Number of processes used by mm3d
+        startfrom (int): First step to run, 9 (malt_pan), 10 (malt_multi) or
+            11 (tawny), see ``run_micmac.py --startfrom``
+        ortho (bool): Run Malt per band and Tawny, and export the orthomosaic
+        dem (bool): Export the DEM
+        mask_footprint (str): Footprint of the Tarama mask, see ``make_tarama_mask``
+
+    Return:
+        dict: Run time of each step, in seconds
+
+    Raises:
+        RuntimeError: If a mm3d step fails
+    """
+    os.chdir(tile_dir)
+    timing = {}
+    if startfrom <= 9:
+        t0 = time.time()
+        check_returncode(subprocess.call(['mm3d', 'Tarama', 'pan_.*tif', 'Ground_UTM']),
+                         'Tarama')
+        make_tarama_mask(point_list=point_list, utm_zone=utm_zone, buff=50,
+                         footprint=mask_footprint)
+        timing['tarama'] = time.time() - t0
+
+        t0 = time.time()
+        check_returncode(run_malt_pan(resolution=resolution, ncores=ncores), 'Malt pan')
+        timing['malt_pan'] = time.time() - t0
+
+    if startfrom <= 10 and ortho:
+        t0 = time.time()
+        for color in COLORS:
+            check_returncode(run_malt_ortho(color, resolution=resolution, ncores=ncores),
+                             'Malt %s' % color)
+        timing['malt_multi'] = time.time() - t0
+
+    if ortho:
+        t0 = time.time()
+        with concurrent.futures.ThreadPoolExecutor(len(COLORS)) as executor:
+            returncodes = list(executor.map(run_tawny, COLORS))
+        for color, returncode in zip(COLORS, returncodes):
+            check_returncode(returncode, 'Tawny %s' % color)
+        timing['tawny'] = time.time() - t0
+
+    t0 = time.time()
+    if not os.path.exists('OUTPUT'):
+        os.makedirs('OUTPUT')
+    if ortho:
+        stack_to_cog(['Ortho-%s/Orthophotomosaic.tif' % color for color in COLORS],
+                     'OUTPUT/ortho.tif', crs=utm_crs(utm_zone), ncores=ncores,
+                     descriptions=COLORS)
+    if dem:
+        dem_arr, aff = read_malt_dem(final_malt_dem())
+        profile = {'driver': 'GTiff', 'count': 1, 'dtype': 'float32', 'nodata': np.nan,
+                   'width': dem_arr.shape[1], 'height': dem_arr.shape[0],
+                   'crs': utm_crs(utm_zone), 'transform': aff}
+        with rasterio.open('OUTPUT/dem.tif', 'w', **profile) as dst:
+            dst.write(dem_arr, 1)
+    timing['export'] = time.time() - t0
+    return timing
+
+
+def _process_tile_job(job):
+    """Unpack arguments of ``process_tile`` and time the whole tile, for use in a process pool
+    """
+    tile_dir, point_list, utm_zone, resolution, ncores, options = job
+    t0 = time.time()
+    timing = process_tile(tile_dir, point_list, utm_zone, resolution, ncores, **options)
+    timing['total'] = time.time() - t0
+    return timing
+
+
+def merge_tiles(tile_dirs, utm_zone, ncores=4, out_dir='OUTPUT', ortho=True, dem=True):
+    """Merge the DEM and orthomosaics of tiles with feathering over their overlaps
+
+    Args:
+        tile_dirs (list): Tile directories, see ``process_tile``
+        utm_zone (int): Utm zone of the project
+        ncores (int): Number of processes
+        out_dir (str): Output directory
+        ortho (bool): Merge the orthomosaics
+        dem (bool): Merge the DEMs
+    """
+    crs = utm_crs(utm_zone)
+    if dem:
+        dem_list = [(os.path.join(x, 'OUTPUT', 'dem.tif'), None) for x in tile_dirs]
+        feather_rasters(dem_list, os.path.join(out_dir, 'dem.tif'), crs=crs, ncores=ncores)
+    if not ortho:
+        return
+    ortho_list = [(os.path.join(x, 'OUTPUT', 'ortho.tif'), None) for x in tile_dirs]
+    feather_rasters(ortho_list, os.path.join(out_dir, 'ortho.tif'), crs=crs, ncores=ncores,
+                    bands=range(1, len(COLORS) + 1), descriptions=COLORS)
+
+
+def run_tiles(point_list, xy, utm_zone, resolution, tile_size, overlap=50,
+              tile_jobs=2, ncores=4, tiles_dir='Tiles', queue=None, local_workers=0,
+              startfrom=9, ortho=True, dem=True, mask_footprint='convex'):
+    """Partitioned processing of an oriented block
+
+    The block is split into overlapping ground tiles (see ``partition_centers``),
+    Tarama/Malt/Tawny run in a separate working directory per tile with
+    ``tile_jobs`` tiles running concurrently, and the tile products are merged in
+    ``OUTPUT/``. Per tile run times are printed and written to ``OUTPUT/tiles.json``
+
+    Args:
+        point_list (list): List of (shapely.Point, str) tuples. See ``dir_to_points``
+        xy (numpy.ndarray): Projected camera centers, in the order of ``point_list``
+        utm_zone (int): Utm zone of the project
+        resolution (float): Ground resolution in meters
+        tile_size (float): Tile size in meters
+        overlap (float): Tile overlap in meters
+        tile_jobs (int): Number of tiles processed concurrently
+        ncores (int): Total number of cores; each tile uses ``ncores // tile_jobs``
+        tiles_dir (str): Directory where tile directories are created
+        queue (str): Optional work queue database (see ``micamac.workqueue``);
+            tiles are then submitted as jobs, claimed by workers possibly
+            running on other hosts, instead of being run in a local pool
+        local_workers (int): Number of local workers started when ``queue`` is set
+        startfrom (int): See ``process_tile``
+        ortho (bool): Produce the orthomosaic, see ``process_tile``
+        dem (bool): Produce the DEM, see ``process_tile``
+        mask_footprint (str): See ``process_tile``
+    """
+    tiles = partition_centers(xy, tile_size=tile_size, overlap=overlap)
+    print('Partitioned block in %d tiles of %.0f m' % (len(tiles), tile_size))
+    options = {'startfrom': startfrom, 'ortho': ortho, 'dem': dem,
+               'mask_footprint': mask_footprint}
+    jobs = []
+    for tile in tiles:
+        tile_dir = os.path.abspath(os.path.join(tiles_dir, tile['name']))
+        tile_points = [point_list[i] for i in tile['indices']]
+        prepare_tile_dir(tile_dir, [x[1] for x in tile_points])
+        jobs.append((tile_dir, tile_points, utm_zone, resolution,
+                     max(1, ncores // tile_jobs), options))
+    if queue is not None:
+        payloads = [{'tile_dir': tile_dir,
+                     'points': [(p.x, p.y, name) for p, name in tile_points],
+                     'utm_zone': utm_zone,
+                     'resolution': resolution,
+                     'ncores': tile_ncores,
+                     'options': options}
+                    for tile_dir, tile_points, _, _, tile_ncores, _ in jobs]
+        status = run_jobs(queue, 'tile', payloads, local_workers=local_workers)
+        timings = [json.loads(x['result']) for x in status]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(tile_jobs) as executor:
+            timings = list(executor.map(profiled(_process_tile_job, 'process_tile'), jobs))
+
+    report = []
+    for tile, timing in zip(tiles, timings):
+        print('%s: %d images, %s' % (tile['name'], len(tile['indices']),
+                                     ', '.join('%s %.0f s' % x for x in timing.items())))
+        report.append({'name': tile['name'],
+                       'bounds': tile['bounds'],
+                       'n_images': len(tile['indices']),
+                       'timing': timing})
+    if not os.path.exists('OUTPUT'):
+        os.makedirs('OUTPUT')
+    t0 = time.time()
+    merge_tiles([x[0] for x in jobs], utm_zone=utm_zone, ncores=ncores,
+                ortho=ortho, dem=dem)
+    print('Merged tiles in %.0f s' % (time.time() - t0))
+    with open('OUTPUT/tiles.json', 'w') as dst:
+        json.dump(report, dst, indent=2)
@@ -0,0 +1,286 @@
+import os
+import json
+import time
+import socket
+import sqlite3
+import threading
+import traceback
+import multiprocessing as mp
+
+from shapely.geometry import Point
+
+from micamac.micmac_utils import run_tawny
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL DEFAULT 3,
+    worker TEXT,
+    lease_until REAL,
+    created REAL,
+    started REAL,
+    finished REAL,
+    result TEXT,
+    error TEXT
+)
+"""
+
+
+def connect(db_path):
+    """Open (and initialize if needed) a work queue database
+
+    The database must live on a file system shared by all workers, with working
+    file locks (SQLite is used for locking and atomic job claims)
+    """
+    con = sqlite3.connect(db_path, timeout=60, isolation_level=None)
+    con.row_factory = sqlite3.Row
+    con.execute(SCHEMA)
+    return con
+
+
+def submit(db_path, kind, payload, max_attempts=3):
+    """Add a job to the queue
+
+    Args:
+        db_path (str): Queue database
+        kind (str): Job type, one of the keys of ``JOB_HANDLERS``
+        payload (dict): Json serializable job arguments
+        max_attempts (int): Number of attempts before the job is marked as failed
+
+    Return:
+        int: The job id
+    """
+    con = connect(db_path)
+    with con:
+        cur = con.execute('INSERT INTO jobs (kind, payload, max_attempts, created) VALUES (?, ?, ?, ?)',
+                          (kind, json.dumps(payload), max_attempts, time.time()))
+    job_id = cur.lastrowid
+    con.close()
+    return job_id
+
+
+def _requeue_stale(con, now):
+    """Give back jobs whose worker lease expired (worker died or lost the file system)
+    """
+    con.execute("UPDATE jobs SET status = 'failed', error = 'lease expired', finished = ? "
+                "WHERE status = 'running' AND lease_until < ? AND attempts >= max_attempts",
+                (now, now))
+    con.execute("UPDATE jobs SET status = 'pending', worker = NULL "
+                "WHERE status = 'running' AND lease_until < ?", (now,))
+
+
+def claim(db_path, worker, lease=600):
+    """Atomically claim the oldest pending job
+
+    Jobs of expired leases are re-queued (or failed when out of attempts) first
+
+    Args:
+        db_path (str): Queue database
+        worker (str): Worker identifier
+        lease (float): Lease duration in seconds; must be renewed while the job runs
+
+    Return:
+        dict: The claimed job (``id``, ``kind``, ``payload``, ``attempts``), or
+        ``None`` if there is no pending job
+    """
+    con = connect(db_path)
+    now = time.time()
+    try:
+        con.execute('BEGIN IMMEDIATE')
+        _requeue_stale(con, now)
+        row = con.execute("SELECT * FROM jobs WHERE status = 'pending' ORDER BY id LIMIT 1").fetchone()
+        if row is None:
+            con.execute('COMMIT')
+            return None
+        con.execute("UPDATE jobs SET status = 'running', worker = ?, attempts = attempts + 1, "
+                    "lease_until = ?, started = ? WHERE id = ?",
+                    (worker, now + lease, now, row['id']))
+        con.execute('COMMIT')
+    except Exception:
+        # Nothing to roll back when BEGIN itself failed (e.g. database locked);
+        # a failing rollback must not hide the original error
+        if con.in_transaction:
+            try:
+                con.execute('ROLLBACK')
+            except sqlite3.Error:
+                pass
+        raise
+    finally:
+        con.close()
+    return {'id': row['id'],
+            'kind': row['kind'],
+            'payload': json.loads(row['payload']),
+            'attempts': row['attempts'] + 1}
+
+
+def renew(db_path, job_id, worker, lease=600):
+    """Extend the lease of a running job
+
+    Return:
+        bool: ``False`` if the job is no longer leased by that worker
+    """
+    con = connect(db_path)
+    with con:
+        cur = con.execute("UPDATE jobs SET lease_until = ? WHERE id = ? AND worker = ? AND status = 'running'",
+                          (time.time() + lease, job_id, worker))
+    con.close()
+    return cur.rowcount == 1
+
+
+def finish(db_path, job_id, worker, result=None, error=None):
+    """Mark a job as done, or as failed/pending (retry) when ``error`` is set
+    """
+    con = connect(db_path)
+    with con:
+        if error is None:
+            con.execute("UPDATE jobs SET status = 'done', result = ?, finished = ? WHERE id = ? AND worker = ?",
+                        (json.dumps(result), time.time(), job_id, worker))
+        else:
+            con.execute("UPDATE jobs SET status = CASE WHEN attempts >= max_attempts THEN 'failed' ELSE 'pending' END, "
+                        "error = ?, finished = ?, worker = NULL WHERE id = ? AND worker = ?",
+                        (error, time.time(), job_id, worker))
+    con.close()
+
+
+def job_status(db_path, job_ids=None):
+    """Status of jobs
+
+    Return:
+        list: List of dict (one per job) with the job columns
+    """
+    con = connect(db_path)
+    if job_ids is None:
+        rows = con.execute('SELECT * FROM jobs ORDER BY id').fetchall()
+    else:
+        rows = con.execute('SELECT * FROM jobs WHERE id IN (%s) ORDER BY id'
+                           % ','.join('?' * len(job_ids)), list(job_ids)).fetchall()
+    con.close()
+    return [dict(x) for x in rows]
+
+
+def wait(db_path, job_ids, poll=10):
+    """Block until all jobs are done
+
+    Raises:
+        RuntimeError: If any of the jobs failed
+    """
+    while True:
+        status = job_status(db_path, job_ids)
+        if all(x['status'] in ['done', 'failed'] for x in status):
+            break
+        time.sleep(poll)
+    failed = [x for x in status if x['status'] == 'failed']
+    if failed:
+        raise RuntimeError('%d jobs failed: %s' % (len(failed),
+                                                   '; '.join('%d (%s): %s' % (x['id'], x['kind'], x['error'])
+                                                             for x in failed)))
+    return status
+
+
+def _handle_tawny(payload):
+    return run_tawny(payload['color'], cwd=payload['cwd'])
+
+
+def _handle_tile(payload):
+    from micamac.tiling import _process_tile_job
+    point_list = [(Point(lon, lat), name) for lon, lat, name in payload['points']]
+    return _process_tile_job((payload['tile_dir'], point_list, payload['utm_zone'],
+                              payload['resolution'], payload['ncores'],
+                              payload.get('options', {})))
+
+
+JOB_HANDLERS = {'tawny': _handle_tawny,
+                'tile': _handle_tile}
+
+
+def _keep_alive(db_path, job_id, worker, lease, stop):
+    while not stop.wait(lease / 3.0):
+        if not renew(db_path, job_id, worker, lease):
+            break
+
+
+def run_worker(db_path, worker=None, lease=600, idle_timeout=None, poll=10):
+    """Claim and run jobs until the queue stays empty for ``idle_timeout`` seconds
+
+    The lease of the running job is renewed in a background thread; jobs
+    returning a non zero integer (mm3d return code) or raising are retried
+    until their ``max_attempts`` is reached
+
+    Args:
+        db_path (str): Queue database
+        worker (str): Worker identifier, defaults to ``hostname:pid``
+        lease (float): Lease duration in seconds
+        idle_timeout (float): Stop after that many seconds without pending jobs.
+            ``None`` runs forever
+        poll (float): Seconds between two claims when the queue is empty
+    """
+    worker = worker or '%s:%d' % (socket.gethostname(), os.getpid())
+    idle_since = time.time()
+    while True:
+        job = claim(db_path, worker, lease)
+        if job is None:
+            if idle_timeout is not None and time.time() - idle_since > idle_timeout:
+                return
+            time.sleep(poll)
+            continue
+        print('[%s] running job %d (%s), attempt %d' % (worker, job['id'], job['kind'], job['attempts']))
+        stop = threading.Event()
+        keeper = threading.Thread(target=_keep_alive, args=(db_path, job['id'], worker, lease, stop))
+        keeper.daemon = True
+        keeper.start()
+        try:
+            result = JOB_HANDLERS[job['kind']](job['payload'])
+            if isinstance(result, int) and result != 0:
+                finish(db_path, job['id'], worker, error='return code %d' % result)
+            else:
+                finish(db_path, job['id'], worker, result=result)
+        except Exception:
+            finish(db_path, job['id'], worker, error=traceback.format_exc())
+        finally:
+            stop.set()
+            keeper.join()
+        idle_since = time.time()
+
+
+def start_local_workers(db_path, n, lease=600, idle_timeout=30):
+    """Start worker processes on the local machine
+
+    Return:
+        list: The started ``multiprocessing.Process`` objects
+    """
+    workers = []
+    for i in range(n):
+        p = mp.Process(target=run_worker, args=(db_path,),
+                       kwargs={'lease': lease, 'idle_timeout': idle_timeout, 'poll': 2})
+        p.start()
+        workers.append(p)
+    return workers
+
+
+def run_jobs(db_path, kind, payloads, local_workers=0, poll=10):
+    """Submit jobs, optionally start local workers, and wait for completion
+
+    Args:
+        db_path (str): Queue database
+        kind (str): Job type, see ``JOB_HANDLERS``
+        payloads (list): List of job payloads
+        local_workers (int): Number of worker processes to start on this machine
+            (remote workers claim jobs from the same database)
+        poll (float): Seconds between status checks
+
+    Return:
+        list: Final status of the jobs, see ``job_status``
+    """
+    job_ids = [submit(db_path, kind, x) for x in payloads]
+    workers = start_local_workers(db_path, local_workers)
+    try:
+        status = wait(db_path, job_ids, poll=poll)
+    finally:
+        for p in workers:
+            p.join()
+    return status
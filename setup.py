@@ -27,6 +27,7 @@ setup(name='micamac',
           'fiona',
           'rasterio',
           'numpy',
+          'opencv-python',
           'matplotlib',
           'flask',
           'micasense',
@@ -37,5 +38,10 @@ setup(name='micamac',
           'micamac/scripts/align_images.py',
           'micamac/scripts/run_micmac.py',
           'micamac/scripts/run_seamline_feathering.py',
-          'micamac/scripts/rerun_tawny.py'
+          'micamac/scripts/rerun_tawny.py',
+          'micamac/scripts/homol_qa.py',
+          'micamac/scripts/compute_indices.py',
+          'micamac/scripts/micamac_worker.py',
+          'micamac/scripts/micamac_service.py',
+          'micamac/scripts/quicklook.py'
       ])